@@ -0,0 +1,37 @@
+"""
+ASGI config for AirQuality project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. Served 
+with uvicorn workers (see Procfile), the async views (e.g. the site readings endpoint) 
+wait on the LondonAir API without blocking the worker, so one worker can have many 
+requests to the API in flight. Static files are served in front of Django (see 
+Emissions/staticfiles.py), so that every middleware in the chain supports async requests
+and no request is run in a thread because of one.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import logging
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AirQuality.settings')
+
+application = get_asgi_application()
+
+from Emissions.staticfiles import ASGIStaticFiles  # noqa: E402 (needs the settings)
+application = ASGIStaticFiles(application)
+
+# load the reference data into this worker's cache before it serves any requests (see
+# Emissions/reference.py); if that fails (e.g. the database isn't ready), it's loaded by 
+# the first request instead
+try:
+    from django.db import connections
+    from Emissions import reference
+    reference.warm()
+    connections.close_all()
+except Exception as error:
+    # logged with the reference module's logs, so that it goes to the app's log handler
+    logging.getLogger("Emissions.reference").warning("Could not warm the reference data cache: %s", error)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import sys
 import django_heroku
 from selenium import webdriver
 
@@ -33,8 +34,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'Emissions.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # static files are served in front of Django, not by WhiteNoiseMiddleware (see 
+    # Emissions/staticfiles.py); every middleware here must support async requests
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -130,12 +133,156 @@ STATICFILES_DIRS = [STATIC_DIR, ]
 MEDIA_ROOT = MEDIA_DIR
 MEDIA_URL = '/media/'
 
+# Cache (shared between gunicorn workers). Uses redis if it's available, e.g. via the
+# heroku-redis add-on; otherwise falls back to database tables, which are created with
+#   $> python manage.py createcachetable
+# The 'bulk' cache holds the many short-lived entries (per-point nowcasts and per-site 
+# days of readings), so that they can't evict the few small control entries in 'default'
+# (data versions, circuit breaker state, fetch locks, the last good snapshots). A database
+# cache culls a third of its entries once it has MAX_ENTRIES.
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+        'bulk': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'airquality_cache',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+        'bulk': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'airquality_bulk_cache',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+    }
+
+# LondonAir API data is published hourly; snapshots of it are cached until the next
+# publish time (PUBLISH_OFFSET seconds after the hour), or for at most SNAPSHOT_TTL seconds.
+AIRQUALITY_SNAPSHOT_TTL = int(os.environ.get('AIRQUALITY_SNAPSHOT_TTL', 60 * 60))
+AIRQUALITY_PUBLISH_OFFSET = int(os.environ.get('AIRQUALITY_PUBLISH_OFFSET', 10 * 60))
+# each process re-reads the data version tokens, and whether the emissions are stale 
+# because the API is down, from the cache (a query, with the database cache) at most once
+# per VERSION_CHECK_INTERVAL seconds (see cache.get_local_data_versions and get_local)
+AIRQUALITY_VERSION_CHECK_INTERVAL = float(os.environ.get('AIRQUALITY_VERSION_CHECK_INTERVAL', 5))
+
+# LondonAir API client (see Emissions/http_client.py). Set AIRQUALITY_PROXY to the URL
+# of a proxy server if one is needed, e.g. 'http://10.160.27.36:3128'.
+AIRQUALITY_API_URL = os.environ.get('AIRQUALITY_API_URL', 'https://api.erg.kcl.ac.uk/AirQuality')
+AIRQUALITY_PROXY = os.environ.get('AIRQUALITY_PROXY')
+AIRQUALITY_CONNECT_TIMEOUT = float(os.environ.get('AIRQUALITY_CONNECT_TIMEOUT', 3.05))
+AIRQUALITY_READ_TIMEOUT = float(os.environ.get('AIRQUALITY_READ_TIMEOUT', 30))
+AIRQUALITY_MAX_RETRIES = int(os.environ.get('AIRQUALITY_MAX_RETRIES', 3))
+AIRQUALITY_RETRY_BACKOFF = float(os.environ.get('AIRQUALITY_RETRY_BACKOFF', 0.5))
+AIRQUALITY_POOL_SIZE = int(os.environ.get('AIRQUALITY_POOL_SIZE', 10))
+# max number of connections to the API from each ASGI worker (see Emissions/async_client.py)
+AIRQUALITY_ASYNC_POOL_SIZE = int(os.environ.get('AIRQUALITY_ASYNC_POOL_SIZE', 100))
+# max number of simultaneous requests to the API when fetching several URLs; keep this
+# no larger than AIRQUALITY_POOL_SIZE
+AIRQUALITY_MAX_CONCURRENCY = int(os.environ.get('AIRQUALITY_MAX_CONCURRENCY', 6))
+# long time windows of hourly readings are requested in chunks of this many days
+AIRQUALITY_STREAM_WINDOW_DAYS = int(os.environ.get('AIRQUALITY_STREAM_WINDOW_DAYS', 31))
+# a chunk whose response breaks off while it's being read (which the client can't retry,
+# as it has already returned the response) is requested again up to this many times
+AIRQUALITY_STREAM_RETRIES = int(os.environ.get('AIRQUALITY_STREAM_RETRIES', 2))
+# concurrent requests for the same API URL are coalesced into one: within a process, and 
+# across processes by a lock in the shared cache. A lock is held for at most 
+# FETCH_LOCK_TIMEOUT seconds (0 turns off the cross-process lock), while the other 
+# processes poll the cache for its result, which is kept for FETCH_RESULT_TTL seconds. 
+# They first poll after FETCH_LOCK_POLL seconds, then twice as long each time, up to 
+# FETCH_LOCK_POLL_MAX seconds (each poll is a query, with the database cache)
+AIRQUALITY_FETCH_LOCK_TIMEOUT = float(os.environ.get('AIRQUALITY_FETCH_LOCK_TIMEOUT', 30))
+AIRQUALITY_FETCH_LOCK_POLL = float(os.environ.get('AIRQUALITY_FETCH_LOCK_POLL', 0.1))
+AIRQUALITY_FETCH_LOCK_POLL_MAX = float(os.environ.get('AIRQUALITY_FETCH_LOCK_POLL_MAX', 2))
+AIRQUALITY_FETCH_RESULT_TTL = int(os.environ.get('AIRQUALITY_FETCH_RESULT_TTL', 5))
+# circuit breaker (see Emissions/breaker.py): after BREAKER_FAILURES consecutive failed 
+# requests (0 turns it off), requests to the API fail immediately for BREAKER_RESET 
+# seconds, then a single probe request is let through
+AIRQUALITY_BREAKER_FAILURES = int(os.environ.get('AIRQUALITY_BREAKER_FAILURES', 5))
+AIRQUALITY_BREAKER_RESET = float(os.environ.get('AIRQUALITY_BREAKER_RESET', 60))
+# the current emissions are shown as stale once the latest snapshot is more than 
+# STALE_AFTER seconds old (e.g. the ingest worker has stopped, or the API is down)
+AIRQUALITY_STALE_AFTER = int(os.environ.get('AIRQUALITY_STALE_AFTER', 2 * 60 * 60))
+
+# number of days of hourly readings to get for a site the first time it is ingested
+# into the local store (see Emissions/store.py)
+AIRQUALITY_INGEST_BACKFILL_DAYS = int(os.environ.get('AIRQUALITY_INGEST_BACKFILL_DAYS', 7))
+# number of days that snapshots of the hourly group index are kept in the database
+AIRQUALITY_SNAPSHOT_RETENTION_DAYS = int(os.environ.get('AIRQUALITY_SNAPSHOT_RETENTION_DAYS', 30))
+
+# size (in km) of the grid cells of the in-process spatial index of sites (see
+# Emissions/spatial.py)
+AIRQUALITY_SPATIAL_CELL_KM = float(os.environ.get('AIRQUALITY_SPATIAL_CELL_KM', 2))
+
+# the borough boundaries are served simplified for each of these map zoom levels (see
+# Emissions/boundaries.py); variants are built from SOURCE into DIR by the
+# build_boundaries management command
+AIRQUALITY_BOUNDARY_ZOOMS = [int(zoom) for zoom in 
+                             os.environ.get('AIRQUALITY_BOUNDARY_ZOOMS', '10,12,14,16').split(',')]
+AIRQUALITY_BOUNDARIES_SOURCE = os.path.join(STATIC_DIR, 'js', 'londonBoroughs.geojson')
+AIRQUALITY_BOUNDARIES_DIR = os.environ.get('AIRQUALITY_BOUNDARIES_DIR', os.path.join(BASE_DIR, 'boundaries'))
+# max number of points in one request to the batch point-in-borough endpoint (/api/borough)
+AIRQUALITY_BOROUGH_MAX_POINTS = int(os.environ.get('AIRQUALITY_BOROUGH_MAX_POINTS', 10000))
+
+# nowcasts are interpolated locally from the stored readings ('local'), falling back to
+# the LondonAir API if there are none, or always come from the API ('api'). The local 
+# nowcast is the inverse-distance-weighted mean (with weights 1 / distance ** POWER) of 
+# the readings from the last MAX_AGE_HOURS hours at the NEIGHBOURS nearest sites
+AIRQUALITY_NOWCAST_SOURCE = os.environ.get('AIRQUALITY_NOWCAST_SOURCE', 'local')
+AIRQUALITY_NOWCAST_NEIGHBOURS = int(os.environ.get('AIRQUALITY_NOWCAST_NEIGHBOURS', 4))
+AIRQUALITY_NOWCAST_POWER = float(os.environ.get('AIRQUALITY_NOWCAST_POWER', 2))
+AIRQUALITY_NOWCAST_MAX_AGE_HOURS = int(os.environ.get('AIRQUALITY_NOWCAST_MAX_AGE_HOURS', 3))
+# nowcasts from the API are cached (until the next publish time) in square grid cells of 
+# this size in metres, so that nearby points share them
+AIRQUALITY_NOWCAST_CACHE_CELL_M = float(os.environ.get('AIRQUALITY_NOWCAST_CACHE_CELL_M', 100))
+# max number of points in one request to the batch nowcast endpoint (/api/nowcast)
+AIRQUALITY_NOWCAST_MAX_POINTS = int(os.environ.get('AIRQUALITY_NOWCAST_MAX_POINTS', 10000))
+
+# metrics (see Emissions/metrics.py) are served at /metrics; set AIRQUALITY_METRICS_TOKEN
+# to require an 'Authorization: Bearer <token>' header
+AIRQUALITY_METRICS_TOKEN = os.environ.get('AIRQUALITY_METRICS_TOKEN')
+
+# Logging: the app's logs (including a line per request, and per request to the 
+# LondonAir API) are written to the console as JSON, one object per line. While running
+# the tests, only warnings are logged by default, so the per-request lines don't flood
+# the test output
+# https://docs.djangoproject.com/en/4.2/topics/logging/
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'Emissions.metrics.JsonFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'Emissions': {
+            'handlers': ['console'],
+            'level': os.environ.get('AIRQUALITY_LOG_LEVEL', 'WARNING' if 'test' in sys.argv[1:2] else 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # oddity where running in travis ci with django_heroku breaks the 
 # build, but running without throws a 500 error in heroku:
 # https://github.com/heroku/django-heroku/issues/39
 try:
     if '/app' in os.environ['HOME']:        
-        django_heroku.settings(locals())
+        # logging is configured above
+        # static files are configured here, so that WhiteNoiseMiddleware isn't added
+        django_heroku.settings(locals(), logging=False, staticfiles=False)
+        STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 except KeyError:
     print("Running locally")
 
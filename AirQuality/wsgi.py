@@ -1,12 +1,14 @@
 """
 WSGI config for AirQuality project.
 
-It exposes the WSGI callable as a module-level variable named ``application``.
+It exposes the WSGI callable as a module-level variable named ``application``. Static
+files are served in front of Django (see Emissions/staticfiles.py).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/2.1/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +16,18 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AirQuality.settings')
 
 application = get_wsgi_application()
+
+from Emissions.staticfiles import WSGIStaticFiles  # noqa: E402 (needs the settings)
+application = WSGIStaticFiles(application)
+
+# load the reference data into this worker's cache before it serves any requests (see
+# Emissions/reference.py); if that fails (e.g. the database isn't ready), it's loaded by 
+# the first request instead
+try:
+    from django.db import connections
+    from Emissions import reference
+    reference.warm()
+    connections.close_all()
+except Exception as error:
+    # logged with the reference module's logs, so that it goes to the app's log handler
+    logging.getLogger("Emissions.reference").warning("Could not warm the reference data cache: %s", error)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class EmissionsConfig(AppConfig):
     name = 'Emissions'
+
+    def ready(self):
+        # connect the signal handlers
+        from Emissions import signals  # noqa: F401
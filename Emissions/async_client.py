@@ -0,0 +1,154 @@
+"""
+Async HTTP client for the LondonAir API, used by the async views when the app is served
+over ASGI (see AirQuality/asgi.py).
+
+It mirrors Emissions/http_client.py: requests go through a pooled, keep-alive
+httpx.AsyncClient with the same connect and read timeouts, jittered retries, circuit
+breaker and metrics (see Emissions/metrics.py). While a request waits on the API, the 
+worker's event loop serves other requests, so one worker can have up to 
+settings.AIRQUALITY_ASYNC_POOL_SIZE requests to the API in flight. Failures are raised as
+requests exceptions, so that callers handle errors from both clients the same way.
+"""
+import asyncio
+import random
+import weakref
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from Emissions import metrics
+from Emissions.breaker import CircuitBreaker, CircuitOpenError
+from Emissions.http_client import RETRY_STATUS_CODES
+
+
+class AsyncApiClient:
+    """
+    Pooled, keep-alive async client for the LondonAir API, with timeouts and retries.
+    Defaults for each of the parameters are taken from settings.py, apart from breaker
+    (a CircuitBreaker), which defaults to None, i.e. no circuit breaker; and transport
+    (an httpx transport, e.g. for tests), which defaults to httpx's own.
+
+    The client's connections belong to the event loop that it is used in; use
+    get_async_client to get the client for the running loop.
+    """
+
+    def __init__(self, base_url=None, proxy=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff=None, pool_size=None, breaker=None, transport=None):
+        self.base_url = base_url if base_url is not None else settings.AIRQUALITY_API_URL
+        self.proxy = proxy if proxy is not None else settings.AIRQUALITY_PROXY
+        self.timeout = httpx.Timeout(
+            read_timeout if read_timeout is not None else settings.AIRQUALITY_READ_TIMEOUT,
+            connect=connect_timeout if connect_timeout is not None else settings.AIRQUALITY_CONNECT_TIMEOUT)
+        self.max_retries = max_retries if max_retries is not None else settings.AIRQUALITY_MAX_RETRIES
+        self.backoff = backoff if backoff is not None else settings.AIRQUALITY_RETRY_BACKOFF
+        pool_size = pool_size if pool_size is not None else settings.AIRQUALITY_ASYNC_POOL_SIZE
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.breaker = breaker
+        self.transport = transport
+        # httpx sets proxies per client, so there's one client per proxy server
+        self.clients = {}
+
+    def client_for(self, proxy):
+        """
+        Get the httpx.AsyncClient for a proxy server (or None, for no proxy), creating
+        it on first use.
+        """
+        client = self.clients.get(proxy)
+        if client is None:
+            client = self.clients[proxy] = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout, limits=self.limits,
+                proxy=proxy or None, transport=self.transport)
+        return client
+
+    def backoff_delay(self, attempt):
+        """
+        Time to wait before retry number attempt (counting from 0); see
+        ApiClient.backoff_delay.
+        """
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    async def get(self, url, proxy=None):
+        """
+        GET a URL from the API, retrying on connection errors, timeouts and 5xx responses.
+
+        Parameters:
+        - url (str), the API endpoint, relative to base_url (e.g. '/Information/Species/Json')
+        - proxy (str), URL of a proxy server to use for this request. Optional, default
+        None (i.e. use the client's proxy, if it has one)
+
+        Returns:
+        - an httpx.Response object, with its body read; this may have a non-200 status code
+
+        Raises:
+        - requests.exceptions.RequestException if no response is received after all
+        retries, or CircuitOpenError (a subclass) if the circuit breaker is open
+        """
+        if self.breaker is not None and not await sync_to_async(self.breaker.allow)(url):
+            metrics.record_upstream(url, "CircuitOpenError", None)
+            raise CircuitOpenError(f"Circuit breaker open; not requesting {url}")
+        client = self.client_for(proxy or self.proxy)
+        for attempt in range(self.max_retries + 1):
+            elapsed = metrics.timer()
+            try:
+                response = await client.get(url)
+            except httpx.TransportError as error:
+                metrics.record_upstream(url, type(error).__name__, elapsed())
+                if attempt == self.max_retries:
+                    await self.record_outcome(url, False)
+                    if isinstance(error, httpx.TimeoutException):
+                        raise requests.exceptions.Timeout(str(error)) from error
+                    raise requests.exceptions.ConnectionError(str(error)) from error
+            else:
+                metrics.record_upstream(url, response.status_code, elapsed(), len(response.content))
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    await self.record_outcome(url, response.status_code not in RETRY_STATUS_CODES)
+                    return response
+            metrics.record_retry(url)
+            await asyncio.sleep(self.backoff_delay(attempt))
+
+    async def record_outcome(self, url, success):
+        """
+        Tell the circuit breaker (if there is one) whether a request to url succeeded.
+        """
+        if self.breaker is None:
+            return
+        if success:
+            await sync_to_async(self.breaker.record_success)(url)
+        else:
+            await sync_to_async(self.breaker.record_failure)(url)
+
+    async def get_json(self, url, proxy=None):
+        """
+        GET a URL from the API and parse the response body as JSON.
+
+        Returns:
+        - the JSON data, or None if the API didn't return a 200 response
+
+        Raises:
+        - requests.exceptions.RequestException if no response is received after all
+        retries, or the body isn't valid JSON
+        """
+        response = await self.get(url, proxy)
+        if response.status_code != 200:
+            return None
+        try:
+            return response.json()
+        except ValueError as error:
+            raise requests.exceptions.InvalidJSONError(str(error)) from error
+
+
+# the client for each event loop; under ASGI there's one loop per worker, so one client
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    Get the shared AsyncApiClient for the running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncApiClient(breaker=CircuitBreaker())
+    return client
@@ -0,0 +1,213 @@
+"""
+Point-in-borough lookup: finds which London borough (and LocalAuthority) a point is in,
+using the full-detail borough boundaries (settings.AIRQUALITY_BOUNDARIES_SOURCE).
+
+The polygons are loaded once per process into a BoroughIndex. Each polygon part has a
+bounding box; a query first filters the parts by bounding box (vectorised over all the
+parts), then runs an exact ray-casting point-in-polygon test against only the parts whose
+box contains the point. Each part's box is also split into horizontal bands, so a point is
+only tested against the edges that cross its band. Batches of points are tested in one
+vectorised pass per band.
+"""
+import re
+import threading
+
+import numpy as np
+
+from Emissions.boundaries import load_source
+from Emissions.models import LocalAuthority
+
+# max number of (points x edges) crossings computed at once in a batch test
+BATCH_CELLS = 4_000_000
+# number of horizontal bands that each polygon part's edges are split into
+PART_BANDS = 64
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class BoroughIndex:
+    """
+    Bounding-box index of borough polygons, answering point-in-borough queries.
+
+    Parameters:
+    - geojson (dict), a FeatureCollection of (Multi)Polygon features with a 'name' property
+    """
+
+    def __init__(self, geojson):
+        self.names = []
+        # for each polygon part: the index of its borough; and for each of its bands, its
+        # edges that cross the band, as arrays of the start (x1, y1) and end (x2, y2)
+        # coordinates of the edges
+        self.part_boroughs, self.part_bands = [], []
+        boxes = []
+        for feature in geojson["features"]:
+            geometry = feature["geometry"]
+            polygons = (geometry["coordinates"] if geometry["type"] == "MultiPolygon"
+                        else [geometry["coordinates"]])
+            self.names.append(feature["properties"]["name"])
+            for polygon in polygons:
+                rings = [np.asarray(ring, dtype=float) for ring in polygon]
+                starts = np.concatenate([ring[:-1] for ring in rings])
+                ends = np.concatenate([ring[1:] for ring in rings])
+                outer = rings[0]
+                box = [outer[:, 0].min(), outer[:, 1].min(), outer[:, 0].max(), outer[:, 1].max()]
+                self.part_boroughs.append(len(self.names) - 1)
+                self.part_bands.append(self.band_edges(starts, ends, box[1], box[3]))
+                boxes.append(box)
+        # min lon, min lat, max lon, max lat of each part
+        self.boxes = np.array(boxes).reshape(-1, 4)
+
+    @staticmethod
+    def band_edges(starts, ends, min_lat, max_lat):
+        """
+        Split a polygon part's edges into PART_BANDS horizontal bands between min_lat and
+        max_lat; an edge is in every band that its latitude range overlaps.
+
+        Returns:
+        - a tuple (min_lat, band height, list of (x1, y1, x2, y2) arrays for each band)
+        """
+        height = max((max_lat - min_lat) / PART_BANDS, 1e-12)
+        low = np.clip(((np.minimum(starts[:, 1], ends[:, 1]) - min_lat) // height).astype(int), 0, PART_BANDS - 1)
+        high = np.clip(((np.maximum(starts[:, 1], ends[:, 1]) - min_lat) // height).astype(int), 0, PART_BANDS - 1)
+        bands = []
+        for band in range(PART_BANDS):
+            edges = (low <= band) & (band <= high)
+            bands.append((starts[edges, 0], starts[edges, 1], ends[edges, 0], ends[edges, 1]))
+        return min_lat, height, bands
+
+    def contains(self, part, lons, lats):
+        """
+        Exact point-in-polygon test of points (within the part's bounding box) against a
+        polygon part, by ray casting (the even-odd rule, so holes are handled too).
+
+        Returns:
+        - a boolean array, True for each point inside the part
+        """
+        min_lat, height, bands = self.part_bands[part]
+        point_bands = np.clip(((lats - min_lat) // height).astype(int), 0, PART_BANDS - 1)
+        inside = np.zeros(len(lons), dtype=bool)
+        for band in np.unique(point_bands).tolist():
+            x1, y1, x2, y2 = bands[band]
+            if not len(x1):
+                continue
+            points = np.flatnonzero(point_bands == band)
+            chunk = max(1, BATCH_CELLS // len(x1))
+            for start in range(0, len(points), chunk):
+                chunk_points = points[start:start + chunk]
+                px = lons[chunk_points, None]
+                py = lats[chunk_points, None]
+                # edges that straddle the horizontal ray from each point ...
+                straddles = (y1 > py) != (y2 > py)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+                # ... and cross it to the right of the point
+                crossings = np.count_nonzero(straddles & (px < crossing_x), axis=1)
+                inside[chunk_points] = crossings % 2 == 1
+        return inside
+
+    def find_many(self, lats, lons):
+        """
+        Find the borough of each of many points.
+
+        Parameters:
+        - lats, lons (lists or arrays of float), the coordinates of the points
+
+        Returns:
+        - a list of borough names aligned with the points (None for points in no borough)
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        found = np.full(len(lats), -1)
+        for part, (min_lon, min_lat, max_lon, max_lat) in enumerate(self.boxes):
+            # only test points that are in the part's bounding box, and not yet found
+            candidates = np.flatnonzero((found < 0) & (lons >= min_lon) & (lons <= max_lon) &
+                                        (lats >= min_lat) & (lats <= max_lat))
+            if len(candidates):
+                inside = self.contains(part, lons[candidates], lats[candidates])
+                found[candidates[inside]] = self.part_boroughs[part]
+        return [self.names[i] if i >= 0 else None for i in found.tolist()]
+
+    def find(self, lat, lon):
+        """
+        Find the borough that a point is in; returns its name, or None.
+        """
+        # filter the parts by bounding box, then test the candidates exactly
+        parts = np.flatnonzero((self.boxes[:, 0] <= lon) & (lon <= self.boxes[:, 2]) &
+                               (self.boxes[:, 1] <= lat) & (lat <= self.boxes[:, 3]))
+        lons, lats = np.array([lon], dtype=float), np.array([lat], dtype=float)
+        for part in parts.tolist():
+            if self.contains(part, lons, lats)[0]:
+                return self.names[self.part_boroughs[part]]
+        return None
+
+
+def get_borough_index():
+    """
+    Get this process's BoroughIndex, loading the boundaries the first time.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = BoroughIndex(load_source())
+    return _index
+
+
+def normalise_name(name):
+    """
+    Normalise a borough / local authority name for matching, e.g. 'Hammersmith & Fulham'
+    -> 'hammersmith and fulham'.
+    """
+    return re.sub(r"\s+", " ", name.lower().replace("&", "and")).strip()
+
+
+def match_local_authorities(names):
+    """
+    Get the LocalAuthority for each of some borough names, from one query. Names are
+    matched after normalising; failing that, a borough matches a local authority whose
+    name starts with it (e.g. 'Kingston' -> 'Kingston upon Thames').
+
+    Returns:
+    - a dict mapping each name to a LocalAuthority (or None if there's no match)
+    """
+    local_auths = {normalise_name(la.name): la for la in LocalAuthority.objects.all()}
+    matches = {}
+    for name in set(names) - {None}:
+        key = normalise_name(name)
+        match = local_auths.get(key)
+        if match is None:
+            match = next((la for la_name, la in sorted(local_auths.items())
+                          if la_name.startswith(key + " ") or key.startswith(la_name + " ")), None)
+        matches[name] = match
+    return matches
+
+
+def find_borough(lat, lon):
+    """
+    Find the London borough that a point is in.
+
+    Parameters:
+    - lat (float), the latitude of the point, in decimal degrees
+    - lon (float), the longitude of the point, in decimal degrees
+
+    Returns:
+    - a tuple (borough name, LocalAuthority or None), or None if the point isn't in London
+    """
+    name = get_borough_index().find(lat, lon)
+    if name is None:
+        return None
+    return name, match_local_authorities([name])[name]
+
+
+def find_boroughs(lats, lons):
+    """
+    Find the London borough of each of many points, in one vectorised pass.
+
+    Returns:
+    - a list aligned with the points, of (borough name, LocalAuthority or None) tuples, or
+    None for points that aren't in London
+    """
+    names = get_borough_index().find_many(lats, lons)
+    local_auths = match_local_authorities(names)
+    return [None if name is None else (name, local_auths[name]) for name in names]
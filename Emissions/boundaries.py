@@ -0,0 +1,267 @@
+"""
+Simplified, quantised variants of the London borough boundaries, one per map zoom level.
+
+The source boundaries (static/js/londonBoroughs.geojson, ~1MB) are far more detailed than
+a map can show at city-wide zoom levels. For each zoom in settings.AIRQUALITY_BOUNDARY_ZOOMS,
+every ring is simplified with the Douglas-Peucker algorithm, to a tolerance of
+TOLERANCE_PX pixels at that zoom, and coordinates are rounded to the fewest decimal places
+that still resolve a pixel. Each variant is stored as compact JSON plus gzip (and brotli,
+if the brotli package is installed) encodings, named by a hash of its content so it can be
+cached indefinitely.
+
+Variants are built by the build_boundaries management command into
+settings.AIRQUALITY_BOUNDARIES_DIR when the app is built (see bin/post_compile); if they 
+haven't been built, they are built in memory the first time they're needed (which takes a
+few seconds, in each process).
+"""
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the JS wrapper around the GeoJSON in the source file
+SOURCE_PREFIX = "const GEOJSON = "
+# metres per pixel at zoom 0 on the equator, for 256px web-mercator tiles
+METRES_PER_PIXEL_Z0 = 156543.03
+METRES_PER_DEGREE = 111320
+# latitude used for the scale of the map (the centre of London)
+REFERENCE_LATITUDE = 51.5
+# simplification tolerance, in pixels at the variant's zoom level
+TOLERANCE_PX = 0.5
+MANIFEST_FILE = "manifest.json"
+
+logger = logging.getLogger(__name__)
+
+_variants = None
+_variants_lock = threading.Lock()
+
+
+def load_source(path=None):
+    """
+    Load the source boundaries GeoJSON, which is wrapped in a JS variable declaration.
+    """
+    path = path or settings.AIRQUALITY_BOUNDARIES_SOURCE
+    with open(path, "r") as f:
+        text = f.read().strip()
+    if text.startswith(SOURCE_PREFIX):
+        text = text[len(SOURCE_PREFIX):].rstrip(";")
+    return json.loads(text)
+
+
+def tolerance_degrees(zoom):
+    """
+    Get the simplification tolerance for a zoom level, in degrees of latitude.
+    """
+    metres_per_pixel = METRES_PER_PIXEL_Z0 * math.cos(math.radians(REFERENCE_LATITUDE)) / 2 ** zoom
+    return TOLERANCE_PX * metres_per_pixel / METRES_PER_DEGREE
+
+
+def decimal_places(tolerance):
+    """
+    Get the number of decimal places to round coordinates to, for a tolerance in degrees;
+    the rounding error is at most half of the tolerance.
+    """
+    return max(0, math.ceil(-math.log10(tolerance / 2)))
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Simplify a line with the Douglas-Peucker algorithm.
+
+    Parameters:
+    - points (numpy array, n x 2), the (x, y) coordinates of the line
+    - tolerance (float), the max distance of a removed point from the simplified line
+
+    Returns:
+    - a boolean numpy array, True for each point that is kept
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    # (start, end) index pairs still to simplify
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            # closed ring: measure from the start point
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            index = start + 1 + furthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return keep
+
+
+def simplify_ring(ring, tolerance, decimals):
+    """
+    Simplify and quantise a (closed) polygon ring; returns a list of [lon, lat] pairs, or
+    None if the ring collapses to fewer than four points.
+    """
+    coords = np.asarray(ring, dtype=float)
+    # scale longitudes so that distances are (roughly) isotropic
+    points = coords * [math.cos(math.radians(REFERENCE_LATITUDE)), 1]
+    simplified = np.round(coords[douglas_peucker(points, tolerance)], decimals)
+    # rounding can make neighbouring points identical
+    distinct = np.ones(len(simplified), dtype=bool)
+    distinct[1:] = np.any(simplified[1:] != simplified[:-1], axis=1)
+    simplified = simplified[distinct]
+    if len(simplified) < 4:
+        return None
+    return simplified.tolist()
+
+
+def simplify_geometry(geometry, tolerance, decimals):
+    """
+    Simplify and quantise a Polygon or MultiPolygon geometry. Holes and parts that
+    collapse are dropped; if every part collapses, the largest is kept, quantised only.
+    """
+    polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+    simplified = []
+    for polygon in polygons:
+        outer = simplify_ring(polygon[0], tolerance, decimals)
+        if outer is None:
+            continue
+        holes = [simplify_ring(hole, tolerance, decimals) for hole in polygon[1:]]
+        simplified.append([outer] + [hole for hole in holes if hole is not None])
+    if not simplified:
+        largest = max(polygons, key=lambda polygon: len(polygon[0]))
+        simplified = [[np.round(np.asarray(largest[0], dtype=float), decimals).tolist()]]
+    if geometry["type"] == "MultiPolygon":
+        return {"type": "MultiPolygon", "coordinates": simplified}
+    return {"type": "Polygon", "coordinates": simplified[0]}
+
+
+def build_variant(geojson, zoom):
+    """
+    Build the simplified, quantised boundaries for a zoom level. Only the 'name' property
+    of each feature is kept.
+    """
+    tolerance = tolerance_degrees(zoom)
+    decimals = decimal_places(tolerance)
+    return {"type": "FeatureCollection",
+            "features": [{"type": "Feature",
+                          "geometry": simplify_geometry(feature["geometry"], tolerance, decimals),
+                          "properties": {"name": feature["properties"]["name"]}}
+                         for feature in geojson["features"]]}
+
+
+def encode_variant(variant):
+    """
+    Get the encodings of a variant, as a dict with keys 'hash', 'identity', 'gzip' (and
+    'br' if brotli is installed).
+    """
+    content = json.dumps(variant, separators=(",", ":")).encode("utf-8")
+    encodings = {"hash": hashlib.sha256(content).hexdigest()[:16],
+                 "identity": content,
+                 "gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(content)
+    return encodings
+
+
+def variant_filename(zoom, content_hash, encoding):
+    suffix = {"identity": "", "gzip": ".gz", "br": ".br"}[encoding]
+    return f"boroughs-z{zoom}.{content_hash}.json{suffix}"
+
+
+def build_variants(source=None):
+    """
+    Build and encode the boundaries for every zoom in settings.AIRQUALITY_BOUNDARY_ZOOMS.
+
+    Returns:
+    - a dict mapping each zoom to its encodings (see encode_variant)
+    """
+    geojson = load_source(source)
+    return {zoom: encode_variant(build_variant(geojson, zoom))
+            for zoom in settings.AIRQUALITY_BOUNDARY_ZOOMS}
+
+
+def write_variants(variants, out_dir=None):
+    """
+    Write built variants (and a manifest of their hashes) to out_dir (default
+    settings.AIRQUALITY_BOUNDARIES_DIR).
+    """
+    out_dir = out_dir or settings.AIRQUALITY_BOUNDARIES_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {}
+    for zoom, encodings in variants.items():
+        manifest[str(zoom)] = encodings["hash"]
+        for encoding, content in encodings.items():
+            if encoding != "hash":
+                with open(os.path.join(out_dir, variant_filename(zoom, encodings["hash"], encoding)), "wb") as f:
+                    f.write(content)
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_variants(out_dir=None):
+    """
+    Read the variants written by write_variants, or None if they haven't been built (or
+    don't match settings.AIRQUALITY_BOUNDARY_ZOOMS).
+    """
+    out_dir = out_dir or settings.AIRQUALITY_BOUNDARIES_DIR
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+        if sorted(map(int, manifest)) != sorted(settings.AIRQUALITY_BOUNDARY_ZOOMS):
+            return None
+        variants = {}
+        for zoom, content_hash in manifest.items():
+            encodings = {"hash": content_hash}
+            for encoding in ("identity", "gzip", "br"):
+                path = os.path.join(out_dir, variant_filename(zoom, content_hash, encoding))
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        encodings[encoding] = f.read()
+            variants[int(zoom)] = encodings
+        return variants
+    except (OSError, ValueError):
+        return None
+
+
+def get_variants():
+    """
+    Get this process's boundary variants, reading them from disk (or building them) the
+    first time.
+    """
+    global _variants
+    if _variants is None:
+        with _variants_lock:
+            if _variants is None:
+                _variants = read_variants()
+                if _variants is None:
+                    logger.warning("Boundary variants haven't been built; building them now "
+                                   "(run the build_boundaries management command when deploying)")
+                    _variants = build_variants()
+    return _variants
+
+
+def variant_urls():
+    """
+    Get the URL of the boundaries for each zoom level, e.g. for the index page.
+
+    Returns:
+    - a dict of form {"10": "/api/boundaries/10/<hash>.json", ...}
+    """
+    return {str(zoom): f"/api/boundaries/{zoom}/{encodings['hash']}.json"
+            for zoom, encodings in sorted(get_variants().items())}
@@ -0,0 +1,123 @@
+"""
+Circuit breakers for requests to the LondonAir API, one per endpoint (see 
+metrics.api_endpoint), so that e.g. failing requests for one site's readings don't stop
+the hourly snapshot being fetched.
+
+A breaker is closed while its endpoint is healthy. After settings.AIRQUALITY_BREAKER_FAILURES
+consecutive failed requests (connection errors, timeouts or 5xx responses, after all
+retries) it opens, and requests fail immediately with CircuitOpenError rather than
+waiting out timeouts. After settings.AIRQUALITY_BREAKER_RESET seconds it is half-open:
+one request at a time is let through as a probe; if the probe succeeds the breaker closes,
+otherwise it opens again.
+
+The breakers' state is kept in the shared cache, so all processes see the same state.
+"""
+import logging
+import math
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from Emissions.cache import BREAKER_KEY, get_local, set_local
+from Emissions.metrics import api_endpoint
+
+logger = logging.getLogger(__name__)
+
+
+def breaker_keys(url):
+    """
+    Get the cache keys of the state of the breaker for an API URL's endpoint: the count
+    of consecutive failures, the time the breaker opened, and the half-open probe lock.
+    """
+    endpoint = api_endpoint(url)
+    return tuple(BREAKER_KEY.format(endpoint=endpoint, field=field) 
+                 for field in ("failures", "opened", "probe"))
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised instead of making a request while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Shared circuit breakers for the LondonAir API, one per endpoint; each method takes a
+    URL (e.g. '/Data/Site/SiteCode=TDO/.../Json'), and acts on the breaker for its 
+    endpoint. Defaults for each of the parameters are taken from settings.py.
+
+    Parameters:
+    - failure_threshold (int), the number of consecutive failures that open the breaker;
+    0 turns the breaker off
+    - reset_timeout (float), the number of seconds before an open breaker lets a probe
+    request through
+    """
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = (failure_threshold if failure_threshold is not None
+                                  else settings.AIRQUALITY_BREAKER_FAILURES)
+        self.reset_timeout = reset_timeout if reset_timeout is not None else settings.AIRQUALITY_BREAKER_RESET
+
+    def is_open(self, url, local=False):
+        """
+        Whether the breaker is open (or half-open), i.e. the endpoint is considered to be 
+        down. If local, the state is read from the shared cache at most once per 
+        settings.AIRQUALITY_VERSION_CHECK_INTERVAL seconds in this process (see 
+        cache.get_local), e.g. for checks made on every request.
+        """
+        opened_key = breaker_keys(url)[1]
+        opened = get_local(opened_key) if local else cache.get(opened_key)
+        return bool(self.failure_threshold) and opened is not None
+
+    def allow(self, url):
+        """
+        Whether a request may be made now. While the breaker is half-open, only one
+        request (across all processes) is allowed, as a probe.
+        """
+        if not self.failure_threshold:
+            return True
+        failures_key, opened_key, probe_key = breaker_keys(url)
+        opened = cache.get(opened_key)
+        if opened is None:
+            return True
+        if time.time() - opened < self.reset_timeout:
+            return False
+        # the probe "lock" expires, in case the probing process dies
+        return cache.add(probe_key, 1, max(1, math.ceil(self.reset_timeout)))
+
+    def record_success(self, url):
+        """
+        Record a successful request; this closes the breaker.
+        """
+        keys = breaker_keys(url)
+        if self.failure_threshold and any(cache.get_many(keys[:2]).values()):
+            cache.delete_many(keys)
+            set_local(keys[1], None)
+
+    def record_failure(self, url):
+        """
+        Record a failed request; this opens the breaker after failure_threshold
+        consecutive failures, or if the request was a probe.
+        """
+        if not self.failure_threshold:
+            return
+        failures_key, opened_key, probe_key = breaker_keys(url)
+        # add() does nothing if the counter already exists
+        cache.add(failures_key, 0, None)
+        try:
+            failures = cache.incr(failures_key)
+        except ValueError:
+            # the counter was evicted between the add and the incr
+            failures = 1
+            cache.set(failures_key, failures, None)
+        probing = cache.get(opened_key) is not None
+        if failures >= self.failure_threshold or probing:
+            if not probing:
+                logger.warning("%s failed requests to %s on the LondonAir API; pausing its "
+                               "requests for %ss", failures, api_endpoint(url), self.reset_timeout)
+            opened = time.time()
+            cache.set(opened_key, opened, None)
+            set_local(opened_key, opened)
+            cache.delete(probe_key)
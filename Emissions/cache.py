@@ -0,0 +1,364 @@
+"""
+Helpers for caching LondonAir API data in django's cache framework. The cache backends
+are set in settings.CACHES, and are shared between all of the gunicorn workers: 'bulk'
+holds the nowcasts and days of readings, of which there are many, and 'default' the rest.
+"""
+import datetime as dt
+import hashlib
+import math
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.utils.connection import ConnectionProxy
+
+from Emissions import metrics
+
+bulk_cache = ConnectionProxy(caches, "bulk")
+
+SNAPSHOT_KEY = "emissions:snapshot:{group_name}"
+# hash of the last /Data/Site payload ingested for a site
+READINGS_HASH_KEY = "emissions:readings-hash:{site_code}"
+# upstream nowcast for a grid cell, during one hourly publish period
+NOWCAST_KEY = "emissions:nowcast:{period}:{row}:{col}"
+# hit / miss counters of the nowcast cache
+NOWCAST_STATS_KEY = "emissions:nowcast-cache:{stat}"
+# a site's hourly readings on one day, pivoted per species, for a version of the Readings
+SITE_DAY_KEY = "emissions:site-day:{version}:{site_code}:{day}"
+# lock held by the process that is fetching an API URL, and the result it fetched
+FETCH_LOCK_KEY = "emissions:fetch-lock:{url}"
+FETCH_RESULT_KEY = "emissions:fetch-result:{url}"
+# state of the circuit breaker for an endpoint of the LondonAir API (see Emissions/breaker.py)
+BREAKER_KEY = "emissions:breaker:{endpoint}:{field}"
+# metres per degree of latitude
+METRES_PER_DEGREE = 111320
+# token that changes whenever a table of reference data (e.g. Site) changes
+DATA_VERSION_KEY = "emissions:data-version:{table}"
+# time that a table's version token last changed
+DATA_MODIFIED_KEY = "emissions:data-modified:{table}"
+
+# version tokens as this process last read them: table -> (token, time.monotonic() read at)
+_local_versions = {}
+# other values as this process last read them (see get_local): key -> (value, time read at)
+_local_values = {}
+
+
+def seconds_until_next_publish(now=None):
+    """
+    Get the number of seconds until the LondonAir API next publishes its hourly data.
+
+    Parameters:
+    - now (python datetime object), the time to count from. Optional; default is the
+    current UTC time.
+
+    Returns:
+    - int, the seconds until settings.AIRQUALITY_PUBLISH_OFFSET seconds past the next hour
+    """
+    if now is None:
+        now = dt.datetime.now(dt.timezone.utc)
+    publish = (now.replace(minute=0, second=0, microsecond=0) +
+               dt.timedelta(seconds=settings.AIRQUALITY_PUBLISH_OFFSET))
+    if publish <= now:
+        publish += dt.timedelta(hours=1)
+    return int((publish - now).total_seconds())
+
+
+def snapshot_ttl(now=None):
+    """
+    Get the time-to-live for a snapshot of hourly data; this lasts until the next
+    publish time, up to a maximum of settings.AIRQUALITY_SNAPSHOT_TTL seconds.
+    """
+    return max(1, min(settings.AIRQUALITY_SNAPSHOT_TTL, seconds_until_next_publish(now)))
+
+
+def publish_period(now=None):
+    """
+    Get the start of the hourly publish period that now is in (i.e. when the data that is
+    currently available was published), as a string of form YYYYMMDDHH.
+    """
+    if now is None:
+        now = dt.datetime.now(dt.timezone.utc)
+    start = now - dt.timedelta(seconds=settings.AIRQUALITY_PUBLISH_OFFSET)
+    return start.strftime("%Y%m%d%H")
+
+
+def get_snapshot(group_name):
+    """
+    Get the cached hourly snapshot for a group, or None if there isn't one.
+    """
+    data = cache.get(SNAPSHOT_KEY.format(group_name=group_name))
+    metrics.record_cache_lookup("snapshot", data is not None)
+    return data
+
+
+def set_snapshot(group_name, data):
+    """
+    Cache the hourly snapshot for a group, until the next publish time.
+    """
+    cache.set(SNAPSHOT_KEY.format(group_name=group_name), data, snapshot_ttl())
+
+
+def get_readings_hash(site_code):
+    """
+    Get the hash of the last hourly readings payload ingested for a site, or None.
+    """
+    return cache.get(READINGS_HASH_KEY.format(site_code=site_code))
+
+
+def set_readings_hash(site_code, payload_hash):
+    """
+    Record the hash of the hourly readings payload ingested for a site. This is kept 
+    for a day; after that the payload is re-ingested (which is harmless).
+    """
+    cache.set(READINGS_HASH_KEY.format(site_code=site_code), payload_hash, 24 * 60 * 60)
+
+
+def fetch_key(template, url):
+    # hash the URL, as some cache backends (e.g. memcached) limit the characters in keys
+    return template.format(url=hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+
+def acquire_fetch_lock(url):
+    """
+    Try to take the (cross-process) lock on fetching an API URL. The lock expires after
+    settings.AIRQUALITY_FETCH_LOCK_TIMEOUT seconds, in case its holder dies.
+
+    Returns:
+    - a token to release the lock with, or None if another process holds it
+    """
+    token = uuid.uuid4().hex
+    timeout = max(1, math.ceil(settings.AIRQUALITY_FETCH_LOCK_TIMEOUT))
+    return token if cache.add(fetch_key(FETCH_LOCK_KEY, url), token, timeout) else None
+
+
+def release_fetch_lock(url, token):
+    """
+    Release a lock taken by acquire_fetch_lock, unless it has expired (and been taken by
+    another process) in the meantime.
+    """
+    key = fetch_key(FETCH_LOCK_KEY, url)
+    # NOTE: not atomic, but the window is tiny, and the worst case is one extra fetch
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+def get_fetch_result(url):
+    """
+    Get the data that another process has just fetched from an API URL, or None.
+    """
+    return cache.get(fetch_key(FETCH_RESULT_KEY, url))
+
+
+def set_fetch_result(url, data):
+    """
+    Share the data fetched from an API URL with processes waiting on the lock, for
+    settings.AIRQUALITY_FETCH_RESULT_TTL seconds.
+    """
+    cache.set(fetch_key(FETCH_RESULT_KEY, url), data, settings.AIRQUALITY_FETCH_RESULT_TTL)
+
+
+def get_site_day(site_code, day, version):
+    """
+    Get the cached readings of a site on a day (see store.get_site_day_readings), for a
+    version of the Reading table, or None.
+    """
+    data = bulk_cache.get(SITE_DAY_KEY.format(version=version, site_code=site_code, day=day.isoformat()))
+    metrics.record_cache_lookup("site_day", data is not None)
+    return data
+
+
+def set_site_day(site_code, day, version, data):
+    """
+    Cache the readings of a site on a day. Today's readings are cached until the next 
+    publish time; earlier days' for a day, as late readings may still arrive.
+    """
+    today = dt.datetime.now(dt.timezone.utc).date()
+    timeout = snapshot_ttl() if day >= today else 24 * 60 * 60
+    bulk_cache.set(SITE_DAY_KEY.format(version=version, site_code=site_code, day=day.isoformat()), 
+              data, timeout)
+
+
+def get_data_version(table):
+    """
+    Get the current version token of a table of reference data, e.g. 'Site'. The token
+    changes whenever the table does, so it can be used to tell when anything derived 
+    from the table (such as the spatial index of sites) needs rebuilding.
+    """
+    key = DATA_VERSION_KEY.format(table=table)
+    version = cache.get(key)
+    if version is None:
+        # add() rather than set(), in case another process has just done the same
+        version = uuid.uuid4().hex
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def get_data_versions(tables):
+    """
+    Get the current version tokens of several tables, in one round trip to the cache
+    (unless a token has to be created).
+
+    Returns:
+    - a dict mapping each table to its version token
+    """
+    keys = {table: DATA_VERSION_KEY.format(table=table) for table in tables}
+    found = cache.get_many(keys.values())
+    return {table: found[key] if key in found else get_data_version(table) for table, key in keys.items()}
+
+
+def get_local_data_versions(tables):
+    """
+    As get_data_versions, but a token is only re-read from the shared cache once this 
+    process has held it for settings.AIRQUALITY_VERSION_CHECK_INTERVAL seconds. This is 
+    for the per-process caches that are checked on every request (e.g. the spatial index
+    of sites); a change made by another process reaches them within the interval.
+    """
+    now = time.monotonic()
+    versions, expired = {}, []
+    for table in tables:
+        entry = _local_versions.get(table)
+        if entry is None or now - entry[1] >= settings.AIRQUALITY_VERSION_CHECK_INTERVAL:
+            expired.append(table)
+        else:
+            versions[table] = entry[0]
+    if expired:
+        found = get_data_versions(expired)
+        _local_versions.update((table, (version, now)) for table, version in found.items())
+        versions.update(found)
+    return versions
+
+
+def get_local_data_version(table):
+    """
+    Get a table's version token, as get_local_data_versions.
+    """
+    return get_local_data_versions([table])[table]
+
+
+def clear_local_data_versions():
+    """
+    Forget the version tokens (and other values, see get_local) held by this process, so
+    they are re-read from the shared cache (e.g. after it has been cleared).
+    """
+    _local_versions.clear()
+    _local_values.clear()
+
+
+def get_local(key):
+    """
+    Get a value from the shared cache, as get_local_data_versions: it's only re-read once
+    this process has held it for settings.AIRQUALITY_VERSION_CHECK_INTERVAL seconds. This
+    is for small values that are checked on every request (e.g. whether a circuit 
+    breaker is open); None if the key isn't set.
+    """
+    now = time.monotonic()
+    entry = _local_values.get(key)
+    if entry is None or now - entry[1] >= settings.AIRQUALITY_VERSION_CHECK_INTERVAL:
+        entry = _local_values[key] = (cache.get(key), now)
+    return entry[0]
+
+
+def set_local(key, value):
+    """
+    Record a value that this process has just set in (or, for None, deleted from) the 
+    shared cache, so that get_local sees the change at once.
+    """
+    _local_values[key] = (value, time.monotonic())
+
+
+def bump_data_version(table):
+    """
+    Record that a table of reference data has changed, by giving it a new version token.
+    """
+    version = uuid.uuid4().hex
+    # HTTP dates have a resolution of one second
+    modified = dt.datetime.now(dt.timezone.utc).replace(microsecond=0)
+    cache.set_many({DATA_VERSION_KEY.format(table=table): version,
+                    DATA_MODIFIED_KEY.format(table=table): modified}, None)
+    # this process sees its own changes straight away
+    _local_versions[table] = (version, time.monotonic())
+
+
+def get_data_modified(table):
+    """
+    Get the (UTC) time that a table's version token last changed, or None if it isn't
+    known (e.g. the token hasn't changed since the cache was cleared).
+    """
+    return cache.get(DATA_MODIFIED_KEY.format(table=table))
+
+
+def nowcast_cell(lat, lon):
+    """
+    Get the (row, column) of the settings.AIRQUALITY_NOWCAST_CACHE_CELL_M square grid cell
+    that a point is in. Rows are a fixed number of degrees of latitude; columns are 
+    narrowed (in degrees) by the cosine of the row's latitude, so cells stay square.
+    """
+    lat_step = settings.AIRQUALITY_NOWCAST_CACHE_CELL_M / METRES_PER_DEGREE
+    row = math.floor(lat / lat_step)
+    return row, math.floor(lon / nowcast_cell_width(row, lat_step))
+
+
+def nowcast_cell_width(row, lat_step):
+    """
+    Get the width (in degrees of longitude) of the nowcast grid cells in a row.
+    """
+    return lat_step / max(math.cos(math.radians((row + 0.5) * lat_step)), 1e-6)
+
+
+def nowcast_cell_centre(lat, lon):
+    """
+    Get the (latitude, longitude) of the centre of the nowcast grid cell that a point is
+    in (see nowcast_cell), rounded to 6 decimal places (about 10cm).
+    """
+    lat_step = settings.AIRQUALITY_NOWCAST_CACHE_CELL_M / METRES_PER_DEGREE
+    row, col = nowcast_cell(lat, lon)
+    return (round((row + 0.5) * lat_step, 6), 
+            round((col + 0.5) * nowcast_cell_width(row, lat_step), 6))
+
+
+def get_nowcast(lat, lon):
+    """
+    Get the cached upstream nowcast for the grid cell that a point is in (during the 
+    current publish period), or None; and count the cache hit or miss.
+    """
+    row, col = nowcast_cell(lat, lon)
+    data = bulk_cache.get(NOWCAST_KEY.format(period=publish_period(), row=row, col=col))
+    count_nowcast_lookup("misses" if data is None else "hits")
+    metrics.record_cache_lookup("nowcast", data is not None)
+    return data
+
+
+def set_nowcast(lat, lon, data):
+    """
+    Cache an upstream nowcast for the grid cell that a point is in, until the next
+    publish time; other points in the same cell will share it.
+    """
+    row, col = nowcast_cell(lat, lon)
+    bulk_cache.set(NOWCAST_KEY.format(period=publish_period(), row=row, col=col), data, snapshot_ttl())
+
+
+def count_nowcast_lookup(stat):
+    """
+    Add one to the nowcast cache's 'hits' or 'misses' counter.
+    """
+    key = NOWCAST_STATS_KEY.format(stat=stat)
+    # add() does nothing if the counter already exists
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the counter was evicted between the add and the incr
+        cache.set(key, 1, None)
+
+
+def get_nowcast_cache_stats():
+    """
+    Get the nowcast cache's hit and miss counts (shared by all processes), as a dict with
+    keys 'hits', 'misses' and 'hit_ratio' (None if there have been no lookups).
+    """
+    hits = cache.get(NOWCAST_STATS_KEY.format(stat="hits"), 0)
+    misses = cache.get(NOWCAST_STATS_KEY.format(stat="misses"), 0)
+    lookups = hits + misses
+    return {"hits": hits, "misses": misses, "hit_ratio": hits / lookups if lookups else None}
@@ -0,0 +1,164 @@
+"""
+Shared HTTP client for the LondonAir API.
+
+All requests go through a single requests.Session per process, so TCP connections
+are pooled and kept alive between calls. Every request has connect and read timeouts,
+and failed requests (connection errors, timeouts and 5xx responses) are retried a
+bounded number of times with jittered exponential backoff. Requests that still fail are
+counted by a circuit breaker per endpoint (see Emissions/breaker.py), which stops requests
+to that endpoint for a while if it is down. Each request is recorded in the metrics (see 
+Emissions/metrics.py). Settings are in settings.py, under AIRQUALITY_*.
+"""
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from Emissions import metrics
+from Emissions.breaker import CircuitBreaker, CircuitOpenError
+
+# response codes that are worth retrying; anything else is returned to the caller
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+
+def proxy_dict(proxy):
+    """
+    Convert a proxy server URL (e.g. 'http://10.160.27.36:3128') to the dict format
+    used by requests, or None if no proxy is given.
+    """
+    if not proxy:
+        return None
+    return {"http": proxy, "https": proxy}
+
+
+def response_size(response, stream=False):
+    """
+    Get the size in bytes of a response's body, or None if it isn't known (e.g. a 
+    streamed response without a Content-Length header).
+    """
+    if not stream:
+        return len(response.content)
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+class ApiClient:
+    """
+    Pooled, keep-alive client for the LondonAir API, with timeouts and retries.
+    Defaults for each of the parameters are taken from settings.py, apart from breaker
+    (a CircuitBreaker), which defaults to None, i.e. no circuit breaker.
+    """
+
+    def __init__(self, base_url=None, proxy=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff=None, pool_size=None, breaker=None):
+        self.base_url = base_url if base_url is not None else settings.AIRQUALITY_API_URL
+        self.timeout = (connect_timeout if connect_timeout is not None else settings.AIRQUALITY_CONNECT_TIMEOUT,
+                        read_timeout if read_timeout is not None else settings.AIRQUALITY_READ_TIMEOUT)
+        self.max_retries = max_retries if max_retries is not None else settings.AIRQUALITY_MAX_RETRIES
+        self.backoff = backoff if backoff is not None else settings.AIRQUALITY_RETRY_BACKOFF
+        pool_size = pool_size if pool_size is not None else settings.AIRQUALITY_POOL_SIZE
+        self.breaker = breaker
+
+        self.session = requests.Session()
+        # retries are handled in get(), so that they can be jittered
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        proxies = proxy_dict(proxy if proxy is not None else settings.AIRQUALITY_PROXY)
+        if proxies is not None:
+            self.session.proxies.update(proxies)
+
+    def backoff_delay(self, attempt):
+        """
+        Time to wait before retry number attempt (counting from 0). Uses 'full jitter',
+        i.e. a random time between 0 and backoff * 2^attempt seconds.
+        """
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def get(self, url, proxy=None, stream=False):
+        """
+        GET a URL from the API, retrying on connection errors, timeouts and 5xx responses.
+
+        Parameters:
+        - url (str), the API endpoint, relative to base_url (e.g. '/Information/Species/Json')
+        - proxy (str), URL of a proxy server to use for this request. Optional, default
+        None (i.e. use the client's proxy, if it has one)
+        - stream (bool), whether to defer downloading the response body. Optional,
+        default False
+
+        Returns:
+        - a requests.Response object; this may have a non-200 status code
+
+        Raises:
+        - requests.exceptions.RequestException if no response is received after all 
+        retries, or CircuitOpenError (a subclass) if the circuit breaker is open
+        """
+        if self.breaker is not None and not self.breaker.allow(url):
+            metrics.record_upstream(url, "CircuitOpenError", None)
+            raise CircuitOpenError(f"Circuit breaker open; not requesting {url}")
+        for attempt in range(self.max_retries + 1):
+            elapsed = metrics.timer()
+            try:
+                response = self.session.get(self.base_url + url, proxies=proxy_dict(proxy),
+                                            timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                metrics.record_upstream(url, type(error).__name__, elapsed())
+                if attempt == self.max_retries:
+                    self.record_outcome(url, False)
+                    raise
+            else:
+                metrics.record_upstream(url, response.status_code, elapsed(), 
+                                        response_size(response, stream))
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    self.record_outcome(url, response.status_code not in RETRY_STATUS_CODES)
+                    return response
+                response.close()
+            metrics.record_retry(url)
+            time.sleep(self.backoff_delay(attempt))
+
+    def record_outcome(self, url, success):
+        """
+        Tell the circuit breaker (if there is one) whether a request to url succeeded.
+        """
+        if self.breaker is None:
+            return
+        if success:
+            self.breaker.record_success(url)
+        else:
+            self.breaker.record_failure(url)
+
+    def get_json(self, url, proxy=None):
+        """
+        GET a URL from the API and parse the response body as JSON.
+
+        Returns:
+        - the JSON data, or None if the API didn't return a 200 response
+
+        Raises:
+        - requests.exceptions.RequestException if no response is received after all retries
+        """
+        response = self.get(url, proxy)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Get the shared ApiClient for this process, creating it on first use (i.e. after
+    gunicorn has forked the worker).
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ApiClient(breaker=CircuitBreaker())
+    return _client
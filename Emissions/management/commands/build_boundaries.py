@@ -0,0 +1,25 @@
+"""
+Build the simplified, quantised variants of the borough boundaries served by 
+/api/boundaries (see Emissions/boundaries.py), e.g. as part of a deployment (see 
+bin/post_compile):
+    $> python manage.py build_boundaries
+"""
+from django.core.management.base import BaseCommand
+
+from Emissions import boundaries
+
+
+class Command(BaseCommand):
+    help = ("Simplify the borough boundaries for each map zoom level, and write them "
+            "(with gzip / brotli encodings) to settings.AIRQUALITY_BOUNDARIES_DIR.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out-dir", default=None,
+                            help="Directory to write to (default settings.AIRQUALITY_BOUNDARIES_DIR)")
+
+    def handle(self, *args, **options):
+        variants = boundaries.build_variants()
+        boundaries.write_variants(variants, options["out_dir"])
+        for zoom, encodings in sorted(variants.items()):
+            self.stdout.write(f"zoom {zoom}: {len(encodings['identity'])} bytes, "
+                              f"{len(encodings['gzip'])} gzipped ({encodings['hash']})")
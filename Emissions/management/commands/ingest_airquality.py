@@ -0,0 +1,78 @@
+"""
+Long-running worker that copies data from the LondonAir API into the local store, so
+that web requests never need to call the API. Run it as a separate process, e.g. the
+'worker' entry in the Procfile:
+    $> python manage.py ingest_airquality
+or run a single ingestion (e.g. from a scheduler) with:
+    $> python manage.py ingest_airquality --once
+To recalculate all of the per-borough / London-wide aggregates from the stored readings:
+    $> python manage.py ingest_airquality --rebuild-aggregates
+"""
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from Emissions import cache, store
+from Emissions.services import AirQualityApiData
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Poll the LondonAir API for the hourly group index and per-site readings, "
+            "and store them in the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--group", default="London",
+                            help="Name of the group of sites to ingest (default London)")
+        parser.add_argument("--once", action="store_true",
+                            help="Run a single ingestion and exit, rather than polling")
+        parser.add_argument("--rebuild-aggregates", action="store_true",
+                            help="Recalculate all reading aggregates from the stored readings, and exit")
+
+    def handle(self, *args, **options):
+        if options["rebuild_aggregates"]:
+            self.stdout.write(f"Stored {store.rebuild_aggregates()} reading aggregates")
+            return
+        api = AirQualityApiData()
+        while True:
+            try:
+                self.ingest(api, options["group"])
+            except Exception as error:
+                if options["once"]:
+                    raise CommandError(f"Ingestion failed: {error}") from error
+                # e.g. a database or parse error; the worker carries on, and tries again 
+                # at the next publish time
+                logger.exception("Ingestion failed")
+                # the connection may be broken, so the next ingestion gets a new one
+                connections.close_all()
+            if options["once"]:
+                break
+            # wait until the API next publishes its hourly data
+            wait = cache.seconds_until_next_publish()
+            self.stdout.write(f"Next ingestion in {wait} seconds")
+            time.sleep(wait)
+
+    def ingest(self, api, group_name):
+        """
+        Store a new snapshot of the group index (if it has changed) and any new
+        readings for each active site.
+        """
+        snapshot = store.ingest_snapshot(group_name, api=api)
+        if snapshot is None:
+            self.stdout.write(f"{group_name} snapshot unchanged (or API unavailable)")
+        else:
+            self.stdout.write(f"Stored {group_name} snapshot at {snapshot.fetched_at}")
+        # as the web app will show them (see store.get_current_emissions_with_status)
+        if store.current_emissions_are_stale(group_name):
+            logger.warning("The current %s emissions are stale; the latest snapshot was fetched at %s",
+                           group_name, store.get_latest_snapshot_time(group_name))
+
+        stored = store.ingest_readings(api=api)
+        failed = [code for code, count in stored.items() if count is None]
+        self.stdout.write(f"Stored {sum(count or 0 for count in stored.values())} readings "
+                          f"for {len(stored) - len(failed)} sites")
+        if failed:
+            self.stderr.write(f"No response from the API for sites: {', '.join(failed)}")
@@ -0,0 +1,140 @@
+"""
+Metrics for the app's hot paths, exposed in the Prometheus text format at /metrics (see
+views.metrics) and as structured (JSON) log lines:
+- requests to the LondonAir API: latency, status codes, response sizes and retries, per
+  endpoint (the URL without its parameters, e.g. /Data/Site/Json)
+- cache hits and misses, per cache (e.g. the hourly snapshot, the index page)
+- parse times of API responses
+- view times, per URL route and status code (see Emissions/middleware.py)
+
+Each process keeps its own metrics. To aggregate the metrics of all of a server's
+workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory before they start (see
+Procfile); the metrics of other processes (e.g. the ingest worker) are in their logs.
+"""
+import json
+import logging
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_SECONDS = Histogram(
+    "airquality_upstream_request_seconds",
+    "Time taken by each request to the LondonAir API (to the response headers, if streamed)",
+    ["endpoint"], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+UPSTREAM_RESPONSES = Counter(
+    "airquality_upstream_responses_total",
+    "Responses from the LondonAir API, by status code (or error, e.g. ConnectionError)",
+    ["endpoint", "status"])
+UPSTREAM_BYTES = Counter(
+    "airquality_upstream_response_bytes_total",
+    "Size of the response bodies from the LondonAir API, where known", ["endpoint"])
+UPSTREAM_RETRIES = Counter(
+    "airquality_upstream_retries_total", "Retried requests to the LondonAir API", ["endpoint"])
+CACHE_LOOKUPS = Counter(
+    "airquality_cache_lookups_total", "Cache lookups, by cache and result (hit or miss)",
+    ["cache", "result"])
+PARSE_SECONDS = Histogram(
+    "airquality_parse_seconds", "Time taken to parse responses from the LondonAir API",
+    ["parser"], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+VIEW_SECONDS = Histogram(
+    "airquality_view_seconds", "Time taken to serve each request, by URL route and status code",
+    ["route", "method", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as JSON objects, one per line, including the fields of the
+    record's metrics (if it has any, e.g. logger.info("...", extra={"metrics": {...}})).
+    """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname,
+                 "logger": record.name, "message": record.getMessage()}
+        entry.update(getattr(record, "metrics", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def api_endpoint(url):
+    """
+    Get the endpoint of an API URL, without its parameters (so that the metrics have a
+    label per endpoint, rather than per site or date), e.g.
+    '/Data/Site/SiteCode=TDO/StartDate=01Jan2019/EndDate=02Jan2019/Json' -> '/Data/Site/Json'
+    """
+    return "/".join(part for part in url.split("/") if "=" not in part)
+
+
+def record_upstream(url, status, seconds, size=None):
+    """
+    Record a request to the LondonAir API.
+
+    Parameters:
+    - url (str), the API endpoint that was requested, e.g. '/Information/Species/Json'
+    - status (int or str), the response's status code, or the name of the error if
+    there was no response (e.g. 'ConnectionError', 'CircuitOpenError')
+    - seconds (float), the time the request took; None if no request was made
+    - size (int), the size of the response body in bytes, if known
+    """
+    endpoint = api_endpoint(url)
+    UPSTREAM_RESPONSES.labels(endpoint, str(status)).inc()
+    if seconds is not None:
+        UPSTREAM_SECONDS.labels(endpoint).observe(seconds)
+    if size is not None:
+        UPSTREAM_BYTES.labels(endpoint).inc(size)
+    logger.info("upstream request", extra={"metrics": {
+        "endpoint": endpoint, "url": url, "status": status,
+        "duration_ms": round(seconds * 1000, 1) if seconds is not None else None, "bytes": size}})
+
+
+def record_retry(url):
+    """
+    Record that a request to the LondonAir API is being retried.
+    """
+    UPSTREAM_RETRIES.labels(api_endpoint(url)).inc()
+
+
+def record_cache_lookup(cache_name, hit):
+    """
+    Record a lookup in a cache (e.g. 'snapshot'), and whether it was a hit.
+    """
+    CACHE_LOOKUPS.labels(cache_name, "hit" if hit else "miss").inc()
+
+
+def record_view(route, method, status, seconds):
+    """
+    Record a request to the app, by its URL route (e.g. 'api/sites/<str:site_code>/readings').
+    """
+    VIEW_SECONDS.labels(route, method, str(status)).observe(seconds)
+    logger.info("request", extra={"metrics": {
+        "route": route, "method": method, "status": status,
+        "duration_ms": round(seconds * 1000, 1)}})
+
+
+def timer():
+    """
+    Start timing something; returns a function that gets the seconds elapsed since.
+    """
+    start = time.perf_counter()
+    return lambda: time.perf_counter() - start
+
+
+def render():
+    """
+    Get the metrics in the Prometheus text format, aggregated across processes if
+    PROMETHEUS_MULTIPROC_DIR is set.
+
+    Returns:
+    - a tuple (metrics as bytes, content type)
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,38 @@
+"""
+Middleware that records the time taken to serve each request in the metrics (see
+Emissions/metrics.py), by URL route (e.g. 'api/sites/<str:site_code>/readings') and
+status code. It supports both sync and async requests, so under ASGI Django doesn't have
+to adapt it to (i.e. run it in a thread); though that only keeps async views off threads
+if every other middleware supports async requests too (see Emissions/staticfiles.py).
+"""
+import asyncio
+
+from django.utils.decorators import sync_and_async_middleware
+
+from Emissions import metrics
+
+
+def route_of(request):
+    """
+    Get the URL route that a request matched, or 'unmatched' (e.g. for a 404, or a
+    static file).
+    """
+    match = getattr(request, "resolver_match", None)
+    return match.route if match is not None else "unmatched"
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            elapsed = metrics.timer()
+            response = await get_response(request)
+            metrics.record_view(route_of(request), request.method, response.status_code, elapsed())
+            return response
+    else:
+        def middleware(request):
+            elapsed = metrics.timer()
+            response = get_response(request)
+            metrics.record_view(route_of(request), request.method, response.status_code, elapsed())
+            return response
+    return middleware
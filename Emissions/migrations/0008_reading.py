@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Emissions', '0007_auto_20190505_1741'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingHighWaterMark',
+            fields=[
+                ('site', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='Emissions.site')),
+                ('timestamp', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Reading',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField()),
+                ('value', models.FloatField()),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='Emissions.site')),
+                ('species', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='Emissions.species')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['site', 'timestamp'], name='Emissions_r_site_id_42545e_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='reading',
+            constraint=models.UniqueConstraint(fields=('site', 'species', 'timestamp'), name='unique_site_species_timestamp'),
+        ),
+    ]
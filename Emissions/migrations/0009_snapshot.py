@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Emissions', '0008_reading'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_name', models.CharField(default='London', max_length=50)),
+                ('fetched_at', models.DateTimeField()),
+                ('payload_hash', models.CharField(max_length=64)),
+                ('data', models.JSONField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group_name', '-fetched_at'], name='Emissions_s_group_n_684a7c_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:43
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, Min, OuterRef
+
+# for each reference table, its unique key, and the foreign keys to it: (model, field,
+# the other fields that the foreign key is unique together with, or None)
+REFERENCES = {
+    'LocalAuthority': ('name', [('Site', 'local_auth', None)]),
+    'Site': ('code', [('Reading', 'site', ('species', 'timestamp')),
+                      ('ReadingHighWaterMark', 'site', ())]),
+    'Species': ('code', [('Reading', 'species', ('site', 'timestamp'))]),
+    'HealthAdvice': ('quality_band', []),
+}
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Merge rows of the reference tables that share a key into the one with the lowest pk, 
+    so that the key can be made unique. References to the other rows are repointed to 
+    it, apart from any that would then clash with one of its own (e.g. a Reading for the 
+    same species and time), which are deleted.
+    """
+    for model_name, (key, references) in REFERENCES.items():
+        model = apps.get_model('Emissions', model_name)
+        duplicated = (model.objects.values(key).order_by()
+                      .annotate(count=Count('pk'), keep=Min('pk')).filter(count__gt=1))
+        for group in duplicated:
+            others = model.objects.filter(**{key: group[key]}).exclude(pk=group['keep'])
+            for other in others.order_by('pk'):
+                for ref_model_name, field, unique_with in references:
+                    ref_model = apps.get_model('Emissions', ref_model_name)
+                    refs = ref_model.objects.filter(**{field: other.pk})
+                    if unique_with is not None:
+                        clashes = ref_model.objects.filter(**{field: group['keep']}, 
+                                                           **{f: OuterRef(f) for f in unique_with})
+                        refs.filter(Exists(clashes)).delete()
+                    refs.update(**{field: group['keep']})
+            others.delete()
+
+
+class Migration(migrations.Migration):
+    # the merge is committed before the tables are altered; PostgreSQL won't alter a 
+    # table with foreign key checks still pending in the same transaction
+    atomic = False
+
+    dependencies = [
+        ('Emissions', '0009_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop, atomic=True),
+        migrations.AlterField(
+            model_name='healthadvice',
+            name='quality_band',
+            field=models.TextField(default='', max_length=9, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='localauthority',
+            name='name',
+            field=models.TextField(default='', unique=True),
+        ),
+        migrations.AlterField(
+            model_name='site',
+            name='code',
+            field=models.CharField(default='', max_length=3, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='species',
+            name='code',
+            field=models.CharField(default='', max_length=4, unique=True),
+        ),
+    ]
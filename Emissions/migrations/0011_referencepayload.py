@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Emissions', '0010_unique_reference_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferencePayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=50, unique=True)),
+                ('payload_hash', models.CharField(max_length=64)),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Emissions', '0011_referencepayload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingAggregate',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('mean', models.FloatField()),
+                ('max', models.FloatField()),
+                ('count', models.IntegerField()),
+                ('local_auth', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='Emissions.localauthority')),
+                ('species', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='Emissions.species')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['local_auth', 'species', 'period', 'period_start'], name='Emissions_r_local_a_84abae_idx'), models.Index(fields=['period', 'period_start'], name='Emissions_r_period_ceca38_idx')],
+            },
+        ),
+    ]
@@ -6,7 +6,7 @@ class Species(models.Model):
     of those provided in the LondonAir API.
     """
     name = models.TextField(default='')
-    code = models.CharField(max_length=4, default='')
+    code = models.CharField(max_length=4, default='', unique=True)
     description = models.TextField(default='')
     health_effect = models.TextField(default='')
     link = models.URLField(default='')
@@ -24,7 +24,7 @@ class LocalAuthority(models.Model):
     contains lat/lon properties; these represent the *centre* of the LA, 
     rather than the whole area.
     """
-    name = models.TextField(default='')
+    name = models.TextField(default='', unique=True)
     code = models.IntegerField()
     latitude = models.FloatField()
     longitude = models.FloatField()
@@ -41,7 +41,7 @@ class Site(models.Model):
     by the LondonAir API, with unecessary fields chopped out.
     """
     name = models.TextField(default='')
-    code = models.CharField(max_length=3, default='')
+    code = models.CharField(max_length=3, default='', unique=True)
     site_type = models.TextField(default='')
     local_auth = models.ForeignKey(LocalAuthority, on_delete=models.CASCADE)
     link = models.URLField(default='')
@@ -74,8 +74,102 @@ class Site(models.Model):
         return f"{self.name} ({self.code}), {self.local_auth}"
 
 
+class Reading(models.Model):
+    """
+    A Reading is a single hourly measurement of a Species at a Site, as provided by 
+    the LondonAir API (/Data/Site). Readings are added by Emissions/store.py.
+    """
+    id = models.BigAutoField(primary_key=True)
+    site = models.ForeignKey(Site, on_delete=models.CASCADE)
+    species = models.ForeignKey(Species, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField()
+    value = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['site', 'species', 'timestamp'], 
+                                    name='unique_site_species_timestamp'),
+        ]
+        indexes = [models.Index(fields=['site', 'timestamp'])]
+
+    def __str__(self):
+        return f"{self.site.code} {self.species.code} {self.timestamp}: {self.value}"
+
+
+class ReadingAggregate(models.Model):
+    """
+    The mean, max and count of the Readings of a Species in a LocalAuthority (or across
+    all of London, if local_auth is null) over an hour or a day. Aggregates are 
+    recalculated by Emissions/store.py whenever new readings for their period are ingested.
+    """
+    HOUR = 'hour'
+    DAY = 'day'
+    PERIOD_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+
+    id = models.BigAutoField(primary_key=True)
+    local_auth = models.ForeignKey(LocalAuthority, on_delete=models.CASCADE, null=True, blank=True)
+    species = models.ForeignKey(Species, on_delete=models.CASCADE)
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    period_start = models.DateTimeField()
+    mean = models.FloatField()
+    max = models.FloatField()
+    count = models.IntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['local_auth', 'species', 'period', 'period_start']),
+                   models.Index(fields=['period', 'period_start'])]
+
+    def __str__(self):
+        area = self.local_auth.name if self.local_auth_id else 'London'
+        return f"{area} {self.species.code} {self.period} {self.period_start}: {self.mean}"
+
+
+class ReadingHighWaterMark(models.Model):
+    """
+    The timestamp of the latest Reading stored for a Site, so that each ingestion run 
+    only needs to get newer readings from the LondonAir API.
+    """
+    site = models.OneToOneField(Site, on_delete=models.CASCADE, primary_key=True)
+    timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.site.code}: {self.timestamp}"
+
+
+class Snapshot(models.Model):
+    """
+    A Snapshot is the hourly MonitoringIndex for a group of sites (e.g. London), as 
+    processed by AirQualityApiData.process_group_emissions. Snapshots are added by the 
+    ingest_airquality management command, and are only stored when the API data changes.
+    """
+    group_name = models.CharField(max_length=50, default='London')
+    fetched_at = models.DateTimeField()
+    payload_hash = models.CharField(max_length=64)
+    data = models.JSONField()
+
+    class Meta:
+        indexes = [models.Index(fields=['group_name', '-fetched_at'])]
+
+    def __str__(self):
+        return f"{self.group_name}, {self.fetched_at}"
+
+
+class ReferencePayload(models.Model):
+    """
+    The hash of the LondonAir API payload that a reference table (e.g. Site) was last
+    refreshed from, so that populate_airquality.py --refresh can skip tables whose
+    payload hasn't changed.
+    """
+    table = models.CharField(max_length=50, unique=True)
+    payload_hash = models.CharField(max_length=64)
+    refreshed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.table}, {self.refreshed_at}"
+
+
 class HealthAdvice(models.Model):
-    quality_band = models.TextField(max_length = 9, default = '')
+    quality_band = models.TextField(max_length = 9, default = '', unique = True)
     lower_index = models.IntegerField(null = True, default = None)
     upper_index = models.IntegerField(null = True, default = None)
     advice_gen_pop = models.TextField(default='')
@@ -0,0 +1,259 @@
+"""
+Local nowcast engine: estimates the current emissions at any point by interpolating the
+latest stored site readings, rather than calling the LondonAir API's /Data/Nowcast
+endpoint for each point.
+
+The value of each species at a point is the inverse-distance-weighted (IDW) mean of the
+latest readings at the settings.AIRQUALITY_NOWCAST_NEIGHBOURS nearest active sites that
+measure it. Values are then banded into the UK Daily Air Quality Index (DAQI, 1-10).
+
+Each process keeps a NowcastField (a SiteIndex of the sites with a recent reading, per
+species), and rebuilds it when new readings are ingested, the Site table changes, or it
+is more than settings.AIRQUALITY_SNAPSHOT_TTL seconds old.
+"""
+import bisect
+import datetime as dt
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from Emissions import cache
+from Emissions.models import Reading
+from Emissions.spatial import SiteIndex
+
+NOWCAST_SPECIES = ["NO2", "O3", "PM10", "PM25"]
+# upper bound of DAQI bands 1-9 for each species, in ug/m3; anything higher is band 10.
+# NOTE: the DAQI bands O3 on 8-hour means and PM on 24-hour means; the nowcast applies
+# them to the latest hourly values, as an estimate
+DAQI_BANDS = {"NO2": [67, 134, 200, 267, 334, 400, 467, 534, 600],
+              "O3": [33, 66, 100, 120, 140, 160, 187, 213, 240],
+              "PM10": [16, 33, 50, 58, 66, 75, 83, 91, 100],
+              "PM25": [11, 23, 35, 41, 47, 53, 58, 64, 70]}
+# readings closer than this (in km) to the point are used as-is, rather than weighted
+EXACT_DISTANCE_KM = 0.001
+# number of points whose distances to every site are computed at once in nowcast_many
+# (this bounds the size of the points x sites distance matrix)
+BATCH_CHUNK_SIZE = 4096
+
+_field = None
+_field_lock = threading.Lock()
+
+
+def daqi_indices(species_code, values):
+    """
+    Vectorised daqi_index: get the DAQI (1-10) of an array of concentrations, as a float
+    array with NaN wherever the value is NaN.
+    """
+    indices = np.searchsorted(DAQI_BANDS[species_code], np.round(values), side="left") + 1.0
+    indices[np.isnan(values)] = np.nan
+    return indices
+
+
+def daqi_index(species_code, value):
+    """
+    Get the DAQI (1-10) of a species' concentration (in ug/m3), or None if value is None.
+    """
+    if value is None:
+        return None
+    bands = DAQI_BANDS[species_code]
+    # values are banded after rounding to whole ug/m3, as in the DAQI tables
+    return bisect.bisect_left(bands, round(value)) + 1
+
+
+class NowcastField:
+    """
+    The latest readings of each species, indexed by site location.
+
+    Parameters:
+    - readings (dict), mapping each species code to a list of
+    (site code, latitude, longitude, value) tuples
+    - cell_km (float), the size of the spatial index's grid cells in km
+    """
+
+    def __init__(self, readings, cell_km):
+        self.indexes, self.values = {}, {}
+        for code, site_readings in readings.items():
+            site_codes, latitudes, longitudes, values = zip(*site_readings) if site_readings else ([], [], [], [])
+            self.indexes[code] = SiteIndex(site_codes, latitudes, longitudes, cell_km)
+            # in the same order as the index's sites
+            self.values[code] = np.array(values, dtype=float)
+
+    def is_empty(self):
+        return not any(len(index) for index in self.indexes.values())
+
+    def interpolate(self, species_code, lat, lon, k):
+        """
+        Get the IDW estimate of a species at a point from its k nearest sites, or None
+        if no site has a recent reading of it.
+        """
+        index = self.indexes.get(species_code)
+        if index is None or not len(index):
+            return None
+        positions, distances = index.nearest_indices(lat, lon, k)
+        values = self.values[species_code][positions]
+        if distances[0] < EXACT_DISTANCE_KM:
+            return float(values[0])
+        weights = 1 / distances ** settings.AIRQUALITY_NOWCAST_POWER
+        return float(np.dot(weights, values) / weights.sum())
+
+    def interpolate_many(self, species_code, lats, lons, k):
+        """
+        Vectorised interpolate: get the IDW estimates of a species at many points.
+
+        Parameters:
+        - lats, lons (float arrays), the coordinates of the points
+        - k (int), the number of nearest sites to use for each point
+
+        Returns:
+        - a float array of the estimate at each point (all NaN if no site has a recent 
+        reading of the species)
+        """
+        estimates = np.full(len(lats), np.nan)
+        index = self.indexes.get(species_code)
+        if index is None or not len(index):
+            return estimates
+        values = self.values[species_code]
+        k = min(k, len(index))
+        power = settings.AIRQUALITY_NOWCAST_POWER
+        x, y = index.project(lats, lons)
+        for start in range(0, len(lats), BATCH_CHUNK_SIZE):
+            stop = start + BATCH_CHUNK_SIZE
+            # points x sites distances, then the k nearest sites to each point
+            distances = np.hypot(x[start:stop, None] - index.x, y[start:stop, None] - index.y)
+            if k < len(index):
+                nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, nearest, axis=1)
+            else:
+                nearest = np.broadcast_to(np.arange(len(index)), distances.shape)
+            nearest_values = values[nearest]
+            with np.errstate(divide="ignore"):
+                weights = 1 / distances ** power
+            # points (almost) at a site get that site's reading
+            closest = distances.argmin(axis=1)
+            exact = distances[np.arange(len(closest)), closest] < EXACT_DISTANCE_KM
+            weights[exact] = 0
+            weights[exact, closest[exact]] = 1
+            estimates[start:stop] = (weights * nearest_values).sum(axis=1) / weights.sum(axis=1)
+        return estimates
+
+    def nowcast_many(self, lats, lons, k):
+        """
+        Vectorised nowcast: get the nowcast at many points, in a single pass.
+
+        Returns:
+        - a dict with the same keys as nowcast, where each value is a numpy array aligned 
+        with lats and lons; species values and indices are floats, NaN where no site has 
+        a recent reading
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        result = {"@lat": lats, "@lon": lons}
+        indices = []
+        for code in NOWCAST_SPECIES:
+            values = self.interpolate_many(code, lats, lons, k)
+            result[f"@{code}"] = np.round(values, 1)
+            result[f"@{code}_Index"] = daqi_indices(code, values)
+            indices.append(result[f"@{code}_Index"])
+        # fmax ignores NaNs, so this is only NaN where no species has a value
+        result["@Max_Index"] = np.fmax.reduce(indices)
+        return result
+
+    def nowcast(self, lat, lon, k):
+        """
+        Get the nowcast at a point, in the same format as AirQualityApiData.nowcast
+        (without the annual means and easting/northing).
+        """
+        result = {"@lat": lat, "@lon": lon}
+        indices = []
+        for code in NOWCAST_SPECIES:
+            value = self.interpolate(code, lat, lon, k)
+            index = daqi_index(code, value)
+            result[f"@{code}"] = None if value is None else round(value, 1)
+            result[f"@{code}_Index"] = index
+            if index is not None:
+                indices.append(index)
+        result["@Max_Index"] = max(indices) if indices else None
+        return result
+
+
+def latest_readings(now=None):
+    """
+    Get the latest reading of each nowcast species at each active site, from the last
+    settings.AIRQUALITY_NOWCAST_MAX_AGE_HOURS hours.
+
+    Returns:
+    - a dict mapping each species code to a list of (site code, latitude, longitude,
+    value) tuples
+    """
+    now = now or dt.datetime.now(dt.timezone.utc)
+    since = now - dt.timedelta(hours=settings.AIRQUALITY_NOWCAST_MAX_AGE_HOURS)
+    rows = (Reading.objects
+            .filter(timestamp__gte=since, site__site_still_active=True,
+                    species__code__in=NOWCAST_SPECIES)
+            .order_by('timestamp')
+            .values_list('species__code', 'site__code', 'site__latitude', 'site__longitude', 'value'))
+    # later readings overwrite earlier ones
+    latest = {code: {} for code in NOWCAST_SPECIES}
+    for species_code, site_code, lat, lon, value in rows:
+        latest[species_code][site_code] = (site_code, lat, lon, value)
+    return {code: list(site_readings.values()) for code, site_readings in latest.items()}
+
+
+def get_nowcast_field():
+    """
+    Get this process's NowcastField, (re)building it if it is out of date.
+    """
+    global _field
+    versions = cache.get_local_data_versions(['Reading', 'Site'])
+    version = (versions['Reading'], versions['Site'])
+    field = _field
+    if (field is None or field[0] != version or
+            time.monotonic() - field[1] > settings.AIRQUALITY_SNAPSHOT_TTL):
+        with _field_lock:
+            if _field is field:
+                _field = (version, time.monotonic(),
+                          NowcastField(latest_readings(), settings.AIRQUALITY_SPATIAL_CELL_KM))
+            field = _field
+    return field[2]
+
+
+def nowcast(lat, lon):
+    """
+    Estimate the current emissions at a point from the latest stored readings.
+
+    Parameters:
+    - lat (float), the latitude of the point, in decimal degrees
+    - lon (float), the longitude of the point, in decimal degrees
+
+    Returns:
+    - a dict with keys ['@lat', '@lon', '@NO2', '@O3', '@PM10', '@PM25', '@NO2_Index',
+    '@O3_Index', '@PM10_Index', '@PM25_Index', '@Max_Index'], where species values are in
+    ug/m3 (None if no nearby site has a recent reading); or None if there are no recent
+    readings at all
+    """
+    field = get_nowcast_field()
+    if field.is_empty():
+        return None
+    return field.nowcast(lat, lon, settings.AIRQUALITY_NOWCAST_NEIGHBOURS)
+
+
+def nowcast_many(lats, lons):
+    """
+    Estimate the current emissions at many points from the latest stored readings, in a
+    single vectorised pass.
+
+    Parameters:
+    - lats (list or array of float), the latitudes of the points, in decimal degrees
+    - lons (list or array of float), the longitudes of the points, in decimal degrees
+
+    Returns:
+    - a dict with the same keys as nowcast, where each value is a numpy array aligned with
+    the input points (NaN where there is no estimate); or None if there are no recent 
+    readings at all
+    """
+    field = get_nowcast_field()
+    if field.is_empty():
+        return None
+    return field.nowcast_many(lats, lons, settings.AIRQUALITY_NOWCAST_NEIGHBOURS)
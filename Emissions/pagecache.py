@@ -0,0 +1,64 @@
+"""
+Per-process cache of the rendered index page.
+
+The index page only depends on the current emissions snapshot, the reference data
+(local authorities, sites and species), and whether the emissions are stale; it has no
+per-user content (e.g. no csrf_token), so every anonymous visitor gets the same bytes.
+The page is rendered once per combination of the version tokens of those tables (see
+cache.get_data_version) in each process, and stored with a gzip encoding and a hash of
+its content, which is used as its ETag.
+"""
+import gzip
+import hashlib
+import threading
+
+from Emissions import cache, metrics, store
+
+# the tables whose data is in the index page
+PAGE_TABLES = ['Snapshot', 'LocalAuthority', 'Site', 'Species']
+
+# (key, encodings) of the rendered page
+_page = None
+_page_lock = threading.Lock()
+
+
+def page_key():
+    """
+    Get the key of the current version of the index page's data.
+    """
+    versions = cache.get_local_data_versions(PAGE_TABLES)
+    parts = [versions[table] for table in PAGE_TABLES] + [str(store.current_emissions_are_stale())]
+    return "|".join(parts)
+
+
+def encode_page(content):
+    """
+    Get the encodings of a rendered page, as a dict with keys 'hash', 'identity' and
+    'gzip'.
+    """
+    return {"hash": hashlib.sha256(content).hexdigest()[:32],
+            "identity": content,
+            "gzip": gzip.compress(content, compresslevel=6, mtime=0)}
+
+
+def get_index_page(render_page):
+    """
+    Get the rendered index page, rendering it (with render_page, which returns the page
+    as bytes) if its data has changed since it was last rendered in this process.
+    Concurrent requests for a changed page wait for a single render.
+
+    Returns:
+    - the encodings of the page (see encode_page)
+    """
+    global _page
+    key = page_key()
+    page = _page
+    metrics.record_cache_lookup("index_page", page is not None and page[0] == key)
+    if page is None or page[0] != key:
+        with _page_lock:
+            if _page is None or _page[0] != key:
+                # the key is read before the data, so a change in between only causes an
+                # extra render
+                _page = (key, encode_page(render_page()))
+            page = _page
+    return page[1]
@@ -0,0 +1,201 @@
+"""
+Parsers for the JSON returned by the LondonAir API.
+
+The API nests its data (e.g. LocalAuthority -> Site -> Species), and returns a dict
+rather than a list wherever there is only one item. The parsers here flatten that
+tree in a single pass, straight into the row-dict format used elsewhere in the app 
+(parse_group_rows).
+
+Large responses (e.g. hourly readings over a long date range) can be parsed 
+incrementally with iter_json_array, rather than loading the whole document.
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# species codes, in the order of their keys in the processed rows, and the name of each
+SPECIES_CODES = ["CO", "NO2", "SO2", "O3", "PM10", "PM25"]
+SPECIES_NAMES = {"CO": "Carbon Monoxide",
+                 "NO2": "Nitrogen Dioxide",
+                 "SO2": "Sulphur Dioxide",
+                 "O3": "Ozone",
+                 "PM10": "PM10 Particulate",
+                 "PM25": "PM2.5 Particulate"}
+# keys that every site in a group MonitoringIndex should have
+SITE_KEYS = {"@SiteName", "@SiteCode", "@SiteType", "@BulletinDate", "@Latitude", "@Longitude",
+             "Species"}
+
+
+def as_list(item):
+    """
+    The API returns a list if there are several items, or a dict if there is only one;
+    get a list in either case (or an empty list if item is neither).
+    """
+    if isinstance(item, list):
+        return item
+    elif isinstance(item, dict):
+        return [item]
+    else:
+        return []
+
+
+def parse_group_rows(group_data, field1, field2):
+    """
+    Flatten a group MonitoringIndex into the row-dict format returned by 
+    AirQualityApiData.process_group_emissions, in a single pass; the rows are the same as
+    the per-site helpers (setup_row_dict and update_site_species_info) build.
+
+    Parameters:
+    - group_data (dict), the JSON returned by the API
+    - field1 (str), the top-level key, e.g. 'HourlyAirQualityIndex' or 'DailyAirQualityIndex'
+    - field2 (str), the key of the list of local authorities, e.g. 'LocalAuthority'
+
+    Returns:
+    - a list with a dict for each site; or None for sites with missing details, or no 
+    (or malformed) species
+    """
+    rows = []
+    species_name = SPECIES_NAMES.get
+    for la in as_list(group_data[field1][field2]):
+        # some local authorities don't actually have any collection sites
+        if "Site" not in la:
+            continue
+        la_name = la["@LocalAuthorityName"]
+        for site in as_list(la["Site"]):
+            try:
+                site_species = site["Species"]
+                # NOTE: the species keys must be in SPECIES_CODES order
+                row = {"Local Authority name": la_name,
+                       "Site name": site["@SiteName"],
+                       "Site code": site["@SiteCode"],
+                       "Site type": site["@SiteType"],
+                       "Date": site["@BulletinDate"],
+                       "Latitude": float(site["@Latitude"]),
+                       "Longitude": float(site["@Longitude"]),
+                       "Carbon Monoxide": None,
+                       "Nitrogen Dioxide": None,
+                       "Sulphur Dioxide": None,
+                       "Ozone": None,
+                       "PM10 Particulate": None,
+                       "PM2.5 Particulate": None}
+            except KeyError:
+                # sites with missing details, or no species, are marked as invalid
+                for key in SITE_KEYS - site.keys():
+                    logger.warning("The key %s does not exist", key)
+                rows.append(None)
+                continue
+            if isinstance(site_species, dict):
+                site_species = (site_species,)
+            elif not isinstance(site_species, list):
+                rows.append(None)
+                continue
+            for species in site_species:
+                name = species_name(species["@SpeciesCode"])
+                if name is None:
+                    logger.warning("Unexpected species %s", species["@SpeciesCode"])
+                else:
+                    row[name] = float(species["@AirQualityIndex"])
+            rows.append(row)
+    return rows
+
+
+def iter_json_array(chunks, key):
+    """
+    Incrementally parse the array stored under key in a JSON document, yielding each 
+    item as it's read; e.g. the readings in AirQualityData.Data of a /Data/Site response.
+    Only one item (plus one chunk of text) is held in memory at a time, so the whole 
+    document is never loaded. If key holds a single object rather than an array (as the
+    API does when there's only one item), that object is yielded.
+
+    Parameters:
+    - chunks (iterable of str), the JSON document, in pieces (e.g. from a streamed response)
+    - key (str), the key of the array; the first occurrence in the document is used
+
+    Raises:
+    - ValueError if the document ends before the array does
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    marker = f'"{key}"'
+    buffer = ""
+
+    def read_more(buffer):
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError(f"JSON document ended inside '{key}'")
+        return buffer + chunk
+
+    # find the key, then the start of its value
+    while True:
+        pos = buffer.find(marker)
+        if pos >= 0:
+            buffer = buffer[pos + len(marker):]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        # keep the end of the buffer, in case the key is split between chunks
+        buffer = buffer[-len(marker):] + chunk
+    pos = 0
+    while True:
+        buffer = buffer[pos:].lstrip(" \t\r\n:")
+        pos = 0
+        if buffer:
+            break
+        buffer = read_more(buffer)
+    if buffer[0] == "{":
+        while True:
+            try:
+                item, pos = decoder.raw_decode(buffer)
+                yield item
+                return
+            except ValueError:
+                buffer = read_more(buffer)
+    elif buffer[0] != "[":
+        return
+
+    pos = 1
+    while True:
+        # skip whitespace and separators between items
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            buffer, pos = read_more(""), 0
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # the item is incomplete; read the rest of it
+            buffer, pos = read_more(buffer[pos:]), 0
+            continue
+        yield item
+
+
+def pivot_readings(records):
+    """
+    Pivot readings from the /Data/Site endpoint (one record per species per hour) into 
+    one row per hour. The records can be in any order, so all of the rows are built 
+    before they're returned.
+
+    Parameters:
+    - records (iterable of dicts), the items of AirQualityData.Data, with keys 
+    '@MeasurementDateGMT', '@SpeciesCode' and '@Value'
+
+    Returns:
+    - a list of (timestamp, {species code: value}) tuples in time order; values are 
+    floats, or None where a species has no value for that hour
+    """
+    rows = {}
+    species_codes = set()
+    for record in records:
+        value = record["@Value"]
+        species_codes.add(record["@SpeciesCode"])
+        rows.setdefault(record["@MeasurementDateGMT"], {})[record["@SpeciesCode"]] = (
+            float(value) if value != "" else None)
+    for values in rows.values():
+        for code in species_codes - values.keys():
+            values[code] = None
+    return sorted(rows.items())
@@ -0,0 +1,82 @@
+"""
+Per-process cache of the reference data shown on the index page: the local authorities,
+sites and species (as lists of field dicts, for the page's drop-downs, and as pre-rendered
+json_script tags) and static/js/config.json.
+
+Each table is re-read from the database only when its version token in the shared cache
+changes (see Emissions/signals.py, and cache.get_data_version); config.json only changes
+on deploy, so it is read once per process. Each gunicorn worker warms the cache when it
+starts (see AirQuality/asgi.py and wsgi.py), so serving the index page (and the JSON 
+endpoints for these tables) needs no database queries or file reads for this data; just
+one round trip to the shared cache for the versions.
+"""
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.utils.html import json_script
+
+from Emissions import cache, metrics
+from Emissions.models import LocalAuthority, Site, Species
+
+# the name of each table in the index page's context, its model, and the id of its
+# json_script tag
+TABLES = [("local_auths", LocalAuthority, "local-auths-id"),
+          ("sites", Site, "sites-id"),
+          ("emissions_info", Species, "emissions-info-id")]
+
+# for each table: (version, rows, rendered json_script tag)
+_tables = {}
+_config = None
+_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Get static/js/config.json, as a tuple (config dict, rendered json_script tag), reading
+    it the first time.
+    """
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                with open(os.path.join(settings.STATIC, 'js/config.json'), "r") as f:
+                    config = json.load(f)
+                _config = (config, json_script(config, "config-id"))
+    return _config
+
+
+def get_reference_data():
+    """
+    Get the reference data for the index page, re-reading any table that has changed.
+
+    Returns:
+    - a dict with, for each table in TABLES, its rows (e.g. "sites", a list of Site field
+    dicts) and its rendered json_script tag (e.g. "sites_json"); and "config" and
+    "config_json" for static/js/config.json
+    """
+    versions = cache.get_local_data_versions([model.__name__ for _, model, _ in TABLES])
+    data = {}
+    for name, model, element_id in TABLES:
+        version = versions[model.__name__]
+        entry = _tables.get(name)
+        metrics.record_cache_lookup("reference", entry is not None and entry[0] == version)
+        if entry is None or entry[0] != version:
+            with _lock:
+                entry = _tables.get(name)
+                if entry is None or entry[0] != version:
+                    # the version is read before the rows, so a change in between only
+                    # causes an extra re-read
+                    rows = list(model.objects.all().values())
+                    _tables[name] = entry = (version, rows, json_script(rows, element_id))
+        data[name], data[f"{name}_json"] = entry[1], entry[2]
+    data["config"], data["config_json"] = get_config()
+    return data
+
+
+def warm():
+    """
+    Load the reference data into this process's cache, e.g. when a worker starts.
+    """
+    get_reference_data()
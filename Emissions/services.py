@@ -6,19 +6,44 @@
 #   mappings of API headers to variable names, that we can use across the app?
 #   -- Could it go into settings.py? Need to check we're not accidentally overriding 
 #       reserved names!
-#   -- Should also do this for API URLs, BASE_URL (and DES_PROXY...?)
+#   -- Should also do this for API URLs (the base URL and proxy are now in settings.py)
 # - Will need a method that takes a site (or list of sites), an emission type and a 
 #   date-range and returns the relevant intensity
-# - Setup logging   
-# - Failover to a database table of previous emissions values (in case API is down)
 
+import asyncio
+import codecs
 import datetime as dt
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from Emissions import cache, metrics
+from Emissions.async_client import get_async_client
+from Emissions.http_client import get_client
+from Emissions.parsers import SPECIES_NAMES, as_list, iter_json_array, parse_group_rows, pivot_readings
+from Emissions.singleflight import AsyncSingleFlight, SingleFlight
+
+logger = logging.getLogger(__name__)
 
-BASE_URL = "http://api.erg.kcl.ac.uk/AirQuality"
-DES_PROXY = {'http' : 'http://10.160.27.36:3128'}
 DEFAULT_START_DATE = "01Jan2019"
+# size (in bytes) of the pieces that streamed responses are read in
+STREAM_CHUNK_SIZE = 64 * 1024
+# errors while reading a response body (e.g. the connection drops partway through, 
+# leaving incomplete JSON), after the client has returned the response
+STREAM_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                 requests.exceptions.ContentDecodingError, requests.exceptions.InvalidJSONError,
+                 ValueError)
+
+# the hourly MonitoringIndex of a group of sites, i.e. the current emissions
+GROUP_INDEX_URL = "/Hourly/MonitoringIndex/GroupName={group_name}/Json"
+
+# coalesces concurrent requests for the same URL in this process (see get_data_from_API)
+_api_flights = SingleFlight()
+# ditto, for the async methods (see aget_data_from_API)
+_async_api_flights = AsyncSingleFlight()
 
 def datetime_obj_to_str(dt_obj):
     """
@@ -35,50 +60,253 @@ def datetime_obj_to_str(dt_obj):
 
 DEFAULT_END_DATE =  datetime_obj_to_str(dt.datetime.now() + dt.timedelta(days = 1))
 
+def date_windows(start_date, end_date, days):
+    """
+    Split a time window into consecutive pieces of (at most) a given number of days.
+
+    Parameters:
+    - start_date, end_date (str), the time window, format DDMonYYYY (e.g. 01Jan2000)
+    - days (int), the maximum length of each piece
+
+    Returns:
+    - a list of (start_date, end_date) tuples of str, format DDMonYYYY
+    """
+    start = dt.datetime.strptime(start_date, '%d%b%Y')
+    end = dt.datetime.strptime(end_date, '%d%b%Y')
+    windows = []
+    while start < end:
+        window_end = min(start + dt.timedelta(days=days), end)
+        windows.append((datetime_obj_to_str(start), datetime_obj_to_str(window_end)))
+        start = window_end
+    return windows
+
+def map_concurrently(func, *iterables):
+    """
+    Like map(), but calls func concurrently in a thread pool of at most 
+    settings.AIRQUALITY_MAX_CONCURRENCY threads. Used for I/O-bound calls to the API.
+
+    Returns:
+    - a list of the results, in the same order as the arguments. If any call raises an 
+    exception, it is re-raised here.
+    """
+    args = list(zip(*iterables))
+    if not args:
+        return []
+    workers = max(1, min(settings.AIRQUALITY_MAX_CONCURRENCY, len(args)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda arg: func(*arg), args))
+
+async def gather_concurrently(func, *iterables):
+    """
+    Async version of map_concurrently: awaits func for each set of arguments, with at
+    most settings.AIRQUALITY_MAX_CONCURRENCY calls in flight at once.
+
+    Returns:
+    - a list of the results, in the same order as the arguments. If any call raises an 
+    exception, it is re-raised here.
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.AIRQUALITY_MAX_CONCURRENCY))
+
+    async def call(arg):
+        async with semaphore:
+            return await func(*arg)
+    return list(await asyncio.gather(*(call(arg) for arg in zip(*iterables))))
+
+def fetch_lock_poll_delays(deadline):
+    """
+    Yield the times to wait between polls for another process's fetch result: starting 
+    at settings.AIRQUALITY_FETCH_LOCK_POLL seconds and doubling up to 
+    AIRQUALITY_FETCH_LOCK_POLL_MAX, so that a long wait doesn't make hundreds of cache 
+    queries. Stops at deadline (a time.monotonic() time).
+    """
+    delay = settings.AIRQUALITY_FETCH_LOCK_POLL
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, settings.AIRQUALITY_FETCH_LOCK_POLL_MAX)
+
+def merge_readings_chunks(chunks):
+    """
+    Merge chunks of hourly readings (lists of (timestamp, {species code: value}) tuples),
+    which may overlap by a day, depending on how the API treats EndDate.
+
+    Returns:
+    - a list of dicts, one per hour in time order, of form 
+    {'MeasurementDate': 'YYYY-MM-DD HH:MM:SS', <species code>: value, ...}
+    """
+    readings = {}
+    for chunk in chunks:
+        for timestamp, values in chunk:
+            readings.setdefault(timestamp, values)
+    return [{'MeasurementDate': timestamp, **readings[timestamp]} for timestamp in sorted(readings)]
+
 class AirQualityApiData:
     """
-    Series of methods to return API data to the application. Call SetupData 
-    class with boolean True/False to use the required DES proxy server.
+    Series of methods to return API data to the application. All requests go through
+    the shared, pooled client in Emissions/http_client.py; or, for the async versions of
+    the methods (prefixed with 'a', e.g. aget_data_from_API), the event loop's pooled
+    client in Emissions/async_client.py.
     """
     
-    def __init__(self, use_DES_proxy=False):
-        # *********************
-        # AV: Luke - this use_DES_proxy var is a good idea, and works well for DES (obvs!).
-        # A more general case though would be to replace the boolean flag with a setting for 
-        # users who are behind *any* proxy; we could also build a simple interface to let 
-        # them enter the details...?
-        # *********************
-        if use_DES_proxy == True:
-            self.proxy = DES_PROXY
-        else:
-            self.proxy = None
+    def __init__(self, proxy=None):
+        """
+        Parameters:
+        - proxy (str), the URL of a proxy server to use for API requests. Optional, default
+        None (i.e. use settings.AIRQUALITY_PROXY, if it is set)
+        """
+        self.proxy = proxy
     
     def get_data_from_API(self, url, proxy=None):
         """
         Get data from the LondonAir API. If a connection cannot be made, print 
-        a message to the console and exit.
+        a message to the console and return None.
+
+        Concurrent calls for the same URL share a single request: threads in this process
+        wait for the first thread's request (see Emissions/singleflight.py), and other 
+        processes wait for it via a lock in the shared cache (see fetch_coalesced).
 
         Parameters:
         - url (str), the URL containing the API data
         - proxy (str), a URL containing the address of a proxy server. Optional, default None
+        (i.e. use the proxy this object was created with)
 
         Returns:
         - a JSON structure containing the data provided by the API; or None if the request 
         failed (e.g. due to a connection error, or an error with the URL provided)
         """
-        
+        proxy = proxy or self.proxy
+        return _api_flights.do((url, proxy), lambda: self.fetch_coalesced(url, proxy))
+
+    def fetch_coalesced(self, url, proxy=None):
+        """
+        As fetch_from_API, but coalesced across processes: the process that takes the
+        fetch lock for the URL makes the request and shares its result in the cache; other
+        processes poll for that result (less and less often; see fetch_lock_poll_delays)
+        until the lock is released, then (if there's no result, e.g. the request failed) 
+        try to take the lock themselves. After 
+        settings.AIRQUALITY_FETCH_LOCK_TIMEOUT seconds, a waiting process gives up and 
+        makes the request anyway.
+        """
+        if not settings.AIRQUALITY_FETCH_LOCK_TIMEOUT:
+            return self.fetch_from_API(url, proxy)
+        delays = fetch_lock_poll_delays(time.monotonic() + settings.AIRQUALITY_FETCH_LOCK_TIMEOUT)
+        while True:
+            data = cache.get_fetch_result(url)
+            if data is not None:
+                return data
+            token = cache.acquire_fetch_lock(url)
+            if token is not None:
+                # the last holder may have shared its result and released the lock since
+                # the result was checked
+                data = cache.get_fetch_result(url)
+                if data is not None:
+                    cache.release_fetch_lock(url, token)
+                    return data
+                break
+            delay = next(delays, None)
+            if delay is None:
+                break
+            time.sleep(delay)
         try:
-            response = requests.get(BASE_URL + url, proxies=proxy)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return None
-        except requests.exceptions.ConnectionError:
-            # placeholder at present; ideally; this would be logged to file (rather than 
-            # printed to console).
-            print(f"\n*** No response from {BASE_URL + url}; is the URL correct? ***\n")
+            data = self.fetch_from_API(url, proxy)
+            if data is not None and token is not None:
+                cache.set_fetch_result(url, data)
+            return data
+        finally:
+            if token is not None:
+                cache.release_fetch_lock(url, token)
+
+    def fetch_from_API(self, url, proxy=None):
+        """
+        Make a request to the LondonAir API (without coalescing); returns the JSON data,
+        or None if the request failed.
+        """
+        client = get_client()
+        try:
+            return client.get_json(url, proxy or self.proxy)
+        except requests.exceptions.RequestException:
+            logger.warning("No response from %s; is the URL correct?", client.base_url + url)
             return None
     
+    def get_many_from_API(self, urls):
+        """
+        Get data for several URLs from the LondonAir API concurrently, using at most 
+        settings.AIRQUALITY_MAX_CONCURRENCY simultaneous requests.
+
+        Parameters:
+        - urls (list of str), the URLs containing the API data
+
+        Returns:
+        - a list of the JSON structures returned by get_data_from_API, in the same order 
+        as urls (None for any request that failed)
+        """
+        return map_concurrently(self.get_data_from_API, urls)
+
+    async def aget_data_from_API(self, url, proxy=None):
+        """
+        Async version of get_data_from_API, for async views: the request is made with the
+        async client (see Emissions/async_client.py), so the event loop serves other
+        requests while it waits. Concurrent calls for the same URL share a single request,
+        in this event loop and (via the fetch lock) across processes.
+
+        Returns:
+        - a JSON structure containing the data provided by the API; or None if the request 
+        failed
+        """
+        proxy = proxy or self.proxy
+        return await _async_api_flights.do((url, proxy), lambda: self.afetch_coalesced(url, proxy))
+
+    async def afetch_coalesced(self, url, proxy=None):
+        """
+        Async version of fetch_coalesced; waiting for another process's request doesn't 
+        block the event loop.
+        """
+        if not settings.AIRQUALITY_FETCH_LOCK_TIMEOUT:
+            return await self.afetch_from_API(url, proxy)
+        delays = fetch_lock_poll_delays(time.monotonic() + settings.AIRQUALITY_FETCH_LOCK_TIMEOUT)
+        while True:
+            data = await sync_to_async(cache.get_fetch_result)(url)
+            if data is not None:
+                return data
+            token = await sync_to_async(cache.acquire_fetch_lock)(url)
+            if token is not None:
+                data = await sync_to_async(cache.get_fetch_result)(url)
+                if data is not None:
+                    await sync_to_async(cache.release_fetch_lock)(url, token)
+                    return data
+                break
+            delay = next(delays, None)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        try:
+            data = await self.afetch_from_API(url, proxy)
+            if data is not None and token is not None:
+                await sync_to_async(cache.set_fetch_result)(url, data)
+            return data
+        finally:
+            if token is not None:
+                await sync_to_async(cache.release_fetch_lock)(url, token)
+
+    async def afetch_from_API(self, url, proxy=None):
+        """
+        Async version of fetch_from_API.
+        """
+        client = get_async_client()
+        try:
+            return await client.get_json(url, proxy or self.proxy)
+        except requests.exceptions.RequestException:
+            logger.warning("No response from %s; is the URL correct?", client.base_url + url)
+            return None
+
+    async def aget_many_from_API(self, urls):
+        """
+        Async version of get_many_from_API.
+        """
+        return await gather_concurrently(self.aget_data_from_API, urls)
+
     def setup_row_dict(self, site_data, la_name):
         try:
             return {"Local Authority name": la_name, 
@@ -95,24 +323,15 @@ class AirQualityApiData:
                     "PM10 Particulate": None, 
                     "PM2.5 Particulate": None}
         except KeyError as err:
-            print(f"The key {err.args[0]} does not exist")
+            logger.warning("The key %s does not exist", err.args[0])
             return None
 
     def get_species_type(self, species_info, row):
-        if species_info["@SpeciesCode"] == "CO":
-            row["Carbon Monoxide"] = float(species_info["@AirQualityIndex"])
-        elif species_info["@SpeciesCode"] == "NO2":
-            row["Nitrogen Dioxide"] = float(species_info["@AirQualityIndex"])
-        elif species_info["@SpeciesCode"] == "SO2":
-            row["Sulphur Dioxide"] = float(species_info["@AirQualityIndex"])
-        elif species_info["@SpeciesCode"] == "O3":
-            row["Ozone"] = float(species_info["@AirQualityIndex"])
-        elif species_info["@SpeciesCode"] == "PM10":
-            row["PM10 Particulate"] = float(species_info["@AirQualityIndex"])
-        elif species_info["@SpeciesCode"] == "PM25":
-            row["PM2.5 Particulate"] = float(species_info["@AirQualityIndex"])
+        name = SPECIES_NAMES.get(species_info["@SpeciesCode"])
+        if name is not None:
+            row[name] = float(species_info["@AirQualityIndex"])
         else:
-            print(f"\n*** Unexpected species {species_info['@SpeciesCode']} ***\n")
+            logger.warning("Unexpected species %s", species_info['@SpeciesCode'])
         return row
 
     def update_site_species_info(self, site, row):
@@ -127,64 +346,75 @@ class AirQualityApiData:
                 row = self.get_species_type(site["Species"], row)
             # something's gone wrong...
             else:
-                print(f"\n*** Unexpected species type: species info = {species}, {type(species)} ***\n")
+                logger.warning("Unexpected species type: species info = %s, %s", site["Species"], 
+                               type(site["Species"]))
                 row = None
         # odd behaviour, worth checking the source JSON
         else:
-            print(f"\n*** Site {site} has no Species - is this correct? ***\n")
+            logger.warning("Site %s has no Species - is this correct?", site)
             row = None
 
         return row
 
     def process_group_emissions(self, group_data, field1, field2):
-        output_data = []
-        for la in group_data[field1][field2]:
-            # some local authorities don't actually have any collection sites
-            if 'Site' in la:
-                # print(la["@LocalAuthorityName"])
-                # case where the LA has more than 1 collection site
-                if isinstance(la['Site'], list):
-                    for site in la['Site']:
-                        row = self.setup_row_dict(site, la["@LocalAuthorityName"]) 
-                        output_data.append(self.update_site_species_info(site, row))
-                # case where the LA has exactly 1 collection site
-                elif isinstance(la['Site'], dict):
-                    site = la['Site']       # don't really need this, but for consistency with above
-                    row = self.setup_row_dict(site, la["@LocalAuthorityName"])
-                    output_data.append(self.update_site_species_info(site, row))
-                # something's gone wrong...!
-                else:
-                    row = None
-                    print(f"Unexpected site type: site info = {site}, {type(site)}")                        
-        
-        return output_data
+        """
+        Convert a group MonitoringIndex from the API to a list with a dict for each site
+        (or None, for sites with missing details). See Emissions/parsers.py.
+
+        Parameters:
+        - group_data (dict), the JSON returned by the API
+        - field1 (str), the top-level key, e.g. 'HourlyAirQualityIndex'
+        - field2 (str), the key of the list of local authorities, e.g. 'LocalAuthority'
+        """
+        with metrics.PARSE_SECONDS.labels("group_index").time():
+            return parse_group_rows(group_data, field1, field2)
 
-    def get_current_emissions_across_london(self, group_name="London"):
+    def get_current_emissions_across_london(self, group_name="London", use_cache=True):
         """
         Get current emissions values for all London sites (no interpolation), for 
-        all emissions types
+        all emissions types. 
+        
+        The processed data is cached (see Emissions/cache.py) until the API next 
+        publishes its hourly data, so the API is only called once per hour. The web app
+        doesn't call this; it serves the Snapshots stored by the ingest worker (see 
+        store.get_current_emissions_with_status).
+
+        Parameters:
+        - group_name (str), the name of the group of sites. Optional, default "London"
+        - use_cache (bool), whether to use the cached snapshot. Optional, default True
         """
-        URL = f"/Hourly/MonitoringIndex/GroupName={group_name}/Json"
-        data = self.get_data_from_API(URL)
-        if data is not None:
-            return self.process_group_emissions(data, 'HourlyAirQualityIndex', 'LocalAuthority')
-        else:
+        if use_cache:
+            emissions = cache.get_snapshot(group_name)
+            if emissions is not None:
+                return emissions
+
+        data = self.get_data_from_API(GROUP_INDEX_URL.format(group_name=group_name))
+        if data is None:
             return None
+        emissions = self.process_group_emissions(data, 'HourlyAirQualityIndex', 'LocalAuthority')
+        cache.set_snapshot(group_name, emissions)
+        return emissions
 
     def get_emissions_across_london_last_n_days(self, group_name="London", n=7):
         # I want to: 
         # - get emissions for the last n days, i.e. today and the preceeding 6 days
         # - average the emissions (for each emission), by local auth and also across London
         #   -- can the be done more efficiently on the client-side?
+        #   -- DONE server-side: the local store keeps hourly and daily aggregates per
+        #      local auth and across London (see store.get_aggregates)
         # Notes:
         # - the URL I need is /Daily/MonitoringIndex/GroupName={Group}/Date={Date}/Json
         # - the output format is very similar to that for get_current_emissions_across_london :-)
-        output_data = {}
+        # The requests for each day are made concurrently (see get_many_from_API).
+        days = []
         for i in range(1, n):
             day = datetime_obj_to_str(dt.datetime.now() - dt.timedelta(days = i))
-            if day[0] == "0": day = day[1:]            
-            URL = f"/Daily/MonitoringIndex/GroupName={group_name}/Date={day}/Json"
-            data = self.get_data_from_API(URL)            
+            if day[0] == "0": day = day[1:]
+            days.append(day)
+        URLs = [f"/Daily/MonitoringIndex/GroupName={group_name}/Date={day}/Json" for day in days]
+
+        output_data = {}
+        for day, data in zip(days, self.get_many_from_API(URLs)):
             if data is not None:
                 output_data[day] = self.process_group_emissions(data, "DailyAirQualityIndex", "LocalAuthority")
             else:
@@ -192,6 +422,103 @@ class AirQualityApiData:
         
         return output_data
 
+    def get_site_readings_window(self, site_code, start_date, end_date):
+        """
+        Get the hourly measurements of all species at a site over a time window, in a 
+        single request. The response is streamed and parsed incrementally (see 
+        Emissions/parsers.py), so its text is never held in memory as a whole; but the 
+        window's rows are all built (and sorted) before they're returned, so memory use 
+        grows with the length of the window.
+
+        Parameters:
+        - site_code (str), a 3(?)-character code for the site that's being queried, e.g. 'TDO'
+        - start_date, end_date (str), the time window, format DDMonYYYY (e.g. 01Jan2000)
+
+        Returns:
+        - a list of (timestamp, {species code: value}) tuples in time order
+
+        If the response breaks off while it's being read, the window is requested again,
+        up to settings.AIRQUALITY_STREAM_RETRIES times; failed requests (connection errors,
+        5xx responses) are retried by the client, so they aren't retried here as well.
+
+        Raises:
+        - requests.exceptions.RequestException (or ValueError, if the response is
+        malformed) if the request fails
+        """
+        URL = f"/Data/Site/SiteCode={site_code}/StartDate={start_date}/EndDate={end_date}/Json"
+        for attempt in range(settings.AIRQUALITY_STREAM_RETRIES + 1):
+            with get_client().get(URL, self.proxy, stream=True) as response:
+                response.raise_for_status()
+                decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+                chunks = (decoder.decode(chunk) for chunk in response.iter_content(STREAM_CHUNK_SIZE))
+                try:
+                    return pivot_readings(iter_json_array(chunks, "Data"))
+                except STREAM_ERRORS as error:
+                    if attempt == settings.AIRQUALITY_STREAM_RETRIES:
+                        raise
+                    logger.warning("Reading %s failed (%s); requesting it again", URL, error)
+                    metrics.record_retry(URL)
+
+    async def aget_site_readings_window(self, site_code, start_date, end_date):
+        """
+        Async version of get_site_readings_window. The async client doesn't stream, so 
+        the response is read in full (and retried by the client if reading it fails) 
+        before it is parsed; a body that isn't valid JSON (e.g. it was cut short) is 
+        requested again, up to settings.AIRQUALITY_STREAM_RETRIES times.
+
+        Raises:
+        - requests.exceptions.RequestException or ValueError if the request fails
+        """
+        URL = f"/Data/Site/SiteCode={site_code}/StartDate={start_date}/EndDate={end_date}/Json"
+        for attempt in range(settings.AIRQUALITY_STREAM_RETRIES + 1):
+            try:
+                data = await get_async_client().get_json(URL, self.proxy)
+                break
+            except requests.exceptions.InvalidJSONError as error:
+                if attempt == settings.AIRQUALITY_STREAM_RETRIES:
+                    raise
+                logger.warning("Reading %s failed (%s); requesting it again", URL, error)
+                metrics.record_retry(URL)
+        if data is None:
+            raise requests.exceptions.HTTPError(f"No readings returned from {URL}")
+        if not isinstance(data, dict) or not isinstance(data.get("AirQualityData"), dict):
+            raise ValueError(f"Unexpected response from {URL}")
+        with metrics.PARSE_SECONDS.labels("site_readings").time():
+            return pivot_readings(as_list(data["AirQualityData"].get("Data")))
+
+    def iter_hourly_site_readings(self, site_code, 
+                                  start_date=DEFAULT_START_DATE, 
+                                  end_date=DEFAULT_END_DATE, 
+                                  window_days=None):
+        """
+        Generator version of get_hourly_site_readings_between, whose memory use is 
+        bounded by one piece of the time window, however long the window is. The window 
+        is requested in pieces of window_days days, one after the other; each piece is 
+        streamed, parsed and pivoted (so its rows are held in memory together, see 
+        get_site_readings_window), and its rows yielded before the next piece is requested.
+
+        Parameters:
+        - site_code (str), a 3(?)-character code for the site that's being queried, e.g. 'TDO'
+        - start_date, end_date (str), the time window, format DDMonYYYY (e.g. 01Jan2000)
+        - window_days (int), the number of days to request at once. Optional; default is 
+        settings.AIRQUALITY_STREAM_WINDOW_DAYS
+
+        Yields:
+        - (timestamp, {species code: value}) tuples in time order, e.g. 
+        ('2019-01-01 00:00:00', {'NO2': 20.1, 'PM10': None})
+
+        Raises:
+        - requests.exceptions.RequestException if a request fails
+        """
+        window_days = window_days or settings.AIRQUALITY_STREAM_WINDOW_DAYS
+        last_timestamp = None
+        for window_start, window_end in date_windows(start_date, end_date, window_days):
+            for timestamp, values in self.get_site_readings_window(site_code, window_start, window_end):
+                # windows may overlap by a day, depending on how the API treats EndDate
+                if last_timestamp is None or timestamp > last_timestamp:
+                    last_timestamp = timestamp
+                    yield timestamp, values
+
     def get_hourly_site_readings_between(self, site_code, 
                                          start_date=DEFAULT_START_DATE, 
                                          end_date=DEFAULT_END_DATE):
@@ -207,22 +534,49 @@ class AirQualityApiData:
         DDMonYYYY, e.g. 01Jan2000. Optional; default is the current date.
         
         Returns:
-        - a pandas Dataframe of the species measurements across the 
-        datetime hours requested.
+        - a list of dicts, one per hour in time order, of form 
+        {'MeasurementDate': 'YYYY-MM-DD HH:MM:SS', <species code>: value, ...}; or None if 
+        the request failed. Values are floats, or None where there's no measurement.
 
         Note: conversion to the correct format can be done via the datetime_obj_to_str
-        convenience function.
+        convenience function. 
+        
+        Long time windows are split into chunks of settings.AIRQUALITY_STREAM_WINDOW_DAYS 
+        days, which are requested concurrently (see get_site_readings_window); the client
+        retries each chunk's request if it fails, and a chunk whose response breaks off 
+        partway through is requested again on its own. If memory use matters more than 
+        speed, use iter_hourly_site_readings instead: this builds the whole time window's
+        rows in memory (see merge_readings_chunks).
         """        
-        URL = f"/Data/Site/SiteCode={site_code}/StartDate={start_date}/EndDate={end_date}/Json"
-        data = self.get_data_from_API(URL)
-        if data is not None:
-            df = pd.DataFrame(data['AirQualityData']['Data'])
-            # reshape the datat into a more useful format
-            df = df.pivot(index='@MeasurementDateGMT', columns="@SpeciesCode", values="@Value").reset_index()
-            # get rid of @s in the column names
-            return df.rename(index=str, columns={'@MeasurementDateGMT':'MeasurementDate'}).to_dict('records')    
-        else:
-            return None    
+        try:
+            windows = date_windows(start_date, end_date, settings.AIRQUALITY_STREAM_WINDOW_DAYS)
+            if not windows:
+                windows = [(start_date, end_date)]
+            chunks = map_concurrently(self.get_site_readings_window, [site_code] * len(windows), 
+                                      *zip(*windows))
+        except (requests.exceptions.RequestException, ValueError):
+            logger.warning("No readings returned for site %s", site_code)
+            return None
+
+        return merge_readings_chunks(chunks)
+
+    async def aget_hourly_site_readings_between(self, site_code, 
+                                                start_date=DEFAULT_START_DATE, 
+                                                end_date=DEFAULT_END_DATE):
+        """
+        Async version of get_hourly_site_readings_between; the chunks are requested 
+        concurrently on the event loop, rather than in a thread pool.
+        """
+        try:
+            windows = date_windows(start_date, end_date, settings.AIRQUALITY_STREAM_WINDOW_DAYS)
+            if not windows:
+                windows = [(start_date, end_date)]
+            chunks = await gather_concurrently(self.aget_site_readings_window, 
+                                               [site_code] * len(windows), *zip(*windows))
+        except (requests.exceptions.RequestException, ValueError):
+            logger.warning("No readings returned for site %s", site_code)
+            return None
+        return merge_readings_chunks(chunks)
     
     def get_daily_index_latest(self, site_code):
         """
@@ -238,7 +592,7 @@ class AirQualityApiData:
         """
         
         URL = f"/Daily/MonitoringIndex/Latest/SiteCode={site_code}/Json"
-        data = self.get_data_from_API(URL, self.proxy)
+        data = self.get_data_from_API(URL)
         if data is not None:
             daily_index_latest = (data['DailyAirQualityIndex']['LocalAuthority']
                                     ["Site"]["Species"])
@@ -275,7 +629,7 @@ class AirQualityApiData:
         if type(date) == dt.datetime:
             date = datetime_obj_to_str(date)
         URL = f"/Daily/MonitoringIndex/SiteCode={site_code}/Date={date}/Json"
-        data = self.get_data_from_API(URL, self.proxy)
+        data = self.get_data_from_API(URL)
         if data is not None:
             daily_index_dated = (data['DailyAirQualityIndex']['LocalAuthority']
                                 ["Site"]["Species"])
@@ -286,29 +640,71 @@ class AirQualityApiData:
         else:
             return None                
 
-    def nowcast(self, lat, long):
+    def nowcast(self, lat, long, source=None):
         """
         For a specific point, will get data from the nearest emissions collection 
         points and interpolate to provide an estimate of the emissions at that point.
 
+        By default (settings.AIRQUALITY_NOWCAST_SOURCE = 'local') the estimate is 
+        interpolated from the latest stored readings (see Emissions/nowcast.py), and the 
+        LondonAir API is only called if there are none. With source='api' the API's own 
+        nowcast is always returned, e.g. to validate the local one. The API's nowcasts are
+        requested for the centre of each settings.AIRQUALITY_NOWCAST_CACHE_CELL_M grid 
+        cell, and cached until the next publish time; so the result (including its '@lat'
+        and '@lon') is for the centre of the cell that (lat, long) is in.
+
         Parameters:
-            - lat (float), a decimal(?) latitude value
-            - long (float), a decimal(?) longitude value
+            - lat (float), a decimal latitude value
+            - long (float), a decimal longitude value
+            - source (str), 'local' or 'api'. Optional; default is 
+            settings.AIRQUALITY_NOWCAST_SOURCE
         
         Returns:
         - a dictionary with keys:
-        ['@lat', '@lon', '@Easting', '@Northing', '@NO2_Annual', '@O3_Annual', 
-        '@PM10_Annual', '@PM25_Annual', '@NO2', '@O3', '@PM10', '@PM25', 
-        '@NO2_Index', '@O3_Index', '@PM10_Index', '@PM25_Index', '@Max_Index']
+        ['@lat', '@lon', '@NO2', '@O3', '@PM10', '@PM25', '@NO2_Index', '@O3_Index', 
+        '@PM10_Index', '@PM25_Index', '@Max_Index']; the API's nowcast also has the keys
+        ['@Easting', '@Northing', '@NO2_Annual', '@O3_Annual', '@PM10_Annual', '@PM25_Annual']
         """
-        URL = f"/Data/Nowcast/lat={lat}/lon={long}/Json"
+        if (source or settings.AIRQUALITY_NOWCAST_SOURCE) == 'local':
+            # imported here, as it needs django's models (and so a configured django)
+            from Emissions import nowcast
+            result = nowcast.nowcast(float(lat), float(long))
+            if result is not None:
+                return result
+        # the API's nowcasts are cached by grid cell, so nearby points share them
+        point_result = cache.get_nowcast(float(lat), float(long))
+        if point_result is not None:
+            return point_result
+        centre_lat, centre_long = cache.nowcast_cell_centre(float(lat), float(long))
+        URL = f"/Data/Nowcast/lat={centre_lat}/lon={centre_long}/Json"
         data = self.get_data_from_API(URL)
         # TODO: get rid of '@' symbols in return dict
         if data is not None:
+            cache.set_nowcast(float(lat), float(long), data['PointResult'])
             return data['PointResult']
         else:
             return None
 
+    def nowcast_many(self, lats, longs):
+        """
+        Estimate the emissions at many points at once (e.g. postcode centroids, or points
+        along a route), in a single vectorised pass over the latest stored readings (see
+        Emissions/nowcast.py). Unlike nowcast, there is no fallback to the LondonAir API,
+        which would need a request per point.
+
+        Parameters:
+            - lats (list or array of float), decimal latitude values
+            - longs (list or array of float), decimal longitude values, aligned with lats
+
+        Returns:
+        - a dictionary with the same keys as nowcast, where each value is a numpy array 
+        aligned with the input points (NaN where there is no estimate); or None if there 
+        are no recent readings
+        """
+        # imported here, as it needs django's models (and so a configured django)
+        from Emissions import nowcast
+        return nowcast.nowcast_many(lats, longs)
+
     def get_all_emissions_info(self):
         """
         Get information about each of the emissions types; name, code, description, its effect on health, 
@@ -333,7 +729,8 @@ class AirQualityApiData:
                 {"value": "emphesema", "text":"Emphesema"}]
 
 def main():
-    setup = AirQualityApiData(use_DES_proxy=False)
+    import pandas as pd
+    setup = AirQualityApiData()
 
     ldn = setup.get_current_emissions_across_london()
     df = pd.DataFrame(ldn)
@@ -352,5 +749,10 @@ def main():
         print(pd.DataFrame(last_n[day]).head())
     
 if __name__ == "__main__":
+    # caching needs the django settings
+    import os
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AirQuality.settings')
+    import django
+    django.setup()
     main()
     
\ No newline at end of file
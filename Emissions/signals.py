@@ -0,0 +1,25 @@
+"""
+Signal handlers that record when the reference data (local authorities, species, sites
+and health advice) changes, so that anything derived from it can be rebuilt. Connected 
+in EmissionsConfig.ready.
+
+NOTE: bulk operations (bulk_create, bulk_update, QuerySet.update) don't send these 
+signals; code that uses them should call cache.bump_data_version itself.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from Emissions import cache
+from Emissions.models import HealthAdvice, LocalAuthority, Site, Species
+
+REFERENCE_MODELS = (LocalAuthority, Species, Site, HealthAdvice)
+
+
+@receiver([post_save, post_delete])
+def reference_data_changed(sender, **kwargs):
+    """
+    Give the sender's table a new version token, once the change is committed.
+    """
+    if sender in REFERENCE_MODELS:
+        transaction.on_commit(lambda: cache.bump_data_version(sender.__name__))
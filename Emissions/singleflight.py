@@ -0,0 +1,105 @@
+"""
+In-process request coalescing ("single-flight"): when several threads ask for the same
+key at once, only the first one does the work, and the others wait for and share its
+result; AsyncSingleFlight does the same for coroutines. Used to stop concurrent requests
+for the same data from each calling the LondonAir API.
+"""
+import asyncio
+import threading
+import weakref
+
+
+class Call:
+    """
+    A call in flight: the result (or exception) of func, once done is set.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        """
+        Call func(), unless a call with the same key is already in flight, in which case
+        wait for that call to finish and share its result.
+
+        Parameters:
+        - key (hashable), identifies the work, e.g. a URL
+        - func (callable), does the work; called with no arguments
+
+        Returns:
+        - the result of func
+
+        Raises:
+        - any exception raised by func (in every thread that waited on the call)
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            # later calls start a new flight
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call, for coroutines: the
+    first caller's coroutine runs as a task, and every caller awaits that task. A caller
+    that is cancelled (e.g. its client disconnected) doesn't cancel the task, which the
+    other callers may still be waiting for.
+    """
+
+    def __init__(self):
+        # the tasks in flight in each event loop
+        self.calls = weakref.WeakKeyDictionary()
+
+    async def do(self, key, func):
+        """
+        Await func(), unless a call with the same key is already in flight, in which case
+        await that call and share its result.
+
+        Parameters:
+        - key (hashable), identifies the work, e.g. a URL
+        - func (callable), returns a coroutine that does the work; called with no arguments
+
+        Returns:
+        - the result of the coroutine
+
+        Raises:
+        - any exception raised by the coroutine (in every caller)
+        """
+        loop = asyncio.get_running_loop()
+        calls = self.calls.setdefault(loop, {})
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = loop.create_task(func())
+            # later calls start a new flight
+            task.add_done_callback(lambda _: calls.pop(key, None))
+        return await asyncio.shield(task)
@@ -0,0 +1,197 @@
+"""
+In-process spatial index of the active monitoring sites, for finding the sites nearest
+to a point (e.g. for a nowcast, or the map's "near me" feature) without calling the
+LondonAir API or scanning the Site table.
+
+Site coordinates are projected onto a flat (equirectangular) plane centred on the
+sites, and bucketed into a uniform grid of settings.AIRQUALITY_SPATIAL_CELL_KM square
+cells; a query only looks at the cells around the point. Distances are measured on the
+plane, which is accurate to well under 0.1% over an area the size of London.
+
+Each process builds its own index the first time it's used, and rebuilds it whenever
+the Site table's version token changes (see Emissions/signals.py).
+"""
+import math
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from Emissions import cache
+from Emissions.models import Site
+
+EARTH_RADIUS_KM = 6371.0088
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+class SiteIndex:
+    """
+    Uniform grid index of site coordinates, answering k-nearest and radius queries.
+
+    Parameters:
+    - codes (list of str), the site codes
+    - latitudes, longitudes (lists of float), the coordinates of each site, in degrees
+    - cell_km (float), the size of the grid cells in km
+    """
+
+    def __init__(self, codes, latitudes, longitudes, cell_km):
+        self.codes = list(codes)
+        self.cell_km = cell_km
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        # centre of the projection
+        self.lat0 = float(latitudes.mean()) if len(latitudes) else 0.0
+        self.lon0 = float(longitudes.mean()) if len(longitudes) else 0.0
+        self.x, self.y = self.project(latitudes, longitudes)
+
+        cells = {}
+        cols = np.floor(self.x / cell_km).astype(int)
+        rows = np.floor(self.y / cell_km).astype(int)
+        for i, cell in enumerate(zip(cols.tolist(), rows.tolist())):
+            cells.setdefault(cell, []).append(i)
+        self.cells = cells
+        if cells:
+            self.col_range = (int(cols.min()), int(cols.max()))
+            self.row_range = (int(rows.min()), int(rows.max()))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def project(self, lat, lon):
+        """
+        Project latitude/longitude (in degrees, as floats or arrays) onto the index's 
+        plane; returns (x, y) in km from the centre of the projection.
+        """
+        x = np.radians(np.subtract(lon, self.lon0)) * math.cos(math.radians(self.lat0)) * EARTH_RADIUS_KM
+        y = np.radians(np.subtract(lat, self.lat0)) * EARTH_RADIUS_KM
+        return x, y
+
+    def cell_of(self, x, y):
+        return math.floor(x / self.cell_km), math.floor(y / self.cell_km)
+
+    def candidates(self, cells):
+        """
+        Get the indices of the sites in the given grid cells, as one array.
+        """
+        members = []
+        for cell in cells:
+            members.extend(self.cells.get(cell, ()))
+        return np.array(members, dtype=int)
+
+    def results(self, x, y, candidates):
+        """
+        Get the (site code, distance in km) of each candidate, nearest first.
+        """
+        distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        order = np.argsort(distances, kind="stable")
+        return [(self.codes[i], d) for i, d in zip(candidates[order].tolist(), distances[order].tolist())]
+
+    def within(self, lat, lon, radius_km):
+        """
+        Get the sites within radius_km of a point.
+
+        Returns:
+        - a list of (site code, distance in km) tuples, nearest first
+        """
+        if not self.codes:
+            return []
+        x, y = self.project(lat, lon)
+        col_min, row_min = self.cell_of(x - radius_km, y - radius_km)
+        col_max, row_max = self.cell_of(x + radius_km, y + radius_km)
+        # no need to look beyond the occupied cells
+        col_min, col_max = max(col_min, self.col_range[0]), min(col_max, self.col_range[1])
+        row_min, row_max = max(row_min, self.row_range[0]), min(row_max, self.row_range[1])
+        cells = [(col, row) for col in range(col_min, col_max + 1) for row in range(row_min, row_max + 1)]
+        return [(code, d) for code, d in self.results(x, y, self.candidates(cells)) if d <= radius_km]
+
+    def nearest_indices(self, lat, lon, k=1):
+        """
+        Get the positions (in self.codes) and distances in km of the k sites nearest to a
+        point (or all of them, if there are fewer than k), nearest first.
+
+        The search works outwards from the point's cell, one ring of cells at a time;
+        any site outside the first n rings is at least n * cell_km away, so the search
+        stops once the k nearest sites found so far are all closer than that.
+
+        Returns:
+        - a tuple of two numpy arrays, (positions, distances)
+        """
+        if not self.codes or k < 1:
+            return np.empty(0, dtype=int), np.empty(0)
+        x, y = self.project(lat, lon)
+        col, row = self.cell_of(x, y)
+        # beyond this many rings, there are no more occupied cells
+        max_ring = max(abs(col - self.col_range[0]), abs(col - self.col_range[1]),
+                       abs(row - self.row_range[0]), abs(row - self.row_range[1]))
+        found = []
+        for ring in range(max_ring + 1):
+            if ring == 0:
+                cells = [(col, row)]
+            else:
+                cells = ([(col + dc, row + dr) for dc in range(-ring, ring + 1) for dr in (-ring, ring)] +
+                         [(col + dc, row + dr) for dc in (-ring, ring) for dr in range(-ring + 1, ring)])
+            for cell in cells:
+                found.extend(self.cells.get(cell, ()))
+            if len(found) >= k:
+                candidates = np.array(found)
+                distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+                if np.partition(distances, k - 1)[k - 1] <= ring * self.cell_km:
+                    break
+        else:
+            candidates = np.array(found)
+            distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        order = np.argsort(distances, kind="stable")[:k]
+        return candidates[order], distances[order]
+
+    def nearest(self, lat, lon, k=1):
+        """
+        Get the k sites nearest to a point (or all of them, if there are fewer than k).
+
+        Returns:
+        - a list of (site code, distance in km) tuples, nearest first
+        """
+        positions, distances = self.nearest_indices(lat, lon, k)
+        return [(self.codes[i], d) for i, d in zip(positions.tolist(), distances.tolist())]
+
+
+def build_site_index():
+    """
+    Build a SiteIndex of the active sites in the database.
+    """
+    sites = list(Site.objects.filter(site_still_active=True)
+                 .values_list('code', 'latitude', 'longitude'))
+    codes, latitudes, longitudes = zip(*sites) if sites else ([], [], [])
+    return SiteIndex(codes, latitudes, longitudes, settings.AIRQUALITY_SPATIAL_CELL_KM)
+
+
+def get_site_index():
+    """
+    Get this process's SiteIndex, (re)building it if the Site table has changed.
+    """
+    global _index, _index_version
+    version = cache.get_local_data_version('Site')
+    if _index is None or version != _index_version:
+        with _index_lock:
+            if _index is None or version != _index_version:
+                _index = build_site_index()
+                _index_version = version
+    return _index
+
+
+def nearest_sites(lat, lon, k=1):
+    """
+    Get the k active sites nearest to a point, as a list of (site code, distance in km)
+    tuples, nearest first.
+    """
+    return get_site_index().nearest(lat, lon, k)
+
+
+def sites_within(lat, lon, radius_km):
+    """
+    Get the active sites within radius_km of a point, as a list of (site code, distance
+    in km) tuples, nearest first.
+    """
+    return get_site_index().within(lat, lon, radius_km)
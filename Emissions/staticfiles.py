@@ -0,0 +1,94 @@
+"""
+Serve static files (js, css, imgs etc.) in front of Django, rather than from Django
+middleware. WhiteNoiseMiddleware only handles sync requests, so under ASGI having it in
+settings.MIDDLEWARE makes Django run every request (not just those for static files)
+through a thread. Instead AirQuality/asgi.py and AirQuality/wsgi.py wrap the Django
+application in ASGIStaticFiles or WSGIStaticFiles, which find and serve files the same
+way WhiteNoiseMiddleware would (configured by the WHITENOISE_* settings), and pass every
+other request on to Django.
+"""
+import wsgiref.util
+
+from asgiref.sync import sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+# bytes of a static file sent per ASGI message
+CHUNK_SIZE = 64 * 1024
+
+
+def find_static_file(whitenoise, path):
+    """
+    Get WhiteNoise's StaticFile for a URL path, or None if it isn't a static file.
+
+    Parameters:
+    - whitenoise, a WhiteNoiseMiddleware
+    - path (str), the URL path (e.g. '/static/js/map.js')
+    """
+    if whitenoise.autorefresh:
+        return whitenoise.find_file(path)
+    return whitenoise.files.get(path)
+
+
+class WSGIStaticFiles:
+    """
+    WSGI application that serves static files, and passes other requests on to
+    application (the Django WSGI application).
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.whitenoise = WhiteNoiseMiddleware()
+
+    def __call__(self, environ, start_response):
+        static_file = find_static_file(self.whitenoise, environ.get("PATH_INFO", ""))
+        if static_file is None:
+            return self.application(environ, start_response)
+        response = static_file.get_response(environ["REQUEST_METHOD"], environ)
+        start_response(f"{response.status.value} {response.status.phrase}", list(response.headers))
+        if response.file is None:
+            return []
+        return wsgiref.util.FileWrapper(response.file)
+
+
+class ASGIStaticFiles:
+    """
+    ASGI application that serves static files without leaving the event loop (apart from
+    reading them, which is done in a thread), and passes other requests on to
+    application (the Django ASGI application).
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.whitenoise = WhiteNoiseMiddleware()
+
+    async def __call__(self, scope, receive, send):
+        static_file = None
+        if scope["type"] == "http":
+            static_file = find_static_file(self.whitenoise, scope["path"])
+        if static_file is None:
+            await self.application(scope, receive, send)
+        else:
+            await self.serve(static_file, scope, send)
+
+    async def serve(self, static_file, scope, send):
+        # WhiteNoise reads the request headers from a WSGI environ
+        environ = {"HTTP_" + name.decode("latin-1").upper().replace("-", "_"): value.decode("latin-1")
+                   for name, value in scope["headers"]}
+        response = static_file.get_response(scope["method"], environ)
+        await send({"type": "http.response.start", "status": int(response.status),
+                    "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                for name, value in response.headers]})
+        if response.file is None:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        read = sync_to_async(response.file.read, thread_sensitive=False)
+        try:
+            chunk = await read(CHUNK_SIZE)
+            while True:
+                next_chunk = await read(CHUNK_SIZE) if chunk else b""
+                await send({"type": "http.response.body", "body": chunk, "more_body": bool(next_chunk)})
+                if not next_chunk:
+                    break
+                chunk = next_chunk
+        finally:
+            response.file.close()
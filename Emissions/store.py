@@ -0,0 +1,530 @@
+"""
+Local store of the data provided by the LondonAir API.
+
+Three kinds of data are stored:
+- Snapshots of the hourly MonitoringIndex for a group of sites (i.e. the current 
+  emissions shown on the map); a new Snapshot is only stored when the API data changes.
+- Hourly Readings for each site. These are ingested incrementally: each Site has a 
+  ReadingHighWaterMark (the timestamp of its latest stored Reading), and each 
+  ingestion run only asks the API for readings from that day onwards.
+- ReadingAggregates (hourly and daily mean / max / count) of the readings per local 
+  authority and across London. After each ingestion run, the aggregates for the days
+  (and local authorities) that received new readings are recalculated.
+
+The ingest_* functions are run by the ingest_airquality management command; the 
+get_* functions are used by the views, so that web requests (almost) never call the API.
+The exception is get_site_day_readings (and its async version, aget_site_day_readings), 
+which falls back to the API for site days that haven't been ingested; concurrent requests
+for the same site day share one API call.
+"""
+import datetime as dt
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Q
+from django.db.models.functions import TruncDay, TruncHour
+
+from Emissions import cache, metrics
+from Emissions.breaker import CircuitBreaker
+from Emissions.singleflight import AsyncSingleFlight, SingleFlight
+from Emissions.models import (Reading, ReadingAggregate, ReadingHighWaterMark, Site, 
+                              Snapshot, Species)
+from Emissions.services import GROUP_INDEX_URL, AirQualityApiData, datetime_obj_to_str
+
+# format of '@MeasurementDateGMT' in the API data
+MEASUREMENT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# format of dates in the API URLs, e.g. 01Jan2019
+API_DATE_FORMAT = '%d%b%Y'
+
+# coalesces concurrent loads of the same site day (see get_site_day_readings)
+_site_day_flights = SingleFlight()
+_async_site_day_flights = AsyncSingleFlight()
+# the time the latest Snapshot of each group was fetched, as last read by this process:
+# group name -> (version of the Snapshots, fetched_at)
+_latest_fetched_at = {}
+
+
+def payload_hash(data):
+    """
+    Get a SHA-256 hash of a JSON structure, e.g. as returned by the API.
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def ingest_snapshot(group_name="London", api=None, now=None):
+    """
+    Get the hourly MonitoringIndex for a group from the API, and store it as a new 
+    Snapshot if its emissions have changed since the latest one. Snapshots older than 
+    settings.AIRQUALITY_SNAPSHOT_RETENTION_DAYS are deleted.
+
+    Parameters:
+    - group_name (str), the name of the group of sites. Optional, default "London"
+    - api (AirQualityApiData), the API object to use. Optional
+    - now (python datetime object), the current time. Optional
+
+    Returns:
+    - the new Snapshot, or None if the API data hasn't changed (or the request failed)
+    """
+    api = api or AirQualityApiData()
+    now = now or dt.datetime.now(dt.timezone.utc)
+    data = api.get_data_from_API(GROUP_INDEX_URL.format(group_name=group_name))
+    if data is None:
+        return None
+
+    # the parsed rows are about half the size of the payload, so they're quicker to hash;
+    # changes to fields that aren't stored don't make a new Snapshot either
+    emissions = api.process_group_emissions(data, 'HourlyAirQualityIndex', 'LocalAuthority')
+    new_hash = payload_hash(emissions)
+    latest = Snapshot.objects.filter(group_name=group_name).order_by('-fetched_at').first()
+    if latest is not None and latest.payload_hash == new_hash:
+        return None
+
+    snapshot = Snapshot.objects.create(group_name=group_name, fetched_at=now, 
+                                       payload_hash=new_hash, data=emissions)
+    cache.set_snapshot(group_name, emissions)
+    cache.bump_data_version('Snapshot')
+    retention = now - dt.timedelta(days=settings.AIRQUALITY_SNAPSHOT_RETENTION_DAYS)
+    Snapshot.objects.filter(group_name=group_name, fetched_at__lt=retention).delete()
+    return snapshot
+
+
+def get_current_emissions(group_name="London"):
+    """
+    Get the current emissions values for all sites in a group, in the same format as
+    AirQualityApiData.get_current_emissions_across_london, from the cache or the latest 
+    stored Snapshot. Never calls the API.
+
+    Returns:
+    - a list of dicts, one per site; or None if no Snapshot has been stored yet
+    """
+    emissions = cache.get_snapshot(group_name)
+    if emissions is None:
+        snapshot = Snapshot.objects.filter(group_name=group_name).order_by('-fetched_at').first()
+        if snapshot is None:
+            return None
+        emissions = snapshot.data
+        cache.set_snapshot(group_name, emissions)
+    return emissions
+
+
+def get_latest_snapshot_time(group_name="London"):
+    """
+    Get the time that the latest Snapshot for a group was fetched, or None if there isn't
+    one. The database is only queried when the Snapshots' data version changes (see 
+    cache.get_local_data_versions).
+    """
+    version = cache.get_local_data_version('Snapshot')
+    entry = _latest_fetched_at.get(group_name)
+    if entry is None or entry[0] != version:
+        fetched_at = (Snapshot.objects.filter(group_name=group_name).order_by('-fetched_at')
+                      .values_list('fetched_at', flat=True).first())
+        _latest_fetched_at[group_name] = entry = (version, fetched_at)
+    return entry[1]
+
+
+def current_emissions_are_stale(group_name="London", now=None):
+    """
+    Whether the current emissions for a group (see get_current_emissions) are stale: the
+    latest Snapshot was fetched more than settings.AIRQUALITY_STALE_AFTER seconds ago 
+    (e.g. the ingest worker has stopped, or the API has been down), or the circuit breaker
+    for the API's group index is open, so it can't be refreshed. False if there are no 
+    Snapshots at all.
+    """
+    fetched_at = get_latest_snapshot_time(group_name)
+    if fetched_at is None:
+        return False
+    now = now or dt.datetime.now(dt.timezone.utc)
+    if (now - fetched_at).total_seconds() > settings.AIRQUALITY_STALE_AFTER:
+        return True
+    # this is checked on every request for the index page, so the breaker's state is 
+    # only re-read from the shared cache every few seconds
+    return CircuitBreaker().is_open(GROUP_INDEX_URL.format(group_name=group_name), local=True)
+
+
+def get_current_emissions_with_status(group_name="London", now=None):
+    """
+    Get the current emissions for a group, and whether they are stale; the views and the
+    ingest worker use this, so that they agree on what's stale. Never calls the API.
+
+    Returns:
+    - a tuple (emissions, stale): emissions as returned by get_current_emissions, and 
+    stale (bool) as returned by current_emissions_are_stale
+    """
+    emissions = get_current_emissions(group_name)
+    return emissions, emissions is not None and current_emissions_are_stale(group_name, now)
+
+
+def parse_measurement_date(date_str):
+    """
+    Convert a '@MeasurementDateGMT' string from the API to a (UTC) datetime object.
+    """
+    return dt.datetime.strptime(date_str, MEASUREMENT_DATE_FORMAT).replace(tzinfo=dt.timezone.utc)
+
+
+def site_readings_url(site_code, start, end):
+    """
+    Get the API URL for the hourly readings at a site between two datetimes.
+    """
+    return (f"/Data/Site/SiteCode={site_code}/StartDate={datetime_obj_to_str(start)}"
+            f"/EndDate={datetime_obj_to_str(end)}/Json")
+
+
+def parse_site_readings(data):
+    """
+    Get the (species code, timestamp, value) of each reading in the JSON returned from
+    the /Data/Site endpoint. Readings with no value are skipped.
+    """
+    records = data['AirQualityData'].get('Data', [])
+    # a single reading is returned as a dict rather than a list
+    if isinstance(records, dict):
+        records = [records]
+    return [(record['@SpeciesCode'], parse_measurement_date(record['@MeasurementDateGMT']),
+             float(record['@Value']))
+            for record in records if record['@Value'] != '']
+
+
+def store_site_readings(site, readings, species_ids):
+    """
+    Bulk-upsert readings for a site and advance its high-water mark. Readings that are
+    already stored get the new value, so revisions from the API (e.g. after ratification)
+    replace the provisional values.
+
+    Parameters:
+    - site (Site), the site the readings are from
+    - readings (list of tuples), (species code, timestamp, value) for each reading
+    - species_ids (dict), mapping of species code to Species id. Readings for species
+    that aren't in the database are skipped.
+
+    Returns:
+    - int, the number of readings passed to the database
+    """
+    # one reading per (species, timestamp), as a row can't be upserted twice in one query
+    values = {(species_ids[code], timestamp): value
+              for code, timestamp, value in readings if code in species_ids}
+    objs = [Reading(site_id=site.pk, species_id=species_id, timestamp=timestamp, value=value)
+            for (species_id, timestamp), value in values.items()]
+    if not objs:
+        return 0
+    latest = max(obj.timestamp for obj in objs)
+    with transaction.atomic():
+        Reading.objects.bulk_create(objs, batch_size=1000, update_conflicts=True,
+                                    unique_fields=['site', 'species', 'timestamp'],
+                                    update_fields=['value'])
+        mark, created = ReadingHighWaterMark.objects.get_or_create(site=site, defaults={'timestamp': latest})
+        if not created and mark.timestamp < latest:
+            mark.timestamp = latest
+            mark.save(update_fields=['timestamp'])
+    return len(objs)
+
+
+def ingest_readings(sites=None, api=None, now=None):
+    """
+    Get new hourly readings from the API for each site and add them to the database.
+
+    For each site, readings are requested from the day of its high-water mark (so that
+    late-arriving readings for that day are picked up), or from
+    settings.AIRQUALITY_INGEST_BACKFILL_DAYS ago if nothing has been stored yet. The
+    requests for each site are made concurrently.
+
+    Parameters:
+    - sites (iterable of Site), the sites to ingest. Optional; default is all active sites
+    - api (AirQualityApiData), the API object to use. Optional
+    - now (python datetime object), the current time. Optional
+
+    Returns:
+    - dict, mapping each site code to the number of readings stored (0 if the API data 
+    is unchanged since the last run), or None if the API request for that site failed
+    """
+    if sites is None:
+        sites = Site.objects.filter(site_still_active=True)
+    sites = list(sites)
+    api = api or AirQualityApiData()
+    now = now or dt.datetime.now(dt.timezone.utc)
+
+    marks = dict(ReadingHighWaterMark.objects.filter(site__in=sites).values_list('site_id', 'timestamp'))
+    backfill_start = now - dt.timedelta(days=settings.AIRQUALITY_INGEST_BACKFILL_DAYS)
+    end = now + dt.timedelta(days=1)
+    urls = [site_readings_url(site.code, marks.get(site.pk, backfill_start), end) for site in sites]
+
+    species_ids = dict(Species.objects.values_list('code', 'id'))
+    stored = {}
+    # the local authorities and days that have new readings
+    changed_local_auths, changed_days = set(), set()
+    for site, data in zip(sites, api.get_many_from_API(urls)):
+        if data is None:
+            stored[site.code] = None
+            continue
+        # skip parsing and writing if the payload is the same as last time
+        new_hash = payload_hash(data)
+        if cache.get_readings_hash(site.code) == new_hash:
+            stored[site.code] = 0
+            continue
+        with metrics.PARSE_SECONDS.labels("site_readings").time():
+            readings = parse_site_readings(data)
+        stored[site.code] = store_site_readings(site, readings, species_ids)
+        cache.set_readings_hash(site.code, new_hash)
+        if stored[site.code]:
+            changed_local_auths.add(site.local_auth_id)
+            changed_days.update(timestamp.date() for _, timestamp, _ in readings)
+    if any(stored.values()):
+        update_aggregates(changed_local_auths, changed_days)
+        # anything built from the latest readings (e.g. the nowcast) is now out of date
+        cache.bump_data_version('Reading')
+    return stored
+
+
+def aggregate_readings(readings, trunc, by_local_auth):
+    """
+    Get the mean, max and count of readings per species and hour / day.
+
+    Parameters:
+    - readings (Reading queryset), the readings to aggregate
+    - trunc (TruncHour or TruncDay), the length of the periods to aggregate over
+    - by_local_auth (bool), whether to aggregate each local authority separately
+
+    Returns:
+    - a queryset of dicts, with keys 'species', 'period_start', 'mean', 'max', 'count' 
+    (and 'site__local_auth' if by_local_auth)
+    """
+    group_by = ['species', 'period_start'] + (['site__local_auth'] if by_local_auth else [])
+    return (readings
+            .annotate(period_start=trunc('timestamp', tzinfo=dt.timezone.utc))
+            .values(*group_by)
+            .annotate(mean=Avg('value'), max=Max('value'), count=Count('id'))
+            .order_by())
+
+
+def update_aggregates(local_auth_ids, days):
+    """
+    Recalculate the hourly and daily ReadingAggregates of some local authorities, and of 
+    London as a whole, over some days; the old aggregates for those days are replaced.
+
+    Parameters:
+    - local_auth_ids (iterable of int), the ids of the local authorities
+    - days (iterable of python date objects), the (UTC) days
+
+    Returns:
+    - int, the number of aggregates stored
+    """
+    local_auth_ids = list(local_auth_ids)
+    periods = [(ReadingAggregate.HOUR, TruncHour), (ReadingAggregate.DAY, TruncDay)]
+    aggregates = []
+    with transaction.atomic():
+        for day in sorted(days):
+            start = dt.datetime(day.year, day.month, day.day, tzinfo=dt.timezone.utc)
+            end = start + dt.timedelta(days=1)
+            (ReadingAggregate.objects
+             .filter(period_start__gte=start, period_start__lt=end)
+             .filter(Q(local_auth__in=local_auth_ids) | Q(local_auth__isnull=True))
+             .delete())
+            day_readings = Reading.objects.filter(timestamp__gte=start, timestamp__lt=end)
+            la_readings = day_readings.filter(site__local_auth__in=local_auth_ids)
+            for period, trunc in periods:
+                for row in aggregate_readings(la_readings, trunc, by_local_auth=True):
+                    aggregates.append(ReadingAggregate(
+                        local_auth_id=row['site__local_auth'], species_id=row['species'], 
+                        period=period, period_start=row['period_start'], mean=row['mean'], 
+                        max=row['max'], count=row['count']))
+                # London-wide aggregates are over the readings of every local authority
+                for row in aggregate_readings(day_readings, trunc, by_local_auth=False):
+                    aggregates.append(ReadingAggregate(
+                        local_auth_id=None, species_id=row['species'], period=period, 
+                        period_start=row['period_start'], mean=row['mean'], max=row['max'], 
+                        count=row['count']))
+        ReadingAggregate.objects.bulk_create(aggregates, batch_size=1000)
+    return len(aggregates)
+
+
+def rebuild_aggregates():
+    """
+    Recalculate every ReadingAggregate from all of the stored readings, e.g. after 
+    readings have been loaded some other way.
+
+    Returns:
+    - int, the number of aggregates stored
+    """
+    days = {timestamp.date() for timestamp in
+            Reading.objects.datetimes('timestamp', 'day', tzinfo=dt.timezone.utc)}
+    ReadingAggregate.objects.all().delete()
+    return update_aggregates(Site.objects.values_list('local_auth_id', flat=True).distinct(), days)
+
+
+def get_aggregates(species_code, period, start, end, local_auth_name=None):
+    """
+    Get the stored aggregates of a species for a local authority (or London as a whole) 
+    over a time window, from a single indexed query.
+
+    Parameters:
+    - species_code (str), e.g. 'NO2'
+    - period (str), ReadingAggregate.HOUR or ReadingAggregate.DAY
+    - start, end (python datetime objects), the time window; start is inclusive, end is
+    exclusive
+    - local_auth_name (str), the name of the local authority. Optional; default is None,
+    i.e. London as a whole
+
+    Returns:
+    - a list of dicts, in time order, with keys 'period_start', 'mean', 'max' and 'count'
+    """
+    aggregates = ReadingAggregate.objects.filter(species__code=species_code, period=period,
+                                                 period_start__gte=start, period_start__lt=end)
+    if local_auth_name is None:
+        aggregates = aggregates.filter(local_auth__isnull=True)
+    else:
+        aggregates = aggregates.filter(local_auth__name=local_auth_name)
+    return list(aggregates.order_by('period_start')
+                .values('period_start', 'mean', 'max', 'count'))
+
+
+def get_area_aggregates(period, period_start):
+    """
+    Get the stored aggregates of every species, for every local authority and for London 
+    as a whole, for a single hour or day; e.g. to colour a map of the boroughs.
+
+    Returns:
+    - a dict of form {<local authority name, or 'London'>: {<species code>: 
+    {'mean': float, 'max': float, 'count': int}, ...}, ...}
+    """
+    aggregates = (ReadingAggregate.objects
+                  .filter(period=period, period_start=period_start)
+                  .values_list('local_auth__name', 'species__code', 'mean', 'max', 'count'))
+    areas = {}
+    for area, species_code, mean, max_value, count in aggregates:
+        areas.setdefault(area or 'London', {})[species_code] = {
+            'mean': mean, 'max': max_value, 'count': count}
+    return areas
+
+
+def get_site_readings_between(site_code, start_date, end_date):
+    """
+    Get the stored hourly readings for a site over a time window, in the same format as
+    AirQualityApiData.get_hourly_site_readings_between.
+
+    Parameters:
+    - site_code (str), the code of the site, e.g. 'TDO'
+    - start_date (str), the start of the window (inclusive), format DDMonYYYY
+    - end_date (str), the end of the window (exclusive), format DDMonYYYY
+
+    Returns:
+    - a list of dicts, one per timestamp in time order, of form
+    {'MeasurementDate': 'YYYY-MM-DD HH:MM:SS', <species code>: value, ...}
+    """
+    start = dt.datetime.strptime(start_date, API_DATE_FORMAT).replace(tzinfo=dt.timezone.utc)
+    end = dt.datetime.strptime(end_date, API_DATE_FORMAT).replace(tzinfo=dt.timezone.utc)
+    readings = (Reading.objects
+                .filter(site__code=site_code, timestamp__gte=start, timestamp__lt=end)
+                .order_by('timestamp')
+                .values_list('timestamp', 'species__code', 'value'))
+    rows = {}
+    for timestamp, code, value in readings:
+        date_str = timestamp.astimezone(dt.timezone.utc).strftime(MEASUREMENT_DATE_FORMAT)
+        rows.setdefault(date_str, {'MeasurementDate': date_str})[code] = value
+    return list(rows.values())
+
+
+def pivot_site_day(rows, day):
+    """
+    Pivot a site's hourly readings on a day into one array per species.
+
+    Parameters:
+    - rows (list of dicts), as returned by get_site_readings_between
+    - day (python date object), the day; rows from other days are ignored
+
+    Returns:
+    - a dict mapping each species code to a list of 24 values, one per hour (UTC) from
+    00:00, with None for hours with no reading
+    """
+    prefix = day.isoformat()
+    species = {}
+    for row in rows:
+        if not row['MeasurementDate'].startswith(prefix):
+            continue
+        hour = int(row['MeasurementDate'][11:13])
+        for code, value in row.items():
+            if code != 'MeasurementDate':
+                species.setdefault(code, [None] * 24)[hour] = value
+    return species
+
+
+def load_site_day(site_code, day, api=None):
+    """
+    Get a site's readings on a day from the store or, if none are stored (e.g. the site
+    isn't ingested, or the day is before the backfill), from the API.
+
+    Returns:
+    - the pivoted readings (see pivot_site_day), or None if the API request failed
+    """
+    start, end = day.strftime(API_DATE_FORMAT), (day + dt.timedelta(days=1)).strftime(API_DATE_FORMAT)
+    rows = get_site_readings_between(site_code, start, end)
+    if not rows:
+        rows = (api or AirQualityApiData()).get_hourly_site_readings_between(site_code, start, end)
+        if rows is None:
+            return None
+    return pivot_site_day(rows, day)
+
+
+def get_site_day_readings(site_code, day, api=None):
+    """
+    Get a site's hourly readings of each species on a day (as shown in the site charts),
+    from the cache, the store or the API, in that order. Results are cached per version
+    of the Reading table, so each ingestion run invalidates them; and concurrent requests
+    for the same site day in this process share a single load.
+
+    Parameters:
+    - site_code (str), the code of the site, e.g. 'TDO'
+    - day (python date object), the (UTC) day
+    - api (AirQualityApiData), the API object to use. Optional
+
+    Returns:
+    - a dict mapping each species code to a list of 24 hourly values (see 
+    pivot_site_day); or None if the readings aren't stored and the API request failed
+    """
+    version = cache.get_data_version('Reading')
+    species = cache.get_site_day(site_code, day, version)
+    if species is not None:
+        return species
+
+    def load():
+        # another request may have loaded it while this one was waiting for the lock
+        species = cache.get_site_day(site_code, day, version)
+        if species is None:
+            species = load_site_day(site_code, day, api)
+            if species is not None:
+                cache.set_site_day(site_code, day, version, species)
+        return species
+    return _site_day_flights.do((site_code, day, version), load)
+
+
+async def aload_site_day(site_code, day, api=None):
+    """
+    Async version of load_site_day.
+    """
+    start, end = day.strftime(API_DATE_FORMAT), (day + dt.timedelta(days=1)).strftime(API_DATE_FORMAT)
+    rows = await sync_to_async(get_site_readings_between)(site_code, start, end)
+    if not rows:
+        rows = await (api or AirQualityApiData()).aget_hourly_site_readings_between(site_code, start, end)
+        if rows is None:
+            return None
+    return pivot_site_day(rows, day)
+
+
+async def aget_site_day_readings(site_code, day, api=None):
+    """
+    Async version of get_site_day_readings, for async views: loading the readings from
+    the API doesn't block the event loop.
+    """
+    version = await sync_to_async(cache.get_data_version)('Reading')
+    species = await sync_to_async(cache.get_site_day)(site_code, day, version)
+    if species is not None:
+        return species
+
+    async def load():
+        species = await sync_to_async(cache.get_site_day)(site_code, day, version)
+        if species is None:
+            species = await aload_site_day(site_code, day, api)
+            if species is not None:
+                await sync_to_async(cache.set_site_day)(site_code, day, version, species)
+        return species
+    return await _async_site_day_flights.do((site_code, day, version), load)
@@ -0,0 +1,79 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache as django_cache
+from django.utils.http import http_date
+
+import datetime as dt
+
+from Emissions import cache
+from Emissions.breaker import CircuitBreaker
+from Emissions.models import LocalAuthority, Snapshot
+from Emissions.services import GROUP_INDEX_URL
+from Emissions.tests.test_cache import LOCMEM_CACHE
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConditionalApiTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.local_auth = LocalAuthority.objects.create(name="Camden", code=5, latitude=51.55,
+                                                            longitude=-0.15)
+
+    def test_etag_and_last_modified(self):
+        response = self.client.get("/api/local-authorities")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["name"], "Camden")
+        self.assertEqual(response["ETag"], f'"{cache.get_data_version("LocalAuthority")}"')
+        self.assertEqual(response["Last-Modified"], http_date(cache.get_data_modified("LocalAuthority").timestamp()))
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_if_none_match(self):
+        etag = self.client.get("/api/local-authorities")["ETag"]
+        response = self.client.get("/api/local-authorities", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get("/api/local-authorities")["Last-Modified"]
+        response = self.client.get("/api/local-authorities", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_change_invalidates_etag(self):
+        etag = self.client.get("/api/local-authorities")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            LocalAuthority.objects.create(name="Hackney", code=12, latitude=51.55, longitude=-0.06)
+        response = self.client.get("/api/local-authorities", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_snapshot(self):
+        self.assertEqual(self.client.get("/api/snapshot").status_code, 503)
+        data = [{"site_code": "ABC", "Nitrogen Dioxide": 3.0}]
+        Snapshot.objects.create(fetched_at=dt.datetime.now(dt.timezone.utc), payload_hash="x", data=data)
+        cache.bump_data_version('Snapshot')
+        response = self.client.get("/api/snapshot")
+        self.assertEqual(response.json(), data)
+        self.assertEqual(self.client.get("/api/snapshot", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+    def test_snapshot_revalidated_once_stale(self):
+        Snapshot.objects.create(fetched_at=dt.datetime.now(dt.timezone.utc), payload_hash="x", data=[])
+        cache.bump_data_version('Snapshot')
+        fresh = self.client.get("/api/snapshot")
+        self.assertFalse(fresh.has_header("Warning"))
+        # the group index's breaker opens, without the data changing
+        self.addCleanup(cache.clear_local_data_versions)
+        CircuitBreaker(failure_threshold=1).record_failure(GROUP_INDEX_URL.format(group_name="London"))
+        for headers in [{"HTTP_IF_NONE_MATCH": fresh["ETag"]}, 
+                        {"HTTP_IF_MODIFIED_SINCE": fresh["Last-Modified"]}]:
+            response = self.client.get("/api/snapshot", **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("110", response["Warning"])
+            self.assertNotEqual(response["ETag"], fresh["ETag"])
+        # while it's still stale, the stale response can be revalidated
+        self.assertEqual(self.client.get("/api/snapshot", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+    def test_only_get(self):
+        self.assertEqual(self.client.post("/api/sites").status_code, 405)
@@ -0,0 +1,134 @@
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import cache as django_cache
+from unittest import mock
+
+import asyncio
+import httpx
+import requests
+
+from Emissions.async_client import AsyncApiClient
+from Emissions.breaker import CircuitBreaker, CircuitOpenError
+from Emissions.models import LocalAuthority, Site
+from Emissions.services import AirQualityApiData
+from Emissions.singleflight import AsyncSingleFlight
+from Emissions.tests.test_cache import LOCMEM_CACHE
+
+
+def make_client(handler, **kwargs):
+    return AsyncApiClient(base_url="https://example.com/AirQuality", proxy="", max_retries=2,
+                          backoff=0, transport=httpx.MockTransport(handler), **kwargs)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AsyncApiClientTest(SimpleTestCase):
+
+    def setUp(self):
+        django_cache.clear()
+
+    async def test_get_json(self):
+        requested = []
+
+        def handler(request):
+            requested.append(str(request.url))
+            return httpx.Response(200, json={"a": 1})
+        self.assertEqual(await make_client(handler).get_json("/Json"), {"a": 1})
+        self.assertEqual(requested, ["https://example.com/AirQuality/Json"])
+
+    async def test_retries_server_errors(self):
+        statuses = [503, 502, 200]
+
+        def handler(request):
+            return httpx.Response(statuses.pop(0), json={"a": 1})
+        self.assertEqual(await make_client(handler).get_json("/Json"), {"a": 1})
+        self.assertEqual(statuses, [])
+
+    async def test_connection_errors_raise_requests_exceptions(self):
+        attempts = []
+
+        def handler(request):
+            attempts.append(request)
+            raise httpx.ConnectError("refused", request=request)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            await make_client(handler).get_json("/Json")
+        self.assertEqual(len(attempts), 3)
+
+    async def test_open_breaker_stops_requests(self):
+        handler = mock.Mock(side_effect=lambda request: httpx.Response(500))
+        client = make_client(handler, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        self.assertIsNone(await client.get_json("/Json"))
+        with self.assertRaises(CircuitOpenError):
+            await client.get_json("/Json")
+        self.assertEqual(handler.call_count, 3)
+
+
+class AsyncSingleFlightTest(SimpleTestCase):
+
+    async def test_concurrent_calls_share_one_call(self):
+        flight, calls = AsyncSingleFlight(), []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(8)))
+        self.assertEqual(results, ["result"] * 8)
+        self.assertEqual(len(calls), 1)
+        # the next call starts a new flight
+        await flight.do("key", work)
+        self.assertEqual(len(calls), 2)
+
+    async def test_errors_are_shared(self):
+        flight = AsyncSingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+        results = await asyncio.gather(*(flight.do("key", fail) for _ in range(3)),
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AsyncApiDataTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        self.requests = []
+
+    def handler(self, request):
+        self.requests.append(str(request.url))
+        return httpx.Response(200, json={"AirQualityData": {"Data": [
+            {"@SpeciesCode": "NO2", "@MeasurementDateGMT": "2019-05-02 01:00:00", "@Value": "12"},
+            {"@SpeciesCode": "NO2", "@MeasurementDateGMT": "2019-05-02 02:00:00", "@Value": ""}]}})
+
+    def patch_client(self):
+        return mock.patch("Emissions.services.get_async_client",
+                          side_effect=lambda: make_client(self.handler))
+
+    async def test_concurrent_requests_are_coalesced(self):
+        api = AirQualityApiData()
+        with self.patch_client():
+            results = await asyncio.gather(*(api.aget_data_from_API("/Json") for _ in range(5)))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(results[0], results[4])
+
+    async def test_cut_short_readings_are_requested_again(self):
+        responses = [httpx.Response(200, text='{"AirQualityData": {"Data": [')]
+        handler = self.handler
+        self.handler = mock.Mock(side_effect=lambda request: responses.pop(0) if responses else handler(request))
+        with self.patch_client(), self.assertLogs("Emissions.services", "WARNING"):
+            rows = await AirQualityApiData().aget_site_readings_window("ABC", "02May2019", "03May2019")
+        self.assertEqual(rows, [("2019-05-02 01:00:00", {"NO2": 12.0}), ("2019-05-02 02:00:00", {"NO2": None})])
+        self.assertEqual(self.handler.call_count, 2)
+
+    def test_site_readings_endpoint_falls_back_to_api(self):
+        la = LocalAuthority.objects.create(name="My local auth", code=1, latitude=51.5, longitude=-0.1)
+        Site.objects.create(name="name of site", code="ABC", local_auth=la, latitude=51.5,
+                            longitude=-0.1, site_still_active=True)
+        with self.patch_client():
+            response = self.client.get("/api/sites/ABC/readings", {"date": "2019-05-02"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["species"]["NO2"][:3], [None, 12.0, None])
+        self.assertEqual(self.requests, [
+            "https://example.com/AirQuality/Data/Site/SiteCode=ABC/StartDate=02May2019/EndDate=03May2019/Json"])
+        self.assertEqual(self.client.post("/api/sites/ABC/readings").status_code, 405)
@@ -0,0 +1,101 @@
+from django.test import SimpleTestCase, TestCase
+
+import json
+import random
+
+from Emissions import boroughs
+from Emissions.boroughs import BoroughIndex
+from Emissions.models import LocalAuthority
+
+
+def square(min_lon, min_lat, size):
+    return [[min_lon, min_lat], [min_lon + size, min_lat], [min_lon + size, min_lat + size],
+            [min_lon, min_lat + size], [min_lon, min_lat]]
+
+
+# two neighbouring boroughs, one of which has a hole, and a borough in two parts
+GEOJSON = {"type": "FeatureCollection", "features": [
+    {"type": "Feature", "properties": {"name": "Camden"},
+     "geometry": {"type": "Polygon", "coordinates": [square(-0.2, 51.5, 0.1)]}},
+    {"type": "Feature", "properties": {"name": "Kingston"},
+     "geometry": {"type": "Polygon",
+                  "coordinates": [square(-0.1, 51.5, 0.1), square(-0.07, 51.53, 0.04)]}},
+    {"type": "Feature", "properties": {"name": "Hammersmith & Fulham"},
+     "geometry": {"type": "MultiPolygon",
+                  "coordinates": [[square(-0.06, 51.54, 0.02)], [square(0.1, 51.5, 0.05)]]}},
+]}
+
+
+class BoroughIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = BoroughIndex(GEOJSON)
+
+    def test_find(self):
+        self.assertEqual(self.index.find(51.55, -0.15), "Camden")
+        self.assertEqual(self.index.find(51.51, -0.05), "Kingston")
+        self.assertEqual(self.index.find(51.52, 0.12), "Hammersmith & Fulham")
+        self.assertIsNone(self.index.find(51.45, -0.15))
+        self.assertIsNone(self.index.find(48.85, 2.35))
+
+    def test_find_in_hole(self):
+        # in the hole in Kingston, but not the part of Hammersmith & Fulham inside it
+        self.assertIsNone(self.index.find(51.535, -0.065))
+        self.assertEqual(self.index.find(51.55, -0.05), "Hammersmith & Fulham")
+
+    def test_find_many_matches_find(self):
+        rng = random.Random(0)
+        lats = [51.45 + rng.random() * 0.2 for _ in range(500)]
+        lons = [-0.25 + rng.random() * 0.45 for _ in range(500)]
+        self.assertEqual(self.index.find_many(lats, lons),
+                         [self.index.find(lat, lon) for lat, lon in zip(lats, lons)])
+        self.assertEqual(self.index.find_many([], []), [])
+
+
+class BoroughLookupTest(TestCase):
+
+    def setUp(self):
+        self.saved_index = boroughs._index
+        boroughs._index = BoroughIndex(GEOJSON)
+        self.camden = LocalAuthority.objects.create(name="Camden", code=5, latitude=51.55, longitude=-0.15)
+        self.kingston = LocalAuthority.objects.create(name="Kingston upon Thames", code=19,
+                                                      latitude=51.4, longitude=-0.3)
+        self.hammersmith = LocalAuthority.objects.create(name="Hammersmith and Fulham", code=13,
+                                                         latitude=51.49, longitude=-0.22)
+
+    def tearDown(self):
+        boroughs._index = self.saved_index
+
+    def test_match_local_authorities(self):
+        matches = boroughs.match_local_authorities(["Camden", "Kingston", "Hammersmith & Fulham",
+                                                    "Atlantis", None])
+        self.assertEqual(matches, {"Camden": self.camden, "Kingston": self.kingston,
+                                   "Hammersmith & Fulham": self.hammersmith, "Atlantis": None})
+
+    def test_find_borough(self):
+        self.assertEqual(boroughs.find_borough(51.51, -0.05), ("Kingston", self.kingston))
+        self.assertIsNone(boroughs.find_borough(48.85, 2.35))
+        self.assertEqual(boroughs.find_boroughs([51.55, 48.85], [-0.15, 2.35]),
+                         [("Camden", self.camden), None])
+
+    def test_get(self):
+        response = self.client.get("/api/borough", {"lat": 51.55, "lon": -0.15})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"borough": "Camden",
+                                           "local_authority": {"id": self.camden.id, "name": "Camden",
+                                                               "code": 5}})
+        response = self.client.get("/api/borough", {"lat": 48.85, "lon": 2.35})
+        self.assertEqual(response.json(), {"borough": None, "local_authority": None})
+        self.assertEqual(self.client.get("/api/borough", {"lat": "x", "lon": 0}).status_code, 400)
+        self.assertEqual(self.client.get("/api/borough").status_code, 400)
+
+    def test_post(self):
+        response = self.client.post("/api/borough", json.dumps({"points": [[51.52, 0.12], [48.85, 2.35]]}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["boroughs"], ["Hammersmith & Fulham", None])
+        self.assertEqual(response.json()["local_authorities"][0]["id"], self.hammersmith.id)
+        self.assertIsNone(response.json()["local_authorities"][1])
+        response = self.client.post("/api/borough", json.dumps({"points": [[51.5]]}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,107 @@
+from django.test import SimpleTestCase, override_settings
+from django.core.management import call_command
+
+import gzip
+import json
+import os
+import tempfile
+from io import StringIO
+
+import numpy as np
+
+from Emissions import boundaries
+
+
+def square(lon, lat, size, points_per_side=50):
+    """A closed square ring with many (collinear) points along each side."""
+    steps = np.linspace(0, size, points_per_side, endpoint=False)
+    sides = ([(lon + s, lat) for s in steps] + [(lon + size, lat + s) for s in steps] +
+             [(lon + size - s, lat + size) for s in steps] + [(lon, lat + size - s) for s in steps])
+    return [list(point) for point in sides] + [[lon, lat]]
+
+
+GEOJSON = {"type": "FeatureCollection", "features": [
+    {"type": "Feature", "properties": {"name": "Camden", "created_at": "2015-07-01"},
+     "geometry": {"type": "MultiPolygon", "coordinates": [
+         [square(-0.2, 51.5, 0.05)],
+         # an island too small to show at city-wide zoom levels
+         [square(-0.1, 51.5, 0.00001, points_per_side=2)]]}},
+    {"type": "Feature", "properties": {"name": "Hackney"},
+     "geometry": {"type": "Polygon", "coordinates": [square(-0.1, 51.55, 0.05)]}}]}
+
+
+class SimplifyTest(SimpleTestCase):
+
+    def test_douglas_peucker(self):
+        points = np.array([[0, 0], [1, 0.01], [2, 0], [3, 1], [4, 0]], dtype=float)
+        self.assertEqual(boundaries.douglas_peucker(points, 0.1).tolist(), [True, False, True, True, True])
+        self.assertEqual(boundaries.douglas_peucker(points, 2).tolist(), [True, False, False, False, True])
+
+    def test_build_variant(self):
+        variant = boundaries.build_variant(GEOJSON, 10)
+        camden, hackney = variant["features"]
+        self.assertEqual(camden["properties"], {"name": "Camden"})
+        # the square is reduced to its corners, and the tiny island is dropped
+        self.assertEqual(len(camden["geometry"]["coordinates"]), 1)
+        outer = camden["geometry"]["coordinates"][0][0]
+        self.assertEqual(len(outer), 5)
+        self.assertEqual(outer[0], outer[-1])
+        self.assertEqual(hackney["geometry"]["type"], "Polygon")
+        self.assertEqual(len(hackney["geometry"]["coordinates"][0]), 5)
+
+    def test_coordinates_are_quantised_per_zoom(self):
+        self.assertLess(boundaries.decimal_places(boundaries.tolerance_degrees(10)),
+                        boundaries.decimal_places(boundaries.tolerance_degrees(16)))
+        ring = [[-0.123456789, 51.0], [-0.1, 51.123456789], [-0.05, 51.0], [-0.123456789, 51.0]]
+        simplified = boundaries.simplify_ring(ring, tolerance=0.0001, decimals=4)
+        self.assertEqual(simplified[0], [-0.1235, 51.0])
+
+
+class BoundaryVariantsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp_dir.name, "boroughs.geojson")
+        with open(self.source, "w") as f:
+            f.write(f"const GEOJSON = {json.dumps(GEOJSON)};")
+        self.out_dir = os.path.join(self.tmp_dir.name, "out")
+        settings_override = override_settings(AIRQUALITY_BOUNDARY_ZOOMS=[10, 14],
+                                              AIRQUALITY_BOUNDARIES_SOURCE=self.source,
+                                              AIRQUALITY_BOUNDARIES_DIR=self.out_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.tmp_dir.cleanup)
+        boundaries._variants = None
+        self.addCleanup(setattr, boundaries, "_variants", None)
+
+    def test_build_command_writes_hashed_variants(self):
+        call_command("build_boundaries", stdout=StringIO())
+        variants = boundaries.read_variants()
+        self.assertEqual(set(variants), {10, 14})
+        encodings = variants[10]
+        self.assertEqual(gzip.decompress(encodings["gzip"]), encodings["identity"])
+        self.assertEqual(json.loads(encodings["identity"]), boundaries.build_variant(GEOJSON, 10))
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, f"boroughs-z10.{encodings['hash']}.json.gz")))
+
+    def test_variants_are_built_in_memory_if_missing(self):
+        self.assertIsNone(boundaries.read_variants())
+        with self.assertLogs("Emissions.boundaries", "WARNING"):
+            self.assertEqual(set(boundaries.variant_urls()), {"10", "14"})
+
+    def test_boundaries_endpoint(self):
+        url = boundaries.variant_urls()["10"]
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(json.loads(gzip.decompress(response.content)), boundaries.build_variant(GEOJSON, 10))
+
+        response = self.client.get(url)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.json()["features"][1]["properties"]["name"], "Hackney")
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+        self.assertEqual(self.client.get("/api/boundaries/10/0123456789abcdef.json").status_code, 404)
+        self.assertEqual(self.client.get(url.replace("/10/", "/12/")).status_code, 404)
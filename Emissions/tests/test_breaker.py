@@ -0,0 +1,149 @@
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import cache as django_cache
+from unittest import mock
+
+import datetime as dt
+import time
+import requests
+
+from Emissions import cache, store
+from Emissions.breaker import CircuitBreaker, CircuitOpenError, breaker_keys
+from Emissions.http_client import ApiClient
+from Emissions.models import Snapshot
+from Emissions.services import GROUP_INDEX_URL
+from Emissions.tests.test_cache import LOCMEM_CACHE
+from Emissions.tests.test_http_client import make_response
+
+URL = "/Json"
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CircuitBreakerTest(SimpleTestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.2)
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.breaker.record_failure(URL)
+        self.assertTrue(self.breaker.allow(URL))
+        self.breaker.record_failure(URL)
+        self.assertTrue(self.breaker.is_open(URL))
+        self.assertFalse(self.breaker.allow(URL))
+
+    def test_success_resets_the_count(self):
+        self.breaker.record_failure(URL)
+        self.breaker.record_failure(URL)
+        self.breaker.record_success(URL)
+        self.breaker.record_failure(URL)
+        self.assertFalse(self.breaker.is_open(URL))
+
+    def test_half_open_allows_one_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure(URL)
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.allow(URL))
+        self.assertFalse(self.breaker.allow(URL))
+        # a failed probe opens the breaker again ...
+        self.breaker.record_failure(URL)
+        self.assertFalse(self.breaker.allow(URL))
+        # ... and a successful one closes it
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.allow(URL))
+        self.breaker.record_success(URL)
+        self.assertFalse(self.breaker.is_open(URL))
+        self.assertTrue(self.breaker.allow(URL))
+
+    def test_off(self):
+        breaker = CircuitBreaker(failure_threshold=0)
+        for _ in range(10):
+            breaker.record_failure(URL)
+        self.assertTrue(breaker.allow(URL))
+
+    def test_endpoints_have_separate_breakers(self):
+        for _ in range(3):
+            self.breaker.record_failure("/Data/Site/SiteCode=XX/Json")
+        self.assertFalse(self.breaker.allow("/Data/Site/SiteCode=XX/Json"))
+        self.assertFalse(self.breaker.is_open(URL))
+        self.assertTrue(self.breaker.allow(URL))
+
+    @mock.patch("Emissions.http_client.time.sleep")
+    def test_client_fails_fast_while_open(self, sleep):
+        client = ApiClient(base_url="https://example.com", proxy="", max_retries=1, breaker=self.breaker)
+        with mock.patch.object(client.session, "get", side_effect=requests.exceptions.ConnectTimeout) as get:
+            for _ in range(3):
+                with self.assertRaises(requests.exceptions.ConnectTimeout):
+                    client.get(URL)
+            with self.assertRaises(CircuitOpenError):
+                client.get(URL)
+        # 2 attempts for each of the first 3 requests; none once the breaker is open
+        self.assertEqual(get.call_count, 6)
+        # 5xx responses count as failures, but 4xx responses don't (time.sleep is mocked,
+        # so make the breaker half-open by backdating it)
+        django_cache.set(breaker_keys(URL)[1], time.time() - 1, None)
+        with mock.patch.object(client.session, "get", return_value=make_response(404)):
+            self.assertEqual(client.get(URL).status_code, 404)
+        self.assertFalse(self.breaker.is_open(URL))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, AIRQUALITY_STALE_AFTER=60 * 60)
+class CurrentEmissionsStalenessTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        cache.clear_local_data_versions()
+        # don't leave this process's copy of an open breaker to later tests
+        self.addCleanup(cache.clear_local_data_versions)
+        self.now = dt.datetime.now(dt.timezone.utc)
+
+    def add_snapshot(self, age):
+        Snapshot.objects.create(fetched_at=self.now - dt.timedelta(seconds=age), payload_hash="x",
+                                data=[{"stored": 1}])
+        cache.bump_data_version('Snapshot')
+
+    def test_no_snapshot(self):
+        self.assertEqual(store.get_current_emissions_with_status(now=self.now), (None, False))
+
+    def test_fresh_snapshot(self):
+        self.add_snapshot(60)
+        self.assertEqual(store.get_current_emissions_with_status(now=self.now), ([{"stored": 1}], False))
+
+    def test_old_snapshot_is_stale(self):
+        self.add_snapshot(2 * 60 * 60)
+        self.assertEqual(store.get_current_emissions_with_status(now=self.now), ([{"stored": 1}], True))
+        # until a newer snapshot is stored
+        self.add_snapshot(0)
+        self.assertFalse(store.current_emissions_are_stale(now=self.now))
+
+    def test_open_breaker_is_stale(self):
+        self.add_snapshot(60)
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record_failure("/Data/Site/SiteCode=XX/Json")
+        self.assertFalse(store.current_emissions_are_stale(now=self.now))
+        breaker.record_failure(GROUP_INDEX_URL.format(group_name="London"))
+        self.assertTrue(store.current_emissions_are_stale(now=self.now))
+
+    def test_breaker_state_is_read_once_per_interval(self):
+        self.add_snapshot(60)
+        self.assertFalse(store.current_emissions_are_stale(now=self.now))
+        # opened by another process
+        django_cache.set(breaker_keys(GROUP_INDEX_URL.format(group_name="London"))[1], time.time(), None)
+        with override_settings(AIRQUALITY_VERSION_CHECK_INTERVAL=60):
+            self.assertFalse(store.current_emissions_are_stale(now=self.now))
+        with override_settings(AIRQUALITY_VERSION_CHECK_INTERVAL=0):
+            self.assertTrue(store.current_emissions_are_stale(now=self.now))
+
+    def test_index_shows_stale_warning(self):
+        self.add_snapshot(60)
+        self.assertNotContains(self.client.get("/"), "may be out of date")
+        self.add_snapshot(0)
+        Snapshot.objects.update(fetched_at=self.now - dt.timedelta(hours=2))
+        cache.bump_data_version('Snapshot')
+        self.assertContains(self.client.get("/"), "may be out of date")
+
+    def test_current_emissions_view_warns_when_stale(self):
+        self.add_snapshot(2 * 60 * 60)
+        response = self.client.get("/api/snapshot")
+        self.assertEqual(response.json(), [{"stored": 1}])
+        self.assertIn("110", response["Warning"])
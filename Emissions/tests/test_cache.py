@@ -0,0 +1,156 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache as django_cache
+from unittest import mock
+
+import datetime as dt
+
+from Emissions import cache, nowcast, reference, spatial
+from Emissions.services import AirQualityApiData
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'bulk': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bulk'}}
+
+GROUP_DATA = {"HourlyAirQualityIndex":
+                {"LocalAuthority": [
+                    {"@LocalAuthorityName": "My local auth",
+                     "Site": {"@SiteName": "name of site",
+                              "@SiteCode": "ABC",
+                              "@SiteType": "Roadside",
+                              "@BulletinDate": "2019-01-01 10:00:00",
+                              "@Latitude": "51.5",
+                              "@Longitude": "-0.1",
+                              "Species": {"@SpeciesCode": "NO2", "@AirQualityIndex": "3"}}}
+                ]}
+            }
+
+@override_settings(CACHES=LOCMEM_CACHE, AIRQUALITY_SNAPSHOT_TTL=3600, AIRQUALITY_PUBLISH_OFFSET=600)
+class SnapshotCacheTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        self.api = AirQualityApiData()
+
+    def test_seconds_until_next_publish_before_offset(self):
+        now = dt.datetime(2019, 1, 1, 10, 5, 0, tzinfo=dt.timezone.utc)
+        self.assertEqual(cache.seconds_until_next_publish(now), 5 * 60)
+
+    def test_seconds_until_next_publish_after_offset(self):
+        now = dt.datetime(2019, 1, 1, 10, 20, 0, tzinfo=dt.timezone.utc)
+        self.assertEqual(cache.seconds_until_next_publish(now), 50 * 60)
+
+    @override_settings(AIRQUALITY_SNAPSHOT_TTL=60)
+    def test_snapshot_ttl_is_capped(self):
+        now = dt.datetime(2019, 1, 1, 10, 20, 0, tzinfo=dt.timezone.utc)
+        self.assertEqual(cache.snapshot_ttl(now), 60)
+
+    def test_current_emissions_are_cached(self):
+        with mock.patch.object(AirQualityApiData, "get_data_from_API",
+                               return_value=GROUP_DATA) as get_data:
+            first = self.api.get_current_emissions_across_london()
+            second = AirQualityApiData().get_current_emissions_across_london()
+        self.assertEqual(get_data.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first[0]["Nitrogen Dioxide"], 3.0)
+
+    def test_current_emissions_failure_is_not_cached(self):
+        with mock.patch.object(AirQualityApiData, "get_data_from_API",
+                               return_value=None) as get_data:
+            self.assertIsNone(self.api.get_current_emissions_across_london())
+            self.assertIsNone(self.api.get_current_emissions_across_london())
+        self.assertEqual(get_data.call_count, 2)
+
+    def test_current_emissions_bypass_cache(self):
+        with mock.patch.object(AirQualityApiData, "get_data_from_API",
+                               return_value=GROUP_DATA) as get_data:
+            self.api.get_current_emissions_across_london()
+            self.api.get_current_emissions_across_london(use_cache=False)
+        self.assertEqual(get_data.call_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, AIRQUALITY_NOWCAST_CACHE_CELL_M=100, 
+                   AIRQUALITY_PUBLISH_OFFSET=600, AIRQUALITY_NOWCAST_SOURCE="api")
+class NowcastCacheTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        cache.bulk_cache.clear()
+        self.api = AirQualityApiData()
+
+    def test_nowcast_cell(self):
+        # ~30m apart: same cell; ~300m apart: different cells (in both directions)
+        self.assertEqual(cache.nowcast_cell(51.5005, -0.1001), cache.nowcast_cell(51.5007, -0.1003))
+        self.assertNotEqual(cache.nowcast_cell(51.5001, -0.1001), cache.nowcast_cell(51.5031, -0.1001))
+        self.assertNotEqual(cache.nowcast_cell(51.5001, -0.1001), cache.nowcast_cell(51.5001, -0.1051))
+
+    def test_publish_period(self):
+        before = dt.datetime(2019, 1, 1, 10, 5, 0, tzinfo=dt.timezone.utc)
+        after = dt.datetime(2019, 1, 1, 10, 15, 0, tzinfo=dt.timezone.utc)
+        self.assertEqual(cache.publish_period(before), "2019010109")
+        self.assertEqual(cache.publish_period(after), "2019010110")
+
+    def test_nearby_points_share_upstream_nowcast(self):
+        point_result = {"PointResult": {"@NO2": "12"}}
+        with mock.patch.object(self.api, "get_data_from_API", return_value=point_result) as get_data:
+            self.assertEqual(self.api.nowcast(51.5005, -0.1001), {"@NO2": "12"})
+            self.assertEqual(self.api.nowcast(51.5007, -0.1003), {"@NO2": "12"})
+            self.api.nowcast(51.51, -0.1)
+        self.assertEqual(get_data.call_count, 2)
+        self.assertEqual(cache.get_nowcast_cache_stats(), {"hits": 1, "misses": 2, "hit_ratio": 1 / 3})
+
+    def test_upstream_nowcast_is_for_cell_centre(self):
+        centre = cache.nowcast_cell_centre(51.5005, -0.1001)
+        self.assertEqual(cache.nowcast_cell(*centre), cache.nowcast_cell(51.5005, -0.1001))
+        self.assertEqual(cache.nowcast_cell_centre(51.5007, -0.1003), centre)
+        with mock.patch.object(self.api, "get_data_from_API", return_value={"PointResult": {}}) as get_data:
+            self.api.nowcast(51.5005, -0.1001)
+        get_data.assert_called_once_with(f"/Data/Nowcast/lat={centre[0]}/lon={centre[1]}/Json")
+
+    def test_nowcasts_do_not_share_the_default_cache(self):
+        cache.set_nowcast(51.5, -0.1, {"@NO2": "12"})
+        django_cache.clear()
+        self.assertEqual(cache.get_nowcast(51.5, -0.1), {"@NO2": "12"})
+
+    def test_nowcast_cache_is_per_publish_period(self):
+        cache.set_nowcast(51.5, -0.1, {"@NO2": "12"})
+        later = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=1)
+        with mock.patch.object(cache, "publish_period", return_value=cache.publish_period(later)):
+            self.assertIsNone(cache.get_nowcast(51.5, -0.1))
+
+    def test_failed_nowcast_is_not_cached(self):
+        with mock.patch.object(self.api, "get_data_from_API", return_value=None) as get_data:
+            self.assertIsNone(self.api.nowcast(51.5, -0.1))
+            self.assertIsNone(self.api.nowcast(51.5, -0.1))
+        self.assertEqual(get_data.call_count, 2)
+
+    def test_stats_endpoint(self):
+        self.assertEqual(self.client.get("/api/nowcast/cache-stats").json(),
+                         {"hits": 0, "misses": 0, "hit_ratio": None})
+        cache.get_nowcast(51.5, -0.1)
+        self.assertEqual(self.client.get("/api/nowcast/cache-stats").json()["misses"], 1)
+
+
+class LocalDataVersionsTest(TestCase):
+    # under the default (database) cache, as deployed without redis
+
+    def setUp(self):
+        cache.clear_local_data_versions()
+
+    def test_per_process_caches_only_check_versions_once_per_interval(self):
+        spatial.get_site_index()
+        nowcast.get_nowcast_field()
+        reference.get_reference_data()
+        with self.assertNumQueries(0):
+            spatial.get_site_index()
+            nowcast.get_nowcast_field()
+            reference.get_reference_data()
+
+    @override_settings(AIRQUALITY_VERSION_CHECK_INTERVAL=0)
+    def test_versions_are_reread_after_interval(self):
+        version = cache.get_local_data_version('Site')
+        django_cache.set(cache.DATA_VERSION_KEY.format(table='Site'), "changed elsewhere", None)
+        self.assertNotEqual(cache.get_local_data_version('Site'), version)
+
+    def test_own_changes_are_seen_straight_away(self):
+        version = cache.get_local_data_version('Site')
+        cache.bump_data_version('Site')
+        self.assertNotEqual(cache.get_local_data_version('Site'), version)
@@ -0,0 +1,97 @@
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+
+import datetime as dt
+import threading
+import time
+import requests
+
+from Emissions.http_client import ApiClient, proxy_dict
+from Emissions.services import AirQualityApiData, datetime_obj_to_str
+
+
+def make_response(status_code, json_data=None):
+    response = mock.Mock(status_code=status_code, content=b"", headers={})
+    response.json.return_value = json_data
+    return response
+
+
+@mock.patch("Emissions.http_client.time.sleep")
+class ApiClientTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client = ApiClient(base_url="https://example.com/AirQuality", proxy="",
+                                connect_timeout=1, read_timeout=2, max_retries=2, backoff=0.1)
+
+    def test_proxy_dict(self, sleep):
+        self.assertIsNone(proxy_dict(None))
+        self.assertEqual(proxy_dict("http://10.0.0.1:3128"),
+                         {"http": "http://10.0.0.1:3128", "https": "http://10.0.0.1:3128"})
+
+    def test_get_json_uses_timeouts(self, sleep):
+        with mock.patch.object(self.client.session, "get",
+                               return_value=make_response(200, {"a": 1})) as get:
+            self.assertEqual(self.client.get_json("/Json"), {"a": 1})
+        get.assert_called_once_with("https://example.com/AirQuality/Json", proxies=None,
+                                    timeout=(1, 2), stream=False)
+        sleep.assert_not_called()
+
+    def test_get_json_non_200_returns_none(self, sleep):
+        with mock.patch.object(self.client.session, "get", return_value=make_response(404)) as get:
+            self.assertIsNone(self.client.get_json("/Json"))
+        self.assertEqual(get.call_count, 1)
+
+    def test_retries_server_errors(self, sleep):
+        responses = [make_response(503), make_response(502), make_response(200, {"a": 1})]
+        with mock.patch.object(self.client.session, "get", side_effect=responses) as get:
+            self.assertEqual(self.client.get_json("/Json"), {"a": 1})
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_retries_connection_errors_then_raises(self, sleep):
+        error = requests.exceptions.ConnectionError()
+        with mock.patch.object(self.client.session, "get", side_effect=error) as get:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.client.get_json("/Json")
+        self.assertEqual(get.call_count, 3)
+
+    def test_backoff_delay_is_bounded(self, sleep):
+        for attempt in range(4):
+            delay = self.client.backoff_delay(attempt)
+            self.assertTrue(0 <= delay <= 0.1 * 2 ** attempt)
+
+
+class GetManyFromApiTest(SimpleTestCase):
+
+    @override_settings(AIRQUALITY_MAX_CONCURRENCY=2)
+    def test_requests_are_concurrent_and_bounded(self):
+        lock = threading.Lock()
+        state = {"active": 0, "max_active": 0}
+
+        def fake_get(url, proxy=None):
+            with lock:
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"], state["active"])
+            time.sleep(0.02)
+            with lock:
+                state["active"] -= 1
+            return {"url": url}
+
+        api = AirQualityApiData()
+        urls = [f"/{i}" for i in range(6)]
+        with mock.patch.object(api, "get_data_from_API", side_effect=fake_get):
+            results = api.get_many_from_API(urls)
+        self.assertEqual(results, [{"url": url} for url in urls])
+        self.assertEqual(state["max_active"], 2)
+
+    def test_last_n_days_in_date_order(self):
+        api = AirQualityApiData()
+        with mock.patch.object(api, "get_data_from_API", return_value=None) as get_data:
+            output = api.get_emissions_across_london_last_n_days(n=4)
+        self.assertEqual(get_data.call_count, 3)
+        expected_days = []
+        for i in range(1, 4):
+            day = datetime_obj_to_str(dt.datetime.now() - dt.timedelta(days=i))
+            expected_days.append(day[1:] if day[0] == "0" else day)
+        self.assertEqual(list(output.keys()), expected_days)
+        self.assertTrue(all(value is None for value in output.values()))
@@ -0,0 +1,67 @@
+from django.test import SimpleTestCase, TestCase, override_settings
+from unittest import mock
+
+import json
+import logging
+
+from prometheus_client import REGISTRY
+
+from Emissions import metrics
+from Emissions.http_client import ApiClient
+from Emissions.tests.test_cache import LOCMEM_CACHE
+from Emissions.tests.test_http_client import make_response
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTest(SimpleTestCase):
+
+    def test_api_endpoint(self):
+        self.assertEqual(metrics.api_endpoint(
+            "/Data/Site/SiteCode=TDO/StartDate=01Jan2019/EndDate=02Jan2019/Json"), "/Data/Site/Json")
+        self.assertEqual(metrics.api_endpoint("/Information/Species/Json"), "/Information/Species/Json")
+
+    @mock.patch("Emissions.http_client.time.sleep")
+    def test_client_records_responses_and_retries(self, sleep):
+        client = ApiClient(base_url="https://example.com", proxy="", max_retries=2, backoff=0)
+        endpoint = "/Data/Nowcast/Json"
+        before = (sample("airquality_upstream_responses_total", endpoint=endpoint, status="503"),
+                  sample("airquality_upstream_responses_total", endpoint=endpoint, status="200"),
+                  sample("airquality_upstream_retries_total", endpoint=endpoint),
+                  sample("airquality_upstream_request_seconds_count", endpoint=endpoint))
+        with mock.patch.object(client.session, "get",
+                               side_effect=[make_response(503), make_response(200, {"a": 1})]):
+            self.assertEqual(client.get_json("/Data/Nowcast/lat=51.5/lon=-0.1/Json"), {"a": 1})
+        after = (sample("airquality_upstream_responses_total", endpoint=endpoint, status="503"),
+                 sample("airquality_upstream_responses_total", endpoint=endpoint, status="200"),
+                 sample("airquality_upstream_retries_total", endpoint=endpoint),
+                 sample("airquality_upstream_request_seconds_count", endpoint=endpoint))
+        self.assertEqual([a - b for a, b in zip(after, before)], [1, 1, 1, 2])
+
+    def test_json_formatter(self):
+        record = logging.LogRecord("Emissions.metrics", logging.INFO, __file__, 1, "request",
+                                   None, None)
+        record.metrics = {"route": "api/sites", "status": 200}
+        entry = json.loads(metrics.JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "request")
+        self.assertEqual(entry["route"], "api/sites")
+        self.assertEqual(entry["status"], 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class MetricsEndpointTest(TestCase):
+
+    def test_view_times_are_exposed(self):
+        self.client.get("/api/species")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn('airquality_view_seconds_count{method="GET",route="api/species",status="200"}',
+                      response.content.decode())
+
+    @override_settings(AIRQUALITY_METRICS_TOKEN="secret")
+    def test_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
@@ -0,0 +1,135 @@
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import cache as django_cache
+from unittest import mock
+
+import datetime as dt
+import numpy as np
+
+from Emissions import cache, nowcast
+from Emissions.models import LocalAuthority, Site, Species, Reading
+from Emissions.services import AirQualityApiData
+from Emissions.tests.test_cache import LOCMEM_CACHE
+
+
+class DaqiIndexTest(SimpleTestCase):
+
+    def test_band_edges(self):
+        self.assertEqual(nowcast.daqi_index("NO2", 0), 1)
+        self.assertEqual(nowcast.daqi_index("NO2", 67), 1)
+        self.assertEqual(nowcast.daqi_index("NO2", 67.6), 2)
+        self.assertEqual(nowcast.daqi_index("PM25", 70), 9)
+        self.assertEqual(nowcast.daqi_index("PM25", 71), 10)
+        self.assertIsNone(nowcast.daqi_index("O3", None))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, AIRQUALITY_NOWCAST_NEIGHBOURS=2, AIRQUALITY_NOWCAST_POWER=2,
+                   AIRQUALITY_NOWCAST_MAX_AGE_HOURS=3, AIRQUALITY_NOWCAST_SOURCE="local")
+class LocalNowcastTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        cache.bulk_cache.clear()
+        nowcast._field = None
+        la = LocalAuthority.objects.create(name="Camden", code=1, latitude=51.54, longitude=-0.14)
+        self.no2 = Species.objects.create(name="Nitrogen Dioxide", code="NO2")
+        self.west = Site.objects.create(name="West", code="WST", local_auth=la, latitude=51.5,
+                                        longitude=-0.2, site_still_active=True)
+        self.east = Site.objects.create(name="East", code="EST", local_auth=la, latitude=51.5,
+                                        longitude=-0.1, site_still_active=True)
+        self.now = dt.datetime.now(dt.timezone.utc).replace(minute=0, second=0, microsecond=0)
+        self.api = AirQualityApiData()
+
+    def add_reading(self, site, value, hours_ago=1):
+        Reading.objects.create(site=site, species=self.no2, value=value,
+                               timestamp=self.now - dt.timedelta(hours=hours_ago))
+
+    def test_idw_interpolation(self):
+        self.add_reading(self.west, 40)
+        self.add_reading(self.east, 80)
+        # midway between the sites, both readings have equal weight
+        result = nowcast.nowcast(51.5, -0.15)
+        self.assertAlmostEqual(result["@NO2"], 60, places=0)
+        self.assertEqual(result["@NO2_Index"], 1)
+        self.assertEqual(result["@Max_Index"], 1)
+        self.assertIsNone(result["@O3"])
+        self.assertIsNone(result["@O3_Index"])
+        # a point at a site gets that site's reading
+        self.assertEqual(nowcast.nowcast(51.5, -0.1)["@NO2"], 80)
+        # nearer the east site, its reading dominates
+        self.assertGreater(nowcast.nowcast(51.5, -0.12)["@NO2"], 70)
+
+    def test_uses_latest_recent_reading(self):
+        self.add_reading(self.west, 500, hours_ago=5)
+        self.add_reading(self.east, 10, hours_ago=2)
+        self.add_reading(self.east, 100, hours_ago=1)
+        result = nowcast.nowcast(51.5, -0.2)
+        self.assertEqual(result["@NO2"], 100)
+        self.assertEqual(result["@NO2_Index"], 2)
+
+    def test_field_is_rebuilt_after_ingestion(self):
+        self.add_reading(self.east, 80)
+        self.assertEqual(nowcast.nowcast(51.5, -0.1)["@NO2"], 80)
+        self.add_reading(self.east, 150, hours_ago=0)
+        # the field isn't rebuilt until the readings are marked as changed
+        self.assertEqual(nowcast.nowcast(51.5, -0.1)["@NO2"], 80)
+        cache.bump_data_version('Reading')
+        result = nowcast.nowcast(51.5, -0.1)
+        self.assertEqual((result["@NO2"], result["@NO2_Index"]), (150, 3))
+
+    def test_services_nowcast_is_local(self):
+        self.add_reading(self.east, 80)
+        with mock.patch.object(self.api, "get_data_from_API") as get_data:
+            self.assertEqual(self.api.nowcast(51.5, -0.1)["@NO2"], 80)
+        get_data.assert_not_called()
+
+    def test_services_nowcast_falls_back_to_api(self):
+        point_result = {"PointResult": {"@NO2": "12"}}
+        with mock.patch.object(self.api, "get_data_from_API", return_value=point_result) as get_data:
+            self.assertEqual(self.api.nowcast(51.5, -0.1), {"@NO2": "12"})
+        lat, lon = cache.nowcast_cell_centre(51.5, -0.1)
+        get_data.assert_called_once_with(f"/Data/Nowcast/lat={lat}/lon={lon}/Json")
+
+    def test_services_nowcast_from_api(self):
+        self.add_reading(self.east, 80)
+        with mock.patch.object(self.api, "get_data_from_API", return_value={"PointResult": {}}) as get_data:
+            self.assertEqual(self.api.nowcast(51.5, -0.1, source="api"), {})
+        get_data.assert_called_once()
+
+    def test_nowcast_many_matches_nowcast(self):
+        self.add_reading(self.west, 40)
+        self.add_reading(self.east, 80)
+        lats = [51.5, 51.5, 51.52, 51.45]
+        lons = [-0.1, -0.15, -0.3, -0.12]
+        result = self.api.nowcast_many(lats, lons)
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            expected = nowcast.nowcast(lat, lon)
+            self.assertAlmostEqual(result["@NO2"][i], expected["@NO2"])
+            self.assertEqual(result["@NO2_Index"][i], expected["@NO2_Index"])
+            self.assertEqual(result["@Max_Index"][i], expected["@Max_Index"])
+        self.assertTrue(np.isnan(result["@O3"]).all())
+        self.assertTrue(np.isnan(result["@PM25_Index"]).all())
+
+    def test_nowcast_many_without_readings(self):
+        self.assertIsNone(self.api.nowcast_many([51.5], [-0.1]))
+
+    def test_batch_endpoint(self):
+        self.add_reading(self.east, 80)
+        response = self.client.post("/api/nowcast", {"points": [[51.5, -0.1], [51.6, -0.1]]},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["@NO2"], [80, 80])
+        self.assertEqual(data["@NO2_Index"], [2, 2])
+        self.assertEqual(data["@O3"], [None, None])
+        self.assertEqual(data["@lat"], [51.5, 51.6])
+
+    def test_batch_endpoint_bad_requests(self):
+        self.add_reading(self.east, 80)
+        for body in ["not json", '{"points": [[51.5]]}', '{"points": [["a", "b"]]}', '{}']:
+            response = self.client.post("/api/nowcast", body, content_type="application/json")
+            self.assertEqual(response.status_code, 400, body)
+        with override_settings(AIRQUALITY_NOWCAST_MAX_POINTS=1):
+            response = self.client.post("/api/nowcast", {"points": [[51.5, -0.1]] * 2},
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/api/nowcast").status_code, 405)
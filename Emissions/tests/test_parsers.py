@@ -0,0 +1,224 @@
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+
+import json
+import requests
+
+from Emissions.parsers import as_list, iter_json_array, parse_group_rows, pivot_readings
+from Emissions.services import AirQualityApiData, date_windows
+
+def site(code, species, **kwargs):
+    data = {"@SiteName": f"name of {code}", "@SiteCode": code, "@SiteType": "Roadside",
+            "@BulletinDate": "2019-01-01 10:00:00", "@Latitude": "51.5", "@Longitude": "-0.1"}
+    data.update(kwargs)
+    if species is not None:
+        data["Species"] = species
+    return data
+
+def species(code, index):
+    return {"@SpeciesCode": code, "@AirQualityIndex": str(index)}
+
+GROUP_DATA = {"HourlyAirQualityIndex": {"LocalAuthority": [
+    # LA with several sites; one with several species, one with a single species
+    {"@LocalAuthorityName": "LA 1",
+     "Site": [site("AAA", [species("NO2", 3), species("PM25", 2)]),
+              site("BBB", species("O3", 4))]},
+    # LA with a single site, which has no species
+    {"@LocalAuthorityName": "LA 2", "Site": site("CCC", None)},
+    # LA with no sites
+    {"@LocalAuthorityName": "LA 3"},
+]}}
+
+
+class GroupRowsParserTest(SimpleTestCase):
+
+    def test_as_list(self):
+        self.assertEqual(as_list([1, 2]), [1, 2])
+        self.assertEqual(as_list({"a": 1}), [{"a": 1}])
+        self.assertEqual(as_list(None), [])
+
+    def test_rows(self):
+        rows = parse_group_rows(GROUP_DATA, "HourlyAirQualityIndex", "LocalAuthority")
+        self.assertEqual([row and row["Site code"] for row in rows], ["AAA", "BBB", None])
+        self.assertEqual([row and row["Local Authority name"] for row in rows], ["LA 1", "LA 1", None])
+        self.assertEqual(rows[0]["Nitrogen Dioxide"], 3.0)
+        self.assertEqual(rows[0]["PM2.5 Particulate"], 2.0)
+        self.assertIsNone(rows[0]["Ozone"])
+        self.assertEqual(rows[1]["Ozone"], 4.0)
+        self.assertEqual(rows[1]["Latitude"], 51.5)
+
+    def test_missing_site_details_are_invalid(self):
+        data = {"HourlyAirQualityIndex": {"LocalAuthority": {
+            "@LocalAuthorityName": "LA 1", "Site": {"@SiteName": "x", "Species": species("NO2", 1)}}}}
+        with self.assertLogs("Emissions.parsers", "WARNING"):
+            self.assertEqual(parse_group_rows(data, "HourlyAirQualityIndex", "LocalAuthority"), [None])
+
+    def test_missing_species_is_logged(self):
+        data = {"HourlyAirQualityIndex": {"LocalAuthority": {
+            "@LocalAuthorityName": "LA 1", "Site": site("AAA", None)}}}
+        with self.assertLogs("Emissions.parsers", "WARNING") as logs:
+            self.assertEqual(parse_group_rows(data, "HourlyAirQualityIndex", "LocalAuthority"), [None])
+        self.assertIn("Species", logs.output[0])
+
+    def test_malformed_species_is_invalid(self):
+        # as the per-site helpers: species that are neither a list nor a dict
+        for malformed in ["", None, "NO2"]:
+            data = {"HourlyAirQualityIndex": {"LocalAuthority": {
+                "@LocalAuthorityName": "LA 1", "Site": site("AAA", None, Species=malformed)}}}
+            self.assertEqual(parse_group_rows(data, "HourlyAirQualityIndex", "LocalAuthority"), [None])
+            api = AirQualityApiData()
+            site_data = data["HourlyAirQualityIndex"]["LocalAuthority"]["Site"]
+            self.assertIsNone(api.update_site_species_info(site_data, api.setup_row_dict(site_data, "LA 1")))
+
+    def test_rows_match_row_dict_helpers(self):
+        api = AirQualityApiData()
+        expected = []
+        for la_name, site_data in [("LA 1", GROUP_DATA["HourlyAirQualityIndex"]["LocalAuthority"][0]["Site"][0]),
+                                   ("LA 1", GROUP_DATA["HourlyAirQualityIndex"]["LocalAuthority"][0]["Site"][1])]:
+            expected.append(api.update_site_species_info(site_data, api.setup_row_dict(site_data, la_name)))
+        expected.append(None)
+        self.assertEqual(api.process_group_emissions(GROUP_DATA, "HourlyAirQualityIndex", "LocalAuthority"), 
+                         expected)
+
+
+def reading(code, date, value):
+    return {"@SpeciesCode": code, "@MeasurementDateGMT": date, "@Value": value}
+
+SITE_READINGS = {"AirQualityData": {"@SiteCode": "ABC", "Data": [
+    reading("NO2", "2019-01-01 00:00:00", "20.5"),
+    reading("NO2", "2019-01-01 01:00:00", ""),
+    reading("O3", "2019-01-01 00:00:00", "40"),
+    reading("O3", "2019-01-01 01:00:00", "41"),
+]}}
+
+def in_chunks(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+class StreamingParserTest(SimpleTestCase):
+
+    def test_iter_json_array_any_chunk_size(self):
+        text = json.dumps(SITE_READINGS, indent=1)
+        for size in [1, 3, 7, 64, len(text)]:
+            items = list(iter_json_array(in_chunks(text, size), "Data"))
+            self.assertEqual(items, SITE_READINGS["AirQualityData"]["Data"])
+
+    def test_iter_json_array_single_item(self):
+        text = json.dumps({"AirQualityData": {"Data": reading("NO2", "2019-01-01 00:00:00", "1")}})
+        self.assertEqual(list(iter_json_array(in_chunks(text, 5), "Data")),
+                         [reading("NO2", "2019-01-01 00:00:00", "1")])
+
+    def test_iter_json_array_empty_or_missing(self):
+        self.assertEqual(list(iter_json_array(['{"Data": []}'], "Data")), [])
+        self.assertEqual(list(iter_json_array(['{"Other": [1, 2]}'], "Data")), [])
+
+    def test_iter_json_array_truncated(self):
+        text = json.dumps(SITE_READINGS)[:-20]
+        with self.assertRaises(ValueError):
+            list(iter_json_array(in_chunks(text, 10), "Data"))
+
+    def test_pivot_readings(self):
+        rows = pivot_readings(SITE_READINGS["AirQualityData"]["Data"])
+        self.assertEqual(rows, [("2019-01-01 00:00:00", {"NO2": 20.5, "O3": 40.0}),
+                                ("2019-01-01 01:00:00", {"NO2": None, "O3": 41.0})])
+
+    def test_date_windows(self):
+        self.assertEqual(date_windows("01Jan2019", "15Feb2019", 31),
+                         [("01Jan2019", "01Feb2019"), ("01Feb2019", "15Feb2019")])
+        self.assertEqual(date_windows("01Jan2019", "01Jan2019", 31), [])
+
+
+class SiteReadingsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.api = AirQualityApiData()
+
+    def test_get_hourly_site_readings_between(self):
+        response = mock.MagicMock(status_code=200, encoding="utf-8")
+        response.__enter__.return_value = response
+        response.iter_content.return_value = in_chunks(json.dumps(SITE_READINGS).encode("utf-8"), 10)
+        with mock.patch("Emissions.services.get_client") as get_client:
+            get_client.return_value.get.return_value = response
+            readings = self.api.get_hourly_site_readings_between("ABC", "01Jan2019", "02Jan2019")
+        get_client.return_value.get.assert_called_once_with(
+            "/Data/Site/SiteCode=ABC/StartDate=01Jan2019/EndDate=02Jan2019/Json", None, stream=True)
+        self.assertEqual(readings, [{"MeasurementDate": "2019-01-01 00:00:00", "NO2": 20.5, "O3": 40.0},
+                                    {"MeasurementDate": "2019-01-01 01:00:00", "NO2": None, "O3": 41.0}])
+
+    def test_iter_hourly_site_readings_windows(self):
+        windows = {"01Jan2019": [("2019-01-01 00:00:00", {"NO2": 1.0}), ("2019-01-02 00:00:00", {"NO2": 2.0})],
+                   "02Jan2019": [("2019-01-02 00:00:00", {"NO2": 2.0}), ("2019-01-03 00:00:00", {"NO2": 3.0})]}
+        with mock.patch.object(self.api, "get_site_readings_window",
+                               side_effect=lambda code, start, end: windows[start]) as get_window:
+            rows = list(self.api.iter_hourly_site_readings("ABC", "01Jan2019", "03Jan2019", window_days=1))
+        self.assertEqual(get_window.call_count, 2)
+        self.assertEqual([timestamp for timestamp, values in rows],
+                         ["2019-01-01 00:00:00", "2019-01-02 00:00:00", "2019-01-03 00:00:00"])
+
+    @override_settings(AIRQUALITY_STREAM_WINDOW_DAYS=31)
+    def test_long_windows_are_chunked_and_merged(self):
+        chunks = {"01Jan2019": [("2019-01-01 00:00:00", {"NO2": 1.0}), ("2019-02-01 00:00:00", {"NO2": 2.0})],
+                  "01Feb2019": [("2019-02-01 00:00:00", {"NO2": 2.0}), ("2019-03-01 00:00:00", {"NO2": 3.0})],
+                  "04Mar2019": [("2019-03-04 00:00:00", {"NO2": 4.0})]}
+        with mock.patch.object(self.api, "get_site_readings_window",
+                               side_effect=lambda code, start, end: chunks[start]) as get_window:
+            readings = self.api.get_hourly_site_readings_between("ABC", "01Jan2019", "10Mar2019")
+        self.assertEqual(get_window.call_count, 3)
+        self.assertEqual([row["MeasurementDate"] for row in readings],
+                         ["2019-01-01 00:00:00", "2019-02-01 00:00:00", "2019-03-01 00:00:00", 
+                          "2019-03-04 00:00:00"])
+
+    @override_settings(AIRQUALITY_STREAM_WINDOW_DAYS=31)
+    def test_failed_chunk_returns_none(self):
+        # the client has already retried, so a failed chunk isn't requested again
+        with mock.patch.object(self.api, "get_site_readings_window",
+                               side_effect=requests.exceptions.ConnectionError()) as get_window:
+            self.assertIsNone(self.api.get_hourly_site_readings_between("ABC", "01Jan2019", "10Mar2019"))
+        self.assertEqual(get_window.call_count, 3)
+
+    @override_settings(AIRQUALITY_STREAM_WINDOW_DAYS=1, AIRQUALITY_STREAM_RETRIES=2)
+    def test_chunk_broken_off_midstream_is_retried(self):
+        def make_response(data, fail=False):
+            text = json.dumps({"AirQualityData": {"Data": data}}).encode("utf-8")
+
+            def iter_content(size):
+                yield from in_chunks(text[:len(text) // 2], 10)
+                if fail:
+                    raise requests.exceptions.ChunkedEncodingError("connection broken")
+                yield from in_chunks(text[len(text) // 2:], 10)
+            response = mock.MagicMock(status_code=200, encoding="utf-8")
+            response.__enter__.return_value = response
+            response.iter_content.side_effect = iter_content
+            return response
+        day1 = [reading("NO2", "2019-01-01 00:00:00", "1"), reading("NO2", "2019-01-01 01:00:00", "2")]
+        day2 = [reading("NO2", "2019-01-02 00:00:00", "3"), reading("NO2", "2019-01-02 01:00:00", "4")]
+        responses = {"01Jan2019": [make_response(day1)],
+                     # the second day's response breaks off once
+                     "02Jan2019": [make_response(day2, fail=True), make_response(day2)]}
+        with mock.patch("Emissions.services.get_client") as get_client:
+            get_client.return_value.get.side_effect = (
+                lambda url, proxy, stream: responses[url.split("StartDate=")[1][:9]].pop(0))
+            with self.assertLogs("Emissions.services", "WARNING"):
+                readings = self.api.get_hourly_site_readings_between("ABC", "01Jan2019", "03Jan2019")
+        self.assertEqual(get_client.return_value.get.call_count, 3)
+        self.assertEqual([row["NO2"] for row in readings], [1.0, 2.0, 3.0, 4.0])
+
+    @override_settings(AIRQUALITY_STREAM_WINDOW_DAYS=1, AIRQUALITY_STREAM_RETRIES=1)
+    def test_chunk_keeps_breaking_off_returns_none(self):
+        response = mock.MagicMock(status_code=200, encoding="utf-8")
+        response.__enter__.return_value = response
+        response.iter_content.side_effect = lambda size: in_chunks(json.dumps(SITE_READINGS)[:-20].encode("utf-8"), 10)
+        with mock.patch("Emissions.services.get_client") as get_client:
+            get_client.return_value.get.return_value = response
+            self.assertIsNone(self.api.get_hourly_site_readings_between("ABC", "01Jan2019", "02Jan2019"))
+        self.assertEqual(get_client.return_value.get.call_count, 2)
+
+    def test_malformed_date_returns_none(self):
+        with mock.patch.object(self.api, "get_site_readings_window") as get_window:
+            self.assertIsNone(self.api.get_hourly_site_readings_between("ABC", "2019-01-01", "10Mar2019"))
+        get_window.assert_not_called()
+
+    async def test_malformed_date_returns_none_async(self):
+        with mock.patch.object(self.api, "aget_site_readings_window") as get_window:
+            self.assertIsNone(await self.api.aget_hourly_site_readings_between("ABC", "2019-01-01", "10Mar2019"))
+        get_window.assert_not_called()
@@ -0,0 +1,146 @@
+from django.test import TestCase
+from unittest import mock
+
+import requests
+
+from Emissions.models import LocalAuthority, Species, Site, HealthAdvice
+from populate_airquality import PopulateDb
+
+def species(code, finished=""):
+    return {"@SpeciesCode": code, "@DateMeasurementFinished": finished}
+
+def site(code, la_name, closed="", site_species=None):
+    return {"@SiteCode": code, "@SiteName": f"Site {code}", "@SiteType": "Roadside",
+            "@LocalAuthorityName": la_name, "@SiteLink": "http://example.com",
+            "@Latitude": "51.5", "@Longitude": "-0.1",
+            "@DateOpened": "2000-01-01 00:00:00", "@DateClosed": closed,
+            "Species": site_species if site_species is not None else species("NO2")}
+
+def advice(band, group, text):
+    return {"@AirQualityBand": band, "@LowerAirQualityIndex": "1", "@UpperAirQualityIndex": "3",
+            "@Group": group, "@Advice": text}
+
+API_DATA = {
+    "groups": {"Groups": {"Group": [{"@GroupName": "Camden", "@Description": "Camden"},
+                                    {"@GroupName": "Hackney", "@Description": "Hackney"}]}},
+    "local_authorities": {"LocalAuthorities": {"LocalAuthority": [
+        {"@LocalAuthorityName": "Camden", "@LocalAuthorityCode": "1", "@HomeURL": "http://camden",
+         "@LaCentreLatitude": "51.54", "@LaCentreLongitude": "-0.14"},
+        {"@LocalAuthorityName": "Hackney", "@LocalAuthorityCode": "2", "@HomeURL": "http://hackney",
+         "@LaCentreLatitude": "51.55", "@LaCentreLongitude": "-0.06"},
+        {"@LocalAuthorityName": "Not a group", "@LocalAuthorityCode": "3", "@HomeURL": "",
+         "@LaCentreLatitude": "51.5", "@LaCentreLongitude": "0"}]}},
+    "species": {"AirQualitySpecies": {"Species": [
+        {"@SpeciesName": "Nitrogen Dioxide", "@SpeciesCode": "NO2", "@Description": "",
+         "@HealthEffect": "", "@Link": "http://no2"}]}},
+    "sites": {"Sites": {"Site": [
+        site("CD1", "Camden", site_species=[species("NO2"), species("O3", "2010-01-01 00:00:00")]),
+        site("HK1", "Hackney", closed="2015-01-01 00:00:00"),
+        site("WMZ", "Camden"),
+        site("XX1", "Unknown")]}},
+    "health_advice": {"AirQualityIndexHealthAdvice": {"HealthAdvice": [
+        advice("Low", "At-risk individuals", "Enjoy"), advice("Low", "General population", "Enjoy too")]}},
+}
+
+
+class PopulateDbTest(TestCase):
+
+    def populate(self, data=API_DATA):
+        populate_db = PopulateDb()
+        with mock.patch.object(populate_db, "fetch_all", return_value=data):
+            populate_db.populate()
+
+    def test_populate(self):
+        self.populate()
+        self.assertEqual(sorted(LocalAuthority.objects.values_list("name", flat=True)), ["Camden", "Hackney"])
+        self.assertEqual(Species.objects.get().code, "NO2")
+        self.assertEqual(sorted(Site.objects.values_list("code", flat=True)), ["CD1", "HK1"])
+        camden_site = Site.objects.get(code="CD1")
+        self.assertEqual(camden_site.local_auth.name, "Camden")
+        self.assertTrue(camden_site.site_still_active)
+        self.assertTrue(camden_site.no2_measure_active)
+        self.assertFalse(camden_site.o3_measure_active)
+        self.assertFalse(Site.objects.get(code="HK1").site_still_active)
+        health_advice = HealthAdvice.objects.get()
+        self.assertEqual((health_advice.advice_at_risk, health_advice.advice_gen_pop), ("Enjoy", "Enjoy too"))
+
+    def test_populate_twice_updates_in_place(self):
+        self.populate()
+        data = dict(API_DATA, sites={"Sites": {"Site": [site("CD1", "Camden", closed="2019-01-01 00:00:00")]}})
+        self.populate(data)
+        self.assertEqual(LocalAuthority.objects.count(), 2)
+        self.assertEqual(Site.objects.count(), 2)
+        self.assertFalse(Site.objects.get(code="CD1").site_still_active)
+
+    def test_populate_skips_failed_endpoints(self):
+        self.populate(dict(API_DATA, sites=None))
+        self.assertEqual(LocalAuthority.objects.count(), 2)
+        self.assertFalse(Site.objects.exists())
+
+    def test_fetch_all_requests_each_endpoint(self):
+        populate_db = PopulateDb(group="London")
+        with mock.patch.object(populate_db, "get_data_from_API", side_effect=lambda url: url):
+            data = populate_db.fetch_all()
+        self.assertEqual(data["sites"], "/Information/MonitoringSiteSpecies/GroupName=London/Json")
+        self.assertEqual(len(data), 5)
+
+
+    def test_failed_endpoint_gives_none(self):
+        def get_json(url, proxy):
+            if "MonitoringSiteSpecies" in url:
+                raise requests.exceptions.ConnectionError()
+            return {"url": url}
+        populate_db = PopulateDb(group="London")
+        with mock.patch("populate_airquality.get_client") as get_client, \
+                self.assertLogs("populate_airquality", "WARNING"):
+            get_client.return_value.base_url = "https://example.com"
+            get_client.return_value.get_json.side_effect = get_json
+            data = populate_db.fetch_all()
+        self.assertIsNone(data["sites"])
+        self.assertEqual(data["species"], {"url": "/Information/Species/Json"})
+
+class RefreshTest(TestCase):
+
+    def refresh(self, data=API_DATA, force=False):
+        populate_db = PopulateDb()
+        with mock.patch.object(populate_db, "fetch_all", return_value=data):
+            return populate_db.refresh(force=force)
+
+    def test_refresh_empty_db_inserts_everything(self):
+        changes = self.refresh()
+        self.assertEqual(changes["LocalAuthority"], {"inserted": 2, "updated": 0})
+        self.assertEqual(changes["Site"], {"inserted": 2, "updated": 0, "closed": 0})
+        self.assertEqual(changes["HealthAdvice"], {"inserted": 1, "updated": 0})
+
+    def test_unchanged_payloads_are_skipped(self):
+        self.refresh()
+        with self.assertNumQueries(3):
+            # read the stored hashes, plus the transaction's savepoint and release
+            self.assertEqual(self.refresh(), {})
+
+    def test_identical_rows_are_not_written(self):
+        populate_db = PopulateDb()
+        with mock.patch.object(populate_db, "fetch_all", return_value=API_DATA):
+            populate_db.populate()
+        changes = self.refresh()
+        self.assertTrue(all(counts["inserted"] == counts["updated"] == 0 
+                            for counts in changes.values()))
+
+    def test_only_changed_rows_are_updated(self):
+        self.refresh()
+        sites = [site("CD1", "Camden", closed="2019-01-01 00:00:00"), 
+                 site("HK1", "Hackney", closed="2015-01-01 00:00:00"),
+                 site("HK2", "Hackney")]
+        changes = self.refresh(dict(API_DATA, sites={"Sites": {"Site": sites}}))
+        self.assertEqual(changes, {"Site": {"inserted": 1, "updated": 1, "closed": 0}})
+        camden_site = Site.objects.get(code="CD1")
+        self.assertFalse(camden_site.site_still_active)
+        self.assertEqual(camden_site.site_date_closed.year, 2019)
+
+    def test_sites_missing_upstream_are_closed(self):
+        self.refresh()
+        changes = self.refresh(dict(API_DATA, sites={"Sites": {"Site": [site("HK1", "Hackney")]}}))
+        self.assertEqual(changes["Site"]["closed"], 1)
+        camden_site = Site.objects.get(code="CD1")
+        self.assertFalse(camden_site.site_still_active)
+        self.assertFalse(camden_site.no2_measure_active)
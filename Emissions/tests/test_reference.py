@@ -0,0 +1,94 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache as django_cache
+from unittest import mock
+
+import gzip
+
+from Emissions import cache, reference
+from Emissions.models import LocalAuthority
+from Emissions.tests.test_cache import LOCMEM_CACHE
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ReferenceDataTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            LocalAuthority.objects.create(name="Camden", code=5, latitude=51.55, longitude=-0.15)
+        # the current emissions are served from the cache
+        cache.set_snapshot("London", [{"Site code": "ABC"}])
+
+    def test_reference_data_is_cached(self):
+        data = reference.get_reference_data()
+        self.assertEqual([la["name"] for la in data["local_auths"]], ["Camden"])
+        self.assertIn('id="local-auths-id"', data["local_auths_json"])
+        self.assertIn("Camden", data["local_auths_json"])
+        self.assertIn('id="config-id"', data["config_json"])
+        with self.assertNumQueries(0):
+            self.assertIs(reference.get_reference_data()["local_auths"], data["local_auths"])
+
+    def test_change_invalidates_the_table(self):
+        reference.warm()
+        with self.captureOnCommitCallbacks(execute=True):
+            LocalAuthority.objects.create(name="Hackney", code=12, latitude=51.55, longitude=-0.06)
+        # only the changed table is re-read
+        with self.assertNumQueries(1):
+            data = reference.get_reference_data()
+        self.assertEqual([la["name"] for la in data["local_auths"]], ["Camden", "Hackney"])
+
+    def test_index_needs_no_queries(self):
+        reference.warm()
+        with self.assertNumQueries(0):
+            response = self.client.get("/")
+        self.assertContains(response, '<option value="5">Camden</option>', html=True)
+        self.assertContains(response, 'id="sites-id"')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class IndexPageCacheTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            LocalAuthority.objects.create(name="Camden", code=5, latitude=51.55, longitude=-0.15)
+        cache.set_snapshot("London", [{"Site code": "ABC"}])
+
+    def test_page_is_rendered_once_per_version(self):
+        first = self.client.get("/")
+        with mock.patch("Emissions.views.render") as render:
+            second = self.client.get("/")
+        render.assert_not_called()
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertIn("no-cache", first["Cache-Control"])
+        self.assertIn("Accept-Encoding", first["Vary"])
+
+    def test_change_rerenders_the_page(self):
+        etag = self.client.get("/")["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            LocalAuthority.objects.create(name="Hackney", code=12, latitude=51.55, longitude=-0.06)
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Hackney")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_if_none_match(self):
+        etag = self.client.get("/")["ETag"]
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_gzip(self):
+        identity = self.client.get("/")
+        response = self.client.get("/", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), identity.content)
+        self.assertNotEqual(response["ETag"], identity["ETag"])
+
+    def test_gzip_refused(self):
+        for accept_encoding in ("gzip;q=0", "gzip; q=0.0, deflate", "*;q=0", "identity"):
+            response = self.client.get("/", HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertFalse(response.has_header("Content-Encoding"), accept_encoding)
+        response = self.client.get("/", HTTP_ACCEPT_ENCODING="deflate, *;q=0.5")
+        self.assertEqual(response["Content-Encoding"], "gzip")
@@ -0,0 +1,120 @@
+from django.test import SimpleTestCase, override_settings
+from django.core.cache import cache as django_cache
+from unittest import mock
+
+import itertools
+import threading
+import time
+
+from Emissions import cache
+from Emissions.services import AirQualityApiData, fetch_lock_poll_delays
+from Emissions.singleflight import SingleFlight
+from Emissions.tests.test_cache import LOCMEM_CACHE
+
+
+class SingleFlightTest(SimpleTestCase):
+
+    def run_concurrently(self, flight, key, func, n=8):
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(flight.do(key, func))
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_share_one_call(self):
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"value": 1}
+        results, errors = self.run_concurrently(SingleFlight(), "key", slow)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"value": 1}] * 8)
+        self.assertEqual(errors, [])
+
+    def test_errors_are_shared(self):
+        def fail():
+            time.sleep(0.2)
+            raise ValueError("bad")
+        results, errors = self.run_concurrently(SingleFlight(), "key", fail)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 8)
+
+    def test_later_calls_start_a_new_flight(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do("key", lambda: 1), 1)
+        self.assertEqual(flight.do("key", lambda: 2), 2)
+        self.assertEqual(flight.calls, {})
+
+
+@override_settings(CACHES=LOCMEM_CACHE, AIRQUALITY_FETCH_LOCK_TIMEOUT=5, AIRQUALITY_FETCH_LOCK_POLL=0.01)
+class CoalescedFetchTest(SimpleTestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        self.api = AirQualityApiData()
+
+    def test_concurrent_requests_share_one_fetch(self):
+        def slow_fetch(url, proxy):
+            time.sleep(0.2)
+            return {"url": url}
+        results = []
+        with mock.patch.object(AirQualityApiData, "fetch_from_API", side_effect=slow_fetch) as fetch:
+            threads = [threading.Thread(target=lambda: results.append(self.api.get_data_from_API("/Json")))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        fetch.assert_called_once()
+        self.assertEqual(results, [{"url": "/Json"}] * 8)
+
+    def test_waits_for_another_process(self):
+        # another process holds the lock, and shares its result a little later
+        token = cache.acquire_fetch_lock("/Json")
+
+        def other_process():
+            time.sleep(0.1)
+            cache.set_fetch_result("/Json", {"a": 1})
+            cache.release_fetch_lock("/Json", token)
+        thread = threading.Thread(target=other_process)
+        with mock.patch.object(AirQualityApiData, "fetch_from_API") as fetch:
+            thread.start()
+            self.assertEqual(self.api.get_data_from_API("/Json"), {"a": 1})
+            thread.join()
+        fetch.assert_not_called()
+
+    def test_fetches_if_the_other_process_fails(self):
+        token = cache.acquire_fetch_lock("/Json")
+        threading.Timer(0.1, cache.release_fetch_lock, ["/Json", token]).start()
+        with mock.patch.object(AirQualityApiData, "fetch_from_API", return_value={"a": 2}) as fetch:
+            self.assertEqual(self.api.get_data_from_API("/Json"), {"a": 2})
+        fetch.assert_called_once()
+        # the lock is released, and the result shared
+        self.assertIsNotNone(cache.acquire_fetch_lock("/Json"))
+        self.assertEqual(cache.get_fetch_result("/Json"), {"a": 2})
+
+    @override_settings(AIRQUALITY_FETCH_LOCK_TIMEOUT=0.2)
+    def test_gives_up_waiting_after_the_timeout(self):
+        cache.acquire_fetch_lock("/Json")
+        with mock.patch.object(AirQualityApiData, "fetch_from_API", return_value={"a": 3}) as fetch:
+            self.assertEqual(self.api.get_data_from_API("/Json"), {"a": 3})
+        fetch.assert_called_once()
+
+    @override_settings(AIRQUALITY_FETCH_LOCK_POLL=0.1, AIRQUALITY_FETCH_LOCK_POLL_MAX=2)
+    def test_poll_delays_back_off(self):
+        with mock.patch("Emissions.services.time.monotonic", return_value=0):
+            delays = list(itertools.islice(fetch_lock_poll_delays(30), 7))
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8, 1.6, 2, 2])
+        # the last delay is cut short by the deadline
+        with mock.patch("Emissions.services.time.monotonic", side_effect=[29.5, 29.75, 29.875, 30]):
+            self.assertEqual(list(fetch_lock_poll_delays(30)), [0.1, 0.2, 0.125])
@@ -0,0 +1,77 @@
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import cache as django_cache
+
+import random
+import numpy as np
+
+from Emissions import spatial
+from Emissions.models import LocalAuthority, Site
+from Emissions.spatial import SiteIndex
+from Emissions.tests.test_cache import LOCMEM_CACHE
+
+
+class SiteIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.codes = [f"S{i:02d}" for i in range(60)]
+        self.latitudes = [51.3 + rng.random() * 0.4 for _ in self.codes]
+        self.longitudes = [-0.5 + rng.random() * 0.7 for _ in self.codes]
+        self.index = SiteIndex(self.codes, self.latitudes, self.longitudes, cell_km=2)
+        self.points = [(51.3 + rng.random() * 0.5, -0.6 + rng.random() * 0.9) for _ in range(50)]
+
+    def brute_force(self, lat, lon):
+        x, y = self.index.project(lat, lon)
+        distances = np.hypot(self.index.x - x, self.index.y - y)
+        return sorted(zip(self.codes, distances.tolist()), key=lambda result: result[1])
+
+    def test_nearest_matches_brute_force(self):
+        for lat, lon in self.points:
+            for k in (1, 3, 10):
+                self.assertEqual(self.index.nearest(lat, lon, k), self.brute_force(lat, lon)[:k])
+
+    def test_within_matches_brute_force(self):
+        for lat, lon in self.points:
+            expected = [result for result in self.brute_force(lat, lon) if result[1] <= 5]
+            self.assertEqual(self.index.within(lat, lon, 5), expected)
+
+    def test_far_away_point(self):
+        self.assertEqual(self.index.nearest(48.85, 2.35, 2), self.brute_force(48.85, 2.35)[:2])
+        self.assertEqual(self.index.within(48.85, 2.35, 50), [])
+
+    def test_distances_are_km(self):
+        index = SiteIndex(["A", "B"], [51.5, 51.6], [-0.1, -0.1], cell_km=2)
+        (code, distance), = index.nearest(51.5, -0.1, 1)
+        self.assertEqual((code, distance), ("A", 0))
+        self.assertAlmostEqual(index.nearest(51.6, -0.1, 2)[1][1], 11.12, places=2)
+
+    def test_empty_index(self):
+        index = SiteIndex([], [], [], cell_km=2)
+        self.assertEqual(index.nearest(51.5, -0.1, 3), [])
+        self.assertEqual(index.within(51.5, -0.1, 3), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SiteIndexRebuildTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        spatial._index = None
+        self.la = LocalAuthority.objects.create(name="Camden", code=1, latitude=51.54, longitude=-0.14)
+        self.site = Site.objects.create(name="A", code="AAA", local_auth=self.la, latitude=51.5, 
+                                        longitude=-0.1, site_still_active=True)
+
+    def test_index_is_rebuilt_when_sites_change(self):
+        self.assertEqual([code for code, _ in spatial.nearest_sites(51.5, -0.1, 5)], ["AAA"])
+        with self.captureOnCommitCallbacks(execute=True):
+            Site.objects.create(name="B", code="BBB", local_auth=self.la, latitude=51.51, 
+                                longitude=-0.1, site_still_active=True)
+        self.assertEqual([code for code, _ in spatial.nearest_sites(51.5, -0.1, 5)], ["AAA", "BBB"])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.site.delete()
+        self.assertEqual([code for code, _ in spatial.sites_within(51.5, -0.1, 5)], ["BBB"])
+
+    def test_index_is_reused_while_sites_unchanged(self):
+        index = spatial.get_site_index()
+        with self.assertNumQueries(0):
+            self.assertIs(spatial.get_site_index(), index)
@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.test import SimpleTestCase, override_settings
+
+import os
+
+from Emissions.staticfiles import CHUNK_SIZE, ASGIStaticFiles, WSGIStaticFiles
+
+STATIC_FILE = os.path.join(settings.STATIC_DIR, 'js', 'londonBoroughs.geojson')
+
+
+async def call_asgi(application, path, method="GET", headers=()):
+    scope = {"type": "http", "method": method, "path": path, "headers": list(headers)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+    await application(scope, receive, send)
+    return messages
+
+
+# find static files in STATICFILES_DIRS, as in development
+@override_settings(DEBUG=True)
+class StaticFilesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.requested = []
+
+        async def django_app(scope, receive, send):
+            self.requested.append(scope["path"])
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"django"})
+        self.application = ASGIStaticFiles(django_app)
+
+    async def test_asgi_serves_static_files(self):
+        messages = await call_asgi(self.application, "/static/js/londonBoroughs.geojson")
+        self.assertEqual(messages[0]["status"], 200)
+        body = b"".join(message["body"] for message in messages[1:])
+        with open(STATIC_FILE, "rb") as file:
+            self.assertEqual(body, file.read())
+        # sent in chunks, the last one without more_body
+        self.assertEqual(len(messages) - 1, max(1, -(-len(body) // CHUNK_SIZE)))
+        self.assertFalse(messages[-1]["more_body"])
+        self.assertEqual(self.requested, [])
+
+    async def test_asgi_not_modified(self):
+        messages = await call_asgi(self.application, "/static/js/londonBoroughs.geojson")
+        etag = dict(messages[0]["headers"])[b"etag"]
+        messages = await call_asgi(self.application, "/static/js/londonBoroughs.geojson",
+                                   headers=[(b"if-none-match", etag)])
+        self.assertEqual(messages[0]["status"], 304)
+        self.assertEqual(messages[1]["body"], b"")
+
+    async def test_asgi_passes_other_requests_to_django(self):
+        messages = await call_asgi(self.application, "/static/js/missing.js")
+        self.assertEqual(messages[1]["body"], b"django")
+        await call_asgi(self.application, "/")
+        self.assertEqual(self.requested, ["/static/js/missing.js", "/"])
+
+    def test_wsgi_serves_static_files(self):
+        statuses = []
+        application = WSGIStaticFiles(lambda environ, start_response: [b"django"])
+        body = application({"PATH_INFO": "/static/js/londonBoroughs.geojson", "REQUEST_METHOD": "GET"},
+                           lambda status, headers: statuses.append(status))
+        with open(STATIC_FILE, "rb") as file:
+            self.assertEqual(b"".join(body), file.read())
+        self.assertEqual(statuses, ["200 OK"])
+        self.assertEqual(application({"PATH_INFO": "/", "REQUEST_METHOD": "GET"}, None), [b"django"])
+
+    def test_no_middleware_is_adapted_under_asgi(self):
+        # Django logs (at DEBUG level, while settings.DEBUG is True) each sync-only
+        # middleware that it adapts, i.e. runs in a thread, for async requests
+        with self.assertNoLogs("django.request", "DEBUG"):
+            ASGIHandler()
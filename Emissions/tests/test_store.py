@@ -0,0 +1,297 @@
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.cache import cache as django_cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from unittest import mock
+
+import datetime as dt
+from io import StringIO
+
+from Emissions import store
+from Emissions.models import (LocalAuthority, Site, Species, Reading, ReadingAggregate, 
+                              ReadingHighWaterMark, Snapshot)
+from Emissions.services import AirQualityApiData
+from Emissions.tests.test_cache import GROUP_DATA, LOCMEM_CACHE
+
+NOW = dt.datetime(2019, 5, 2, 12, 30, tzinfo=dt.timezone.utc)
+
+def site_data(records, site_code="ABC"):
+    return {"AirQualityData": {"@SiteCode": site_code, "Data": records}}
+
+def record(code, date, value):
+    return {"@SpeciesCode": code, "@MeasurementDateGMT": date, "@Value": value}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ReadingStoreTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        la = LocalAuthority.objects.create(name="My local auth", code=1, latitude=51.5, longitude=-0.1)
+        self.site = Site.objects.create(name="name of site", code="ABC", local_auth=la, 
+                                        latitude=51.5, longitude=-0.1, site_still_active=True)
+        Species.objects.create(name="Nitrogen Dioxide", code="NO2")
+        Species.objects.create(name="Ozone", code="O3")
+        self.api = AirQualityApiData()
+
+    def ingest(self, data):
+        with mock.patch.object(self.api, "get_many_from_API", return_value=[data]) as get_many:
+            stored = store.ingest_readings(api=self.api, now=NOW)
+        return stored, get_many.call_args[0][0]
+
+    def test_ingest_stores_readings_and_high_water_mark(self):
+        data = site_data([record("NO2", "2019-05-02 10:00:00", "20.5"),
+                          record("NO2", "2019-05-02 11:00:00", ""),
+                          record("O3", "2019-05-02 11:00:00", "40"),
+                          record("SO2", "2019-05-02 11:00:00", "2")])
+        stored, urls = self.ingest(data)
+        self.assertEqual(urls, ["/Data/Site/SiteCode=ABC/StartDate=25Apr2019/EndDate=03May2019/Json"])
+        self.assertEqual(stored, {"ABC": 2})
+        self.assertEqual(Reading.objects.count(), 2)
+        mark = ReadingHighWaterMark.objects.get(site=self.site)
+        self.assertEqual(mark.timestamp, dt.datetime(2019, 5, 2, 11, tzinfo=dt.timezone.utc))
+
+    def test_ingest_is_incremental(self):
+        self.ingest(site_data([record("NO2", "2019-05-01 10:00:00", "20")]))
+        stored, urls = self.ingest(site_data([record("NO2", "2019-05-01 10:00:00", "20"),
+                                              record("NO2", "2019-05-02 10:00:00", "30")]))
+        self.assertEqual(urls, ["/Data/Site/SiteCode=ABC/StartDate=01May2019/EndDate=03May2019/Json"])
+        self.assertEqual(Reading.objects.count(), 2)
+
+    def test_ingest_updates_revised_readings(self):
+        self.ingest(site_data([record("NO2", "2019-05-01 10:00:00", "20")]))
+        self.ingest(site_data([record("NO2", "2019-05-01 10:00:00", "22.5")]))
+        self.assertEqual(list(Reading.objects.values_list("value", flat=True)), [22.5])
+
+    def test_ingest_failed_request(self):
+        stored, urls = self.ingest(None)
+        self.assertEqual(stored, {"ABC": None})
+        self.assertFalse(ReadingHighWaterMark.objects.exists())
+
+    def test_get_site_readings_between(self):
+        self.ingest(site_data([record("NO2", "2019-05-01 10:00:00", "20"),
+                               record("O3", "2019-05-01 10:00:00", "40"),
+                               record("NO2", "2019-05-02 10:00:00", "30")]))
+        readings = store.get_site_readings_between("ABC", "01May2019", "02May2019")
+        self.assertEqual(readings, [{"MeasurementDate": "2019-05-01 10:00:00", "NO2": 20.0, "O3": 40.0}])
+
+    def test_ingest_skips_unchanged_payload(self):
+        data = site_data([record("NO2", "2019-05-01 10:00:00", "20")])
+        self.ingest(data)
+        with mock.patch.object(store, "store_site_readings") as store_site_readings:
+            stored, urls = self.ingest(data)
+        store_site_readings.assert_not_called()
+        self.assertEqual(stored, {"ABC": 0})
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AggregateStoreTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        camden = LocalAuthority.objects.create(name="Camden", code=1, latitude=51.54, longitude=-0.14)
+        hackney = LocalAuthority.objects.create(name="Hackney", code=2, latitude=51.55, longitude=-0.06)
+        self.sites = [Site.objects.create(name="Camden 1", code="CD1", local_auth=camden,
+                                          latitude=51.54, longitude=-0.14, site_still_active=True),
+                      Site.objects.create(name="Camden 2", code="CD2", local_auth=camden,
+                                          latitude=51.55, longitude=-0.15, site_still_active=True),
+                      Site.objects.create(name="Hackney 1", code="HK1", local_auth=hackney,
+                                          latitude=51.55, longitude=-0.06, site_still_active=True)]
+        Species.objects.create(name="Nitrogen Dioxide", code="NO2")
+        self.api = AirQualityApiData()
+
+    def ingest(self, *payloads):
+        with mock.patch.object(self.api, "get_many_from_API", return_value=list(payloads)):
+            return store.ingest_readings(sites=self.sites, api=self.api, now=NOW)
+
+    def test_aggregates_are_materialised_on_ingest(self):
+        self.ingest(site_data([record("NO2", "2019-05-02 10:00:00", "20"),
+                               record("NO2", "2019-05-02 11:00:00", "40")], "CD1"),
+                    site_data([record("NO2", "2019-05-02 10:00:00", "30")], "CD2"),
+                    site_data([record("NO2", "2019-05-02 10:00:00", "70")], "HK1"))
+        start, end = dt.datetime(2019, 5, 2, tzinfo=dt.timezone.utc), NOW
+        camden_hours = store.get_aggregates("NO2", ReadingAggregate.HOUR, start, end, "Camden")
+        self.assertEqual([(a["period_start"].hour, a["mean"], a["max"], a["count"]) for a in camden_hours],
+                         [(10, 25, 30, 2), (11, 40, 40, 1)])
+        london_day, = store.get_aggregates("NO2", ReadingAggregate.DAY, start, end)
+        self.assertEqual((london_day["mean"], london_day["max"], london_day["count"]), (40, 70, 4))
+        areas = store.get_area_aggregates(ReadingAggregate.DAY, start)
+        self.assertEqual(areas["Hackney"]["NO2"], {"mean": 70, "max": 70, "count": 1})
+        self.assertEqual(set(areas), {"Camden", "Hackney", "London"})
+
+    def test_aggregates_are_updated_incrementally(self):
+        self.ingest(site_data([record("NO2", "2019-05-01 10:00:00", "20")], "CD1"),
+                    site_data([record("NO2", "2019-05-01 10:00:00", "60")], "CD2"),
+                    site_data([record("NO2", "2019-05-02 10:00:00", "70")], "HK1"))
+        may_1 = dt.datetime(2019, 5, 1, tzinfo=dt.timezone.utc)
+        untouched = set(ReadingAggregate.objects.filter(period_start__lt=may_1 + dt.timedelta(days=1))
+                        .values_list('id', flat=True))
+        # a new Hackney reading only recalculates Hackney's and London's aggregates for that day
+        self.ingest(None, None, site_data([record("NO2", "2019-05-02 10:00:00", "70"),
+                                           record("NO2", "2019-05-02 11:00:00", "10")], "HK1"))
+        self.assertTrue(untouched <= set(ReadingAggregate.objects.values_list('id', flat=True)))
+        hackney_day, = store.get_aggregates("NO2", ReadingAggregate.DAY, may_1, NOW, "Hackney")
+        self.assertEqual((hackney_day["mean"], hackney_day["count"]), (40, 2))
+        london_days = store.get_aggregates("NO2", ReadingAggregate.DAY, may_1, NOW)
+        self.assertEqual([a["mean"] for a in london_days], [40, 40])
+        self.assertEqual(ReadingAggregate.objects.filter(local_auth__isnull=True, 
+                                                         period=ReadingAggregate.HOUR).count(), 3)
+
+    def test_get_aggregates_is_one_query(self):
+        with self.assertNumQueries(1):
+            store.get_aggregates("NO2", ReadingAggregate.HOUR, NOW - dt.timedelta(days=1), NOW, "Camden")
+
+    def test_rebuild_aggregates_command(self):
+        self.ingest(site_data([record("NO2", "2019-05-02 10:00:00", "20")], "CD1"), None, None)
+        ReadingAggregate.objects.all().delete()
+        out = StringIO()
+        call_command("ingest_airquality", "--rebuild-aggregates", stdout=out)
+        # hour and day, for Camden and London
+        self.assertEqual(out.getvalue().strip(), "Stored 4 reading aggregates")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SnapshotStoreTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        self.api = AirQualityApiData()
+
+    def test_ingest_snapshot_only_stores_changes(self):
+        with mock.patch.object(self.api, "get_data_from_API", return_value=GROUP_DATA):
+            first = store.ingest_snapshot(api=self.api, now=NOW)
+            second = store.ingest_snapshot(api=self.api, now=NOW + dt.timedelta(hours=1))
+        self.assertIsNotNone(first)
+        self.assertIsNone(second)
+        self.assertEqual(Snapshot.objects.count(), 1)
+        self.assertEqual(first.data[0]["Nitrogen Dioxide"], 3.0)
+
+    def test_ingest_snapshot_deletes_old_snapshots(self):
+        Snapshot.objects.create(fetched_at=NOW - dt.timedelta(days=60), payload_hash="old", data=[])
+        with mock.patch.object(self.api, "get_data_from_API", return_value=GROUP_DATA):
+            snapshot = store.ingest_snapshot(api=self.api, now=NOW)
+        self.assertEqual(list(Snapshot.objects.all()), [snapshot])
+
+    def test_get_current_emissions_from_database(self):
+        self.assertIsNone(store.get_current_emissions())
+        Snapshot.objects.create(fetched_at=NOW, payload_hash="abc", data=[{"Site code": "ABC"}])
+        self.assertEqual(store.get_current_emissions(), [{"Site code": "ABC"}])
+        # once read, it's served from the cache
+        Snapshot.objects.all().delete()
+        self.assertEqual(store.get_current_emissions(), [{"Site code": "ABC"}])
+
+    def test_index_does_not_call_the_api(self):
+        with mock.patch.object(AirQualityApiData, "get_data_from_API") as get_data:
+            response = self.client.get("/")
+        get_data.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+
+    def test_ingest_command_once(self):
+        with mock.patch.object(AirQualityApiData, "get_data_from_API", return_value=GROUP_DATA):
+            call_command("ingest_airquality", "--once", stdout=StringIO())
+        self.assertEqual(Snapshot.objects.count(), 1)
+
+    def test_ingest_command_survives_errors(self):
+        command = "Emissions.management.commands.ingest_airquality"
+        with mock.patch(f"{command}.Command.ingest", side_effect=[RuntimeError("database"), None]) as ingest, \
+             mock.patch(f"{command}.connections"), \
+             mock.patch(f"{command}.time.sleep", side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt), self.assertLogs(command, "ERROR"):
+                call_command("ingest_airquality", stdout=StringIO())
+        self.assertEqual(ingest.call_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SiteDayStoreTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+        la = LocalAuthority.objects.create(name="My local auth", code=1, latitude=51.5, longitude=-0.1)
+        self.site = Site.objects.create(name="name of site", code="ABC", local_auth=la,
+                                        latitude=51.5, longitude=-0.1, site_still_active=True)
+        self.no2 = Species.objects.create(name="Nitrogen Dioxide", code="NO2")
+        self.api = AirQualityApiData()
+        self.day = NOW.date()
+
+    def test_from_store(self):
+        Reading.objects.create(site=self.site, species=self.no2, timestamp=NOW.replace(hour=3, minute=0), value=20.5)
+        Reading.objects.create(site=self.site, species=self.no2, timestamp=NOW.replace(hour=23, minute=0), value=7)
+        with mock.patch.object(self.api, "get_hourly_site_readings_between") as get_readings:
+            species = store.get_site_day_readings("ABC", self.day, api=self.api)
+        get_readings.assert_not_called()
+        self.assertEqual(species["NO2"][3], 20.5)
+        self.assertEqual(species["NO2"][23], 7)
+        self.assertEqual(species["NO2"].count(None), 22)
+
+    def test_from_api_and_cached(self):
+        rows = [{"MeasurementDate": "2019-05-02 01:00:00", "NO2": 12.0, "O3": None},
+                {"MeasurementDate": "2019-05-03 00:00:00", "NO2": 99.0, "O3": None}]
+        with mock.patch.object(self.api, "get_hourly_site_readings_between", return_value=rows) as get_readings:
+            first = store.get_site_day_readings("ABC", self.day, api=self.api)
+            second = store.get_site_day_readings("ABC", self.day, api=self.api)
+        get_readings.assert_called_once_with("ABC", "02May2019", "03May2019")
+        self.assertEqual(first, second)
+        self.assertEqual(first["NO2"][1], 12.0)
+        self.assertEqual(first["NO2"].count(None), 23)
+        self.assertEqual(first["O3"], [None] * 24)
+
+    def test_failure_is_not_cached(self):
+        with mock.patch.object(self.api, "get_hourly_site_readings_between", return_value=None) as get_readings:
+            self.assertIsNone(store.get_site_day_readings("ABC", self.day, api=self.api))
+            self.assertIsNone(store.get_site_day_readings("ABC", self.day, api=self.api))
+        self.assertEqual(get_readings.call_count, 2)
+
+    def test_endpoint(self):
+        Reading.objects.create(site=self.site, species=self.no2, timestamp=NOW.replace(minute=0), value=20)
+        response = self.client.get("/api/sites/ABC/readings", {"date": "2019-05-02"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["date"], "2019-05-02")
+        self.assertEqual(response.json()["species"]["NO2"][12], 20)
+        self.assertEqual(self.client.get("/api/sites/ABC/readings", {"date": "May 2"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/sites/XYZ/readings").status_code, 404)
+
+
+class UniqueReferenceKeysMigrationTest(TransactionTestCase):
+    before = [('Emissions', '0009_snapshot')]
+    after = [('Emissions', '0010_unique_reference_keys')]
+
+    def tearDown(self):
+        MigrationExecutor(connection).migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_duplicates_are_merged_into_the_first(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        LocalAuthority = apps.get_model('Emissions', 'LocalAuthority')
+        Site = apps.get_model('Emissions', 'Site')
+        Species = apps.get_model('Emissions', 'Species')
+        Reading = apps.get_model('Emissions', 'Reading')
+        ReadingHighWaterMark = apps.get_model('Emissions', 'ReadingHighWaterMark')
+        la, other_la = (LocalAuthority.objects.create(name="LA", code=1, latitude=51.5, longitude=-0.1)
+                        for _ in range(2))
+        site, other_site = (Site.objects.create(code="ABC", local_auth=local_auth, latitude=51.5, longitude=-0.1)
+                            for local_auth in (la, other_la))
+        species, other_species = (Species.objects.create(code="NO2") for _ in range(2))
+        Reading.objects.create(site=site, species=species, timestamp=NOW, value=1.0)
+        # clashes with the reading above once both sites and species are merged
+        Reading.objects.create(site=other_site, species=other_species, timestamp=NOW, value=2.0)
+        Reading.objects.create(site=other_site, species=species, timestamp=NOW + dt.timedelta(hours=1), 
+                               value=3.0)
+        ReadingHighWaterMark.objects.create(site=site, timestamp=NOW)
+        ReadingHighWaterMark.objects.create(site=other_site, timestamp=NOW + dt.timedelta(hours=1))
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        apps = executor.loader.project_state(self.after).apps
+        self.assertEqual(list(apps.get_model('Emissions', 'LocalAuthority').objects.values_list('pk', flat=True)), 
+                         [la.pk])
+        self.assertEqual(list(apps.get_model('Emissions', 'Site').objects.values_list('pk', 'local_auth')), 
+                         [(site.pk, la.pk)])
+        self.assertEqual(list(apps.get_model('Emissions', 'Species').objects.values_list('pk', flat=True)), 
+                         [species.pk])
+        self.assertEqual(sorted(apps.get_model('Emissions', 'Reading').objects
+                                .values_list('site', 'species', 'value')),
+                         [(site.pk, species.pk, 1.0), (site.pk, species.pk, 3.0)])
+        self.assertEqual(list(apps.get_model('Emissions', 'ReadingHighWaterMark').objects
+                              .values_list('site', flat=True)), [site.pk])
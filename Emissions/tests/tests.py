@@ -14,7 +14,7 @@ class ServicesTest(TestCase):
 
     
     # - AirQualityApiData()
-    #     -- does the constructor work properly? Test with arg=True, False, None
+    #     -- does the constructor work properly? Test with a proxy URL, None
     
     #     -- get_hourly_site_readings; test with correct API against sample data;
     #     site code not supplied; start_date not supplied; end_date not supplied; 
@@ -22,7 +22,7 @@ class ServicesTest(TestCase):
     #     whether no data from API returns None from the function
     #     -- get_daily_index_on_date...
     def setUp(self):
-        self.api = AirQualityApiData(use_DES_proxy=False)
+        self.api = AirQualityApiData()
     
     def tearDown(self):
         del self.api
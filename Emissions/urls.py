@@ -2,5 +2,15 @@ from django.urls import path
 from . import views # import views.py from the current dir
 
 urlpatterns = [
-    path("", views.index)
+    path("", views.index),
+    path("api/snapshot", views.current_emissions),
+    path("api/sites", views.site_list),
+    path("api/sites/<str:site_code>/readings", views.site_readings),
+    path("api/local-authorities", views.local_authority_list),
+    path("api/species", views.species_list),
+    path("api/nowcast", views.nowcast_batch),
+    path("api/nowcast/cache-stats", views.nowcast_cache_stats),
+    path("api/borough", views.borough_lookup),
+    path("api/boundaries/<int:zoom>/<str:content_hash>.json", views.borough_boundaries),
+    path("metrics", views.metrics_view),
 ]
\ No newline at end of file
@@ -1,30 +1,356 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.log import log_response
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.conf import settings
 from Emissions.services import AirQualityApiData
-from Emissions.models import LocalAuthority, Species, Site
-
-from json import load
-import os
-
-def index(request):
-    """
-    Get data from the database / LondonAir API and pass it to the html page.
-    """
-    # get config file data from static/js/config.json
-    with open(os.path.join(settings.STATIC, 'js/config.json'), "r") as f:
-        config = load(f)
-    # get placeholder data
-    data = AirQualityApiData()    
-    # get a list of London local authorities from db
-    local_auths = list(LocalAuthority.objects.all().values())  
-    # get a list of sites from the db
-    sites = list(Site.objects.all().values())
-    # get a list of species from db
-    species = list(Species.objects.all().values())
-    return render(request, "Emissions/index.html", {"config": config,
-                                                    "emissions_info": species,
-                                                    "local_auths": local_auths,
-                                                    "sites": sites,
-                                                    "illness_types": data.illness_types(), 
-                                                    "emissions_data": data.get_current_emissions_across_london()})
\ No newline at end of file
+from Emissions.models import Site
+from Emissions import boroughs, boundaries, cache, metrics, pagecache, reference, store
+
+import datetime as dt
+from functools import wraps
+from json import loads
+from math import isfinite, isnan
+import numpy as np
+
+def choose_encoding(request, available):
+    """
+    Choose the content coding of a response from those available (in order of preference
+    on a tie), according to the q-values in the request's Accept-Encoding header.
+
+    Returns:
+    - one of available, or 'identity' if none of them is acceptable (e.g. "gzip;q=0")
+    """
+    qvalues = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        qvalues[coding] = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    qvalues[coding] = float(value)
+                except ValueError:
+                    qvalues[coding] = 0.0
+    # '*' is any coding that isn't listed
+    best = max(available, key=lambda coding: qvalues.get(coding, qvalues.get("*", 0.0)), default=None)
+    if best is None or qvalues.get(best, qvalues.get("*", 0.0)) <= 0:
+        return "identity"
+    return best
+
+async def index(request):
+    """
+    Get data from the database and pass it to the html page. The current emissions 
+    come from the local store, which is kept up to date by the ingest_airquality 
+    management command; the page never waits on the LondonAir API. The reference data
+    (local authorities, sites, species and config.json) comes from this process's cache
+    of it (see Emissions/reference.py).
+
+    The rendered page is cached until its data changes (see Emissions/pagecache.py), and
+    sent gzip-encoded if the client accepts it. It has an ETag of its content, and may be
+    stored by browsers and the CDN, but must be revalidated before each use.
+    """
+    def render_page():
+        # get placeholder data
+        data = AirQualityApiData()    
+        context = reference.get_reference_data()
+        emissions, stale = store.get_current_emissions_with_status()
+        context.update({"illness_types": data.illness_types(), 
+                        "boundaries": boundaries.variant_urls(),
+                        "emissions_data": emissions,
+                        "emissions_stale": stale})
+        return render(request, "Emissions/index.html", context).content
+
+    # the cache and database are only accessed synchronously
+    page = await sync_to_async(pagecache.get_index_page)(render_page)
+    encoding = choose_encoding(request, ["gzip"])
+    response = HttpResponse(page[encoding], content_type="text/html; charset=utf-8")
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    # each encoding is a different representation, so has a different (strong) ETag
+    etag = f'"{page["hash"]}"' if encoding == "identity" else f'"{page["hash"]}-{encoding}"'
+    response["ETag"] = etag
+    patch_vary_headers(response, ["Accept-Encoding"])
+    patch_cache_control(response, public=True, no_cache=True)
+    return get_conditional_response(request, etag=etag, response=response)
+
+def require_safe_async(view):
+    """
+    Decorator for async views that only accept the GET and HEAD methods; the async 
+    version of django's require_safe (which only supports sync views in Django 4.2).
+    """
+    @wraps(view)
+    async def wrapped(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            response = HttpResponseNotAllowed(["GET", "HEAD"])
+            log_response("Method Not Allowed (%s): %s", request.method, request.path,
+                         response=response, request=request)
+            return response
+        return await view(request, *args, **kwargs)
+    return wrapped
+
+def versioned(table, variant=None):
+    """
+    Decorator for async GET views whose response only depends on one table's data 
+    version (see cache.get_data_version), e.g. versioned('Site'). The response gets a 
+    strong ETag of the version token, and a Last-Modified of when it last changed (if 
+    known); requests with a matching If-None-Match or If-Modified-Since get a 304 without
+    running the view. Clients (and the CDN) may store the response, but must revalidate
+    it before each use. This does what django's condition decorator does for sync views.
+
+    If the response also depends on something that changes without a version bump, 
+    variant is a (sync) function that gets it as a string, or None for the usual 
+    response; e.g. 'stale' while the data is stale. It's added to the ETag, and while 
+    it's set there's no Last-Modified, as the data's modified time doesn't cover it.
+    """
+    def get_version():
+        return (cache.get_data_version(table), cache.get_data_modified(table),
+                variant() if variant is not None else None)
+
+    def decorator(view):
+        @wraps(view)
+        @require_safe_async
+        async def wrapped(request, *args, **kwargs):
+            version, modified, current_variant = await sync_to_async(get_version)()
+            if current_variant is not None:
+                version, modified = f"{version}-{current_variant}", None
+            etag = quote_etag(version)
+            if modified is not None and not timezone.is_aware(modified):
+                modified = timezone.make_aware(modified, dt.timezone.utc)
+            last_modified = int(modified.timestamp()) if modified is not None else None
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if last_modified and not response.has_header("Last-Modified"):
+                response.headers["Last-Modified"] = http_date(last_modified)
+            response.headers.setdefault("ETag", etag)
+            patch_cache_control(response, public=True, no_cache=True)
+            return response
+        return wrapped
+    return decorator
+
+
+def stale_variant():
+    """
+    The versioned variant of the current emissions: 'stale' while they are stale (see 
+    store.current_emissions_are_stale), so that clients revalidating a response that
+    was stored while they were fresh get the Warning header.
+    """
+    return "stale" if store.current_emissions_are_stale() else None
+
+
+@versioned('Snapshot', variant=stale_variant)
+async def current_emissions(request):
+    """
+    Get the current emissions snapshot for London (as embedded in the index page as 
+    emissions_data), as JSON; status 503 if no snapshot has been stored yet. If the 
+    emissions are stale (see store.current_emissions_are_stale), the response has a 
+    'Warning: 110' (response is stale) header.
+    """
+    emissions, stale = await sync_to_async(store.get_current_emissions_with_status)()
+    if emissions is None:
+        return JsonResponse({"error": "No emissions data is available yet"}, status=503)
+    response = JsonResponse(emissions, safe=False)
+    if stale:
+        response["Warning"] = '110 - "Response is Stale"'
+    return response
+
+
+@versioned('Site')
+async def site_list(request):
+    """
+    Get all of the sites, as JSON (a list of Site field dicts, as in the index page).
+    """
+    data = await sync_to_async(reference.get_reference_data)()
+    return JsonResponse(data["sites"], safe=False)
+
+
+@versioned('LocalAuthority')
+async def local_authority_list(request):
+    """
+    Get all of the London local authorities, as JSON.
+    """
+    data = await sync_to_async(reference.get_reference_data)()
+    return JsonResponse(data["local_auths"], safe=False)
+
+
+@versioned('Species')
+async def species_list(request):
+    """
+    Get all of the species, as JSON.
+    """
+    data = await sync_to_async(reference.get_reference_data)()
+    return JsonResponse(data["emissions_info"], safe=False)
+
+
+@require_safe_async
+async def site_readings(request, site_code):
+    """
+    Get a site's hourly readings on a day (query parameter date, YYYY-MM-DD; default is
+    today, UTC), for the site charts. The response is JSON of the form
+    {"site_code": "TDO", "date": "2019-01-01", "species": {"NO2": [24 values], ...}},
+    where each species has one value per hour from 00:00 (null where there's no reading).
+    Readings that aren't stored are requested from the LondonAir API without blocking the
+    event loop (see store.aget_site_day_readings).
+
+    The response has status 400 if the date is invalid, 404 if the site doesn't exist, 
+    or 502 if the readings aren't stored and the LondonAir API request failed.
+    """
+    try:
+        day = dt.date.fromisoformat(request.GET.get("date") or
+                                    dt.datetime.now(dt.timezone.utc).date().isoformat())
+    except ValueError:
+        return JsonResponse({"error": "date must be of the form YYYY-MM-DD"}, status=400)
+    if not await Site.objects.filter(code=site_code).aexists():
+        return JsonResponse({"error": f"No site with code {site_code}"}, status=404)
+    species = await store.aget_site_day_readings(site_code, day)
+    if species is None:
+        return JsonResponse({"error": "Readings are not available from the LondonAir API"}, 
+                            status=502)
+    return JsonResponse({"site_code": site_code, "date": day.isoformat(), "species": species})
+
+
+def parse_points(body, max_points):
+    """
+    Parse a request body of the form {"points": [[lat, lon], [lat, lon], ...]}.
+
+    Returns:
+    - a numpy array of the points (n x 2)
+
+    Raises:
+    - ValueError (with a message for the client) if the body is invalid, or has more than
+    max_points points
+    """
+    try:
+        points = np.array(loads(body)["points"], dtype=float)
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Body must be JSON of the form {\"points\": [[lat, lon], ...]}")
+    if points.size == 0:
+        points = points.reshape(0, 2)
+    if points.ndim != 2 or points.shape[1] != 2 or not np.isfinite(points).all():
+        raise ValueError("Each point must be a [lat, lon] pair of numbers")
+    if len(points) > max_points:
+        raise ValueError(f"At most {max_points} points can be requested at once")
+    return points
+
+
+@csrf_exempt
+@require_POST
+def nowcast_batch(request):
+    """
+    Estimate the current emissions at many points in one request. The request body is
+    JSON of the form {"points": [[lat, lon], [lat, lon], ...]}, with at most 
+    settings.AIRQUALITY_NOWCAST_MAX_POINTS points.
+
+    The response is JSON with the same keys as AirQualityApiData.nowcast, where each value
+    is a list aligned with the input points (null where there is no estimate), e.g.
+    {"@lat": [51.5, ...], "@lon": [-0.1, ...], "@NO2": [23.4, ...], "@NO2_Index": [1, ...], ...}
+    It has status 400 if the body is invalid, or 503 if there are no recent readings.
+    """
+    try:
+        points = parse_points(request.body, settings.AIRQUALITY_NOWCAST_MAX_POINTS)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    result = AirQualityApiData().nowcast_many(points[:, 0], points[:, 1])
+    if result is None:
+        return JsonResponse({"error": "No recent readings are available"}, status=503)
+    # NaN isn't valid JSON, so missing values are sent as null; and indices as ints
+    response = {}
+    for key, values in result.items():
+        cast = int if key.endswith("_Index") else float
+        response[key] = [None if isnan(value) else cast(value) for value in values.tolist()]
+    return JsonResponse(response)
+
+
+def nowcast_cache_stats(request):
+    """
+    Get the hit and miss counts of the cache of nowcasts from the LondonAir API, as JSON
+    of the form {"hits": 10, "misses": 2, "hit_ratio": 0.83}.
+    """
+    return JsonResponse(cache.get_nowcast_cache_stats())
+
+
+def metrics_view(request):
+    """
+    Get the app's metrics (see Emissions/metrics.py), in the Prometheus text format. If 
+    settings.AIRQUALITY_METRICS_TOKEN is set, the request must have the header 
+    'Authorization: Bearer <token>' (status 403 otherwise).
+    """
+    token = settings.AIRQUALITY_METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden("Forbidden")
+    content, content_type = metrics.render()
+    response = HttpResponse(content, content_type=content_type)
+    response["Cache-Control"] = "no-store"
+    return response
+
+
+def borough_boundaries(request, zoom, content_hash):
+    """
+    Serve the borough boundaries simplified for a map zoom level (see 
+    Emissions/boundaries.py), as GeoJSON. The URL includes a hash of the content, so the 
+    response can be cached indefinitely; it's sent brotli- or gzip-encoded if the client 
+    accepts it.
+    """
+    encodings = boundaries.get_variants().get(zoom)
+    if encodings is None or encodings["hash"] != content_hash:
+        raise Http404("No such boundaries")
+    encoding = choose_encoding(request, [encoding for encoding in ("br", "gzip") if encoding in encodings])
+    response = HttpResponse(encodings[encoding], content_type="application/json")
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    response["Vary"] = "Accept-Encoding"
+    response["ETag"] = f'"{content_hash}"'
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def local_authority_json(local_auth):
+    if local_auth is None:
+        return None
+    return {"id": local_auth.id, "name": local_auth.name, "code": local_auth.code}
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def borough_lookup(request):
+    """
+    Find the London borough (and LocalAuthority) that a point, or many points, are in.
+
+    - GET with query parameters lat and lon: the response is JSON of the form
+    {"borough": "Camden", "local_authority": {"id": 1, "name": "Camden", "code": 5}}, 
+    with nulls if the point isn't in London
+    - POST with a JSON body of the form {"points": [[lat, lon], ...]} (at most
+    settings.AIRQUALITY_BOROUGH_MAX_POINTS points): the response is JSON of the form
+    {"boroughs": [...], "local_authorities": [...]}, lists aligned with the points
+
+    The response has status 400 if the parameters or body are invalid.
+    """
+    if request.method == "GET":
+        try:
+            lat, lon = float(request.GET["lat"]), float(request.GET["lon"])
+        except (KeyError, ValueError):
+            return JsonResponse({"error": "lat and lon must be given as numbers"}, status=400)
+        found = boroughs.find_borough(lat, lon) if isfinite(lat) and isfinite(lon) else None
+        name, local_auth = found or (None, None)
+        return JsonResponse({"borough": name, "local_authority": local_authority_json(local_auth)})
+
+    try:
+        points = parse_points(request.body, settings.AIRQUALITY_BOROUGH_MAX_POINTS)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    found = [result or (None, None) for result in boroughs.find_boroughs(points[:, 0], points[:, 1])]
+    return JsonResponse({"boroughs": [name for name, _ in found],
+                         "local_authorities": [local_authority_json(la) for _, la in found]})
@@ -0,0 +1,164 @@
+##################################################################################
+# Micro-benchmark for the group MonitoringIndex parser (Emissions/parsers.py),
+# compared with the per-site, if/elif-based parser it replaced.
+#
+# Uses a synthetic payload with the same shape as the API's
+# /Hourly/MonitoringIndex/GroupName=.../Json response. To run:
+#   $> python benchmarks/bench_group_parser.py [--sites N] [--repeat R]
+##################################################################################
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Emissions.parsers import SPECIES_CODES, parse_group_rows
+
+
+def make_payload(n_sites, sites_per_la=5, seed=0):
+    """
+    Build a synthetic group MonitoringIndex with n_sites sites, each measuring a
+    random subset of species (plus the odd single-site LA and single-species site,
+    which the API returns as dicts rather than lists).
+    """
+    rng = random.Random(seed)
+    las = []
+    for la_num in range(0, n_sites, sites_per_la):
+        sites = []
+        for site_num in range(la_num, min(la_num + sites_per_la, n_sites)):
+            species = [{"@SpeciesCode": code, "@SpeciesDescription": code,
+                        "@AirQualityIndex": str(rng.randint(1, 10)),
+                        "@AirQualityBand": "Low", "@IndexSource": "Measurement"}
+                       for code in rng.sample(SPECIES_CODES, rng.randint(1, 4))]
+            sites.append({"@BulletinDate": "2019-05-01 10:00:00",
+                          "@SiteCode": f"S{site_num:03d}",
+                          "@SiteName": f"Site {site_num}",
+                          "@SiteType": "Roadside",
+                          "@Latitude": str(51.3 + rng.random() * 0.4),
+                          "@Longitude": str(-0.5 + rng.random() * 0.7),
+                          "@LatitudeWGS84": "", "@LongitudeWGS84": "",
+                          "Species": species if len(species) > 1 else species[0]})
+        las.append({"@LocalAuthorityCode": str(la_num), 
+                    "@LocalAuthorityName": f"LA {la_num}",
+                    "Site": sites if len(sites) > 1 else sites[0]})
+    return {"HourlyAirQualityIndex": {"@GroupName": "London", "@TimeToLive": "20",
+                                      "LocalAuthority": las}}
+
+
+# ------------------------------------------------------------------------------------
+# The previous parser (AirQualityApiData.process_group_emissions and helpers), for
+# comparison
+# ------------------------------------------------------------------------------------
+def legacy_setup_row_dict(site_data, la_name):
+    try:
+        return {"Local Authority name": la_name, 
+                "Site name": site_data["@SiteName"],
+                "Site code": site_data["@SiteCode"], 
+                "Site type": site_data["@SiteType"], 
+                "Date": site_data["@BulletinDate"], 
+                "Latitude": float(site_data["@Latitude"]), 
+                "Longitude": float(site_data["@Longitude"]), 
+                "Carbon Monoxide": None, 
+                "Nitrogen Dioxide": None, 
+                "Sulphur Dioxide": None, 
+                "Ozone": None, 
+                "PM10 Particulate": None, 
+                "PM2.5 Particulate": None}
+    except KeyError:
+        return None
+
+def legacy_get_species_type(species_info, row):
+    if species_info["@SpeciesCode"] == "CO":
+        row["Carbon Monoxide"] = float(species_info["@AirQualityIndex"])
+    elif species_info["@SpeciesCode"] == "NO2":
+        row["Nitrogen Dioxide"] = float(species_info["@AirQualityIndex"])
+    elif species_info["@SpeciesCode"] == "SO2":
+        row["Sulphur Dioxide"] = float(species_info["@AirQualityIndex"])
+    elif species_info["@SpeciesCode"] == "O3":
+        row["Ozone"] = float(species_info["@AirQualityIndex"])
+    elif species_info["@SpeciesCode"] == "PM10":
+        row["PM10 Particulate"] = float(species_info["@AirQualityIndex"])
+    elif species_info["@SpeciesCode"] == "PM25":
+        row["PM2.5 Particulate"] = float(species_info["@AirQualityIndex"])
+    return row
+
+def legacy_update_site_species_info(site, row):
+    if "Species" in site:
+        if isinstance(site["Species"], list) and row is not None:
+            for species in site["Species"]:
+                row = legacy_get_species_type(species, row)
+        elif isinstance(site["Species"], dict):
+            row = legacy_get_species_type(site["Species"], row)
+        else:
+            row = None
+    else:
+        row = None
+    return row
+
+def legacy_process_group_emissions(group_data, field1, field2):
+    output_data = []
+    for la in group_data[field1][field2]:
+        if 'Site' in la:
+            if isinstance(la['Site'], list):
+                for site in la['Site']:
+                    row = legacy_setup_row_dict(site, la["@LocalAuthorityName"]) 
+                    output_data.append(legacy_update_site_species_info(site, row))
+            elif isinstance(la['Site'], dict):
+                site = la['Site']
+                row = legacy_setup_row_dict(site, la["@LocalAuthorityName"])
+                output_data.append(legacy_update_site_species_info(site, row))
+    return output_data
+
+
+def payload_hash(data):
+    # as Emissions/store.payload_hash, which needs Django set up to import
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def legacy_ingest_snapshot(payload, field1, field2):
+    new_hash = payload_hash(payload)
+    return new_hash, json.dumps(legacy_process_group_emissions(payload, field1, field2))
+
+def rows_ingest_snapshot(payload, field1, field2):
+    rows = parse_group_rows(payload, field1, field2)
+    return payload_hash(rows), json.dumps(rows)
+
+
+def best_time(func, repeat, number):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sites", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    fields = ("HourlyAirQualityIndex", "LocalAuthority")
+    print("Times are per call (best of --repeat runs). 'parse' is the payload -> rows, by the")
+    print("legacy parser and by parse_group_rows (as used by process_group_emissions).")
+    print("'snapshot' is the ingest path end to end (Emissions/store.ingest_snapshot): hash, parse")
+    print("and serialise the rows, as stored; the legacy path hashed the payload, the current one")
+    print("hashes the rows, which is where most of the difference comes from.\n")
+    print(f"{'sites':>7} | {'parse: legacy':>13} {'rows':>9} {'speedup':>8} | "
+          f"{'snapshot: legacy':>16} {'rows':>9} {'speedup':>8}")
+    for n_sites in args.sites:
+        payload = make_payload(n_sites)
+        assert parse_group_rows(payload, *fields) == legacy_process_group_emissions(payload, *fields)
+
+        number = max(1, 20000 // n_sites)
+        parse_legacy = best_time(lambda: legacy_process_group_emissions(payload, *fields), args.repeat, number)
+        parse_rows = best_time(lambda: parse_group_rows(payload, *fields), args.repeat, number)
+        snapshot_legacy = best_time(lambda: legacy_ingest_snapshot(payload, *fields), args.repeat, number)
+        snapshot_rows = best_time(lambda: rows_ingest_snapshot(payload, *fields), args.repeat, number)
+        print(f"{n_sites:>7} | {parse_legacy * 1e3:>11.3f}ms {parse_rows * 1e3:>7.3f}ms "
+              f"{parse_legacy / parse_rows:>7.2f}x | "
+              f"{snapshot_legacy * 1e3:>14.3f}ms {snapshot_rows * 1e3:>7.3f}ms "
+              f"{snapshot_legacy / snapshot_rows:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
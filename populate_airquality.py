@@ -11,6 +11,16 @@
 #   $> python manage.py makemigrations      [Updates the models with any changes]
 #   $> python manage.py migrate             [Creates the database schema]
 #   $> python populate_airquality           [Runs this script to populate the db]
+#
+# The script can safely be re-run against an existing database; each table is 
+# upserted (keyed on LocalAuthority.name, Species.code, Site.code and 
+# HealthAdvice.quality_band) in bulk, inside a single transaction.
+#
+# To refresh an existing database incrementally (e.g. hourly, from a scheduler), 
+# run:
+#   $> python populate_airquality.py --refresh
+# This only writes the rows that have been inserted, changed or closed upstream, 
+# and skips any table whose API payload is unchanged since the last refresh.
 ##################################################################################
 
 # setting these environment variables before anything is run is *essential*!
@@ -19,195 +29,338 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AirQuality.settings')
 
 import django
 django.setup()
-from Emissions.models import LocalAuthority, Species, Site, HealthAdvice
+from django.db import transaction
+from Emissions import cache
+from Emissions.models import LocalAuthority, Species, Site, HealthAdvice, ReferencePayload
+from Emissions.http_client import get_client
+from Emissions.parsers import as_list
+from Emissions.services import map_concurrently
+from Emissions.store import payload_hash
 
-import pandas as pd
+import argparse
+import logging
 import requests
 import datetime as dt
-from sys import exit
+
+logger = logging.getLogger(__name__)
+
+# API endpoints for each of the reference tables (the group name is filled in later)
+GROUPS_URL = "/Information/Groups/Json"
+LOCAL_AUTHORITIES_URL = "/Information/MonitoringLocalAuthority/GroupName={group}/Json"
+SPECIES_URL = "/Information/Species/Json"
+SITES_URL = "/Information/MonitoringSiteSpecies/GroupName={group}/Json"
+HEALTH_ADVICE_URL = "/Information/IndexHealthAdvice/json"
+
+SPECIES_CODES = ['CO', 'NO2', 'O3', 'PM10', 'PM25', 'SO2']
+# fields of a Site that are cleared when it disappears from the API data
+SITE_ACTIVE_FIELDS = ['site_still_active', 'co_measure_active', 'no2_measure_active', 
+                      'o3_measure_active', 'pm10_measure_active', 'pm25_measure_active', 
+                      'so2_measure_active']
 
 class PopulateDb():
     """
-    Main class to populate the sqlite database. Add new methods to populate other
-    tables as required.
+    Main class to populate the database. The data for every table is fetched from the 
+    LondonAir API concurrently, then each table is upserted with a single bulk query.
+    Add new build_* methods to populate other tables as required.
     """
-    def __init__(self, use_proxy=False, group='London'):
-        """Determine whether or not to use the DES proxy required for DES, and 
-            which grouping to use (default is London)"""
+    def __init__(self, proxy=None, group='London'):
+        """Determine which proxy server to use, if any (default is settings.AIRQUALITY_PROXY), 
+            and which grouping to use (default is London)"""
         self.group = group
-        if use_proxy == True:
-            self.proxy = {'http' : 'http://10.160.27.36:3128'}
-        else:
-            self.proxy = None
-     
-    def populate_local_authorities(self):
-        """
-        Get LocalAuthority (i.e. location) data from the LondonAir API and create 
-        a LocalAuthority object for each item in the dict that's returned.
-
-        If the API doesn't return a valid response, print a message to the console.
-        
-        """
-        grp_url = "/Information/Groups/Json"
-        la_url = "/Information/MonitoringLocalAuthority/GroupName=London/Json"
-        grp_data = pd.DataFrame(self.get_data_from_API(grp_url)["Groups"]["Group"])
-        la_data = pd.DataFrame(self.get_data_from_API(la_url)["LocalAuthorities"]["LocalAuthority"])
-        if grp_data is not None and la_data is not None:
-            df = la_data.merge(grp_data, left_on='@LocalAuthorityName', right_on='@Description')
-            for item in df[["@LocalAuthorityName", "@LocalAuthorityCode", "@HomeURL", 
-                            "@LaCentreLatitude", "@LaCentreLongitude"]].to_dict(orient="records"):
-                la = LocalAuthority.objects.get_or_create(name=item["@LocalAuthorityName"],
-                                                        code=item["@LocalAuthorityCode"],
-                                                        latitude=item["@LaCentreLatitude"],
-                                                        longitude=item["@LaCentreLongitude"],
-                                                        link=item["@HomeURL"])[0]
-                la.save()
-        else:
-            print("LondonAir API returned a 404 error for Local Authorities/ Groups")
-    
-    def populate_species(self):
-        """
-        Get Species (i.e. emission) data from the LondonAir API and create a Species
-        object for each item in the dict that's returned.
-
-        If the API doesn't return a valid response, print a message to the console
-        """
-        data = self.get_data_from_API("/Information/Species/Json")
-        if data is not None:
-            for item in data["AirQualitySpecies"]["Species"]:
-                species = Species.objects.get_or_create(name=item["@SpeciesName"],
-                                                    code=item["@SpeciesCode"],
-                                                    description=item["@Description"],
-                                                    health_effect=item["@HealthEffect"],
-                                                    link=item["@Link"])[0]
-                species.save()
-        else:
-            print("LondonAir API returned a 404 error for Species")
+        self.proxy = proxy
+
+    def fetch_all(self):
+        """
+        Get the data for all of the tables from the LondonAir API, concurrently.
+
+        Returns:
+        - a dict of the JSON returned for each endpoint, with keys 'groups', 
+        'local_authorities', 'species', 'sites' and 'health_advice' (None for any 
+        endpoint that returned an error)
+        """
+        urls = {"groups": GROUPS_URL,
+                "local_authorities": LOCAL_AUTHORITIES_URL.format(group=self.group),
+                "species": SPECIES_URL,
+                "sites": SITES_URL.format(group=self.group),
+                "health_advice": HEALTH_ADVICE_URL}
+        return dict(zip(urls.keys(), map_concurrently(self.get_data_from_API, urls.values())))
+
+    def build_local_authorities(self, grp_data, la_data):
+        """
+        Create (unsaved) LocalAuthority objects from the LondonAir API's Groups and 
+        MonitoringLocalAuthority data. Only LAs which are also a Group are included.
+        """
+        groups = {grp["@Description"] for grp in as_list(grp_data["Groups"]["Group"])}
+        return [LocalAuthority(name=item["@LocalAuthorityName"],
+                               code=item["@LocalAuthorityCode"],
+                               latitude=item["@LaCentreLatitude"],
+                               longitude=item["@LaCentreLongitude"],
+                               link=item["@HomeURL"])
+                for item in as_list(la_data["LocalAuthorities"]["LocalAuthority"])
+                if item["@LocalAuthorityName"] in groups]
     
-    def populate_sites(self):
-        """
-        Get Site (i.e. measurement location) metadata from the LondonAir API and 
-        create a Sites object for each item in the dict that's returned.
-
-        If the API doesn't return a valid response, print a message to the console
-        """
-        data = self.get_data_from_API(f"/Information/MonitoringSiteSpecies/GroupName={self.group}/Json")
-        if data is not None:
-            for item in data['Sites']['Site']:
-                try:
-                    la = LocalAuthority.objects.get(name=item["@LocalAuthorityName"])
-                
-                    if item["@SiteCode"] != 'WMZ': #No lat/long info, site was only open
-                                        #for three months in 2016, breaks everything else
-                        
-                        date_opened = dt.datetime.strptime(item["@DateOpened"], 
-                                                                '%Y-%m-%d %H:%M:%S')
-                        date_opened = date_opened.replace(tzinfo = dt.timezone.utc)
-                        
-                        if item["@DateClosed"] == '':
-                            site_active = True
-                            date_closed = None
-                        else:    
-                            site_active = False
-                            date_closed = dt.datetime.strptime(item["@DateClosed"], 
-                                                                '%Y-%m-%d %H:%M:%S')
-                            date_closed = date_closed.replace(tzinfo = dt.timezone.utc)
-                            
-                        if type(item["Species"]) != list:
-                            item_species = {item["Species"]["@SpeciesCode"] : 
-                                            item["Species"]["@DateMeasurementFinished"]}    
-                        else:
-                            item_species = {i["@SpeciesCode"]: i['@DateMeasurementFinished'] 
-                                            for i in item["Species"]}
-                            
-                        species_codes = ['CO', 'NO2', 'O3', 'PM10', 'PM25', 'SO2']
-                        species_active = {i: False for i in species_codes}
-                        for i in species_active:
-                            if i in item_species.keys():
-                                if item_species[i] == '':
-                                    species_active[i] = True
-                                            
-                        sites = Site.objects.get_or_create(
-                            name = item["@SiteName"],
-                            code = item["@SiteCode"], 
-                            site_type = item["@SiteType"],
-                            local_auth = la,    # use the relevant LocalAuthority object
-                            link = item["@SiteLink"],
-                            latitude = float(item["@Latitude"]),
-                            longitude = float(item["@Longitude"]),
-                            site_date_open = date_opened,
-                            site_date_closed = date_closed,
-                            site_still_active = site_active,
-                            co_measure_active = species_active["CO"],
-                            no2_measure_active = species_active["NO2"],
-                            o3_measure_active = species_active["O3"],
-                            pm10_measure_active = species_active["PM10"],
-                            pm25_measure_active = species_active["PM25"],
-                            so2_measure_active = species_active["SO2"])[0]
-                        
-                        sites.save()
-                except LocalAuthority.DoesNotExist:
-                    print(f"Local Authority {item['@LocalAuthorityName']} not found")
-        else:
-            print("LondonAir API returned a 404 error for Sites")
+    def build_species(self, data):
+        """
+        Create (unsaved) Species objects from the LondonAir API's Species data.
+        """
+        return [Species(name=item["@SpeciesName"],
+                        code=item["@SpeciesCode"],
+                        description=item["@Description"],
+                        health_effect=item["@HealthEffect"],
+                        link=item["@Link"])
+                for item in as_list(data["AirQualitySpecies"]["Species"])]
     
-    def populate_health_advice(self):
-        """
-        Get Health Advice Index data from the LondonAir API and create a 
-        HealthAdvice object for each item in the dict that's returned.
-
-        If the API doesn't return a valid response, print a message to the console
-        """
-        data = self.get_data_from_API("/Information/IndexHealthAdvice/json")
-        if data is not None:
-            hai_entries = data['AirQualityIndexHealthAdvice']['HealthAdvice']
-            HAI = []
-            for pair in range(1, len(hai_entries), 2):
-                band_at_risk = hai_entries[pair-1]
-                band_gen_pop = hai_entries[pair]
-                common_keys = list(band_at_risk.keys())[:3]
-                band_details = {i : band_at_risk[i] for i in common_keys}
-                band_details[band_at_risk["@Group"]] = band_at_risk["@Advice"]
-                band_details[band_gen_pop["@Group"]] = band_gen_pop["@Advice"]
-                HAI.append(band_details)
+    def build_sites(self, data, la_ids):
+        """
+        Create (unsaved) Site objects from the LondonAir API's MonitoringSiteSpecies data.
+
+        Parameters:
+        - data (dict), the JSON returned by the API
+        - la_ids (dict), mapping of LocalAuthority name to id
+        """
+        sites = []
+        for item in as_list(data['Sites']['Site']):
+            if item["@SiteCode"] == 'WMZ': #No lat/long info, site was only open
+                                #for three months in 2016, breaks everything else
+                continue
+            if item["@LocalAuthorityName"] not in la_ids:
+                print(f"Local Authority {item['@LocalAuthorityName']} not found")
+                continue
+            
+            date_opened = dt.datetime.strptime(item["@DateOpened"], '%Y-%m-%d %H:%M:%S')
+            date_opened = date_opened.replace(tzinfo = dt.timezone.utc)
+            if item["@DateClosed"] == '':
+                site_active = True
+                date_closed = None
+            else:    
+                site_active = False
+                date_closed = dt.datetime.strptime(item["@DateClosed"], '%Y-%m-%d %H:%M:%S')
+                date_closed = date_closed.replace(tzinfo = dt.timezone.utc)
             
-            for item in HAI:
-                advice = HealthAdvice.objects.get_or_create(
-                            quality_band = item["@AirQualityBand"],
-                            lower_index = item["@LowerAirQualityIndex"],
-                            upper_index = item["@UpperAirQualityIndex"],
-                            advice_gen_pop = item['General population'],
-                            advice_at_risk = item['At-risk individuals'])[0]
-                
-                advice.save()
-        else:
-            print("LondonAir API returned a 404 error for Health Advice")
+            # a species is actively measured if its measurement hasn't finished
+            item_species = {i["@SpeciesCode"]: i['@DateMeasurementFinished'] 
+                            for i in as_list(item.get("Species"))}
+            species_active = {i: item_species.get(i) == '' for i in SPECIES_CODES}
+                                    
+            sites.append(Site(
+                name = item["@SiteName"],
+                code = item["@SiteCode"], 
+                site_type = item["@SiteType"],
+                local_auth_id = la_ids[item["@LocalAuthorityName"]],
+                link = item["@SiteLink"],
+                latitude = float(item["@Latitude"]),
+                longitude = float(item["@Longitude"]),
+                site_date_open = date_opened,
+                site_date_closed = date_closed,
+                site_still_active = site_active,
+                co_measure_active = species_active["CO"],
+                no2_measure_active = species_active["NO2"],
+                o3_measure_active = species_active["O3"],
+                pm10_measure_active = species_active["PM10"],
+                pm25_measure_active = species_active["PM25"],
+                so2_measure_active = species_active["SO2"]))
+        return sites
+    
+    def build_health_advice(self, data):
+        """
+        Create (unsaved) HealthAdvice objects from the LondonAir API's IndexHealthAdvice 
+        data. The API gives the advice for at-risk individuals and the general population
+        for each band as consecutive entries; these are combined into one object.
+        """
+        hai_entries = data['AirQualityIndexHealthAdvice']['HealthAdvice']
+        advice = []
+        for pair in range(1, len(hai_entries), 2):
+            band_at_risk = hai_entries[pair-1]
+            band_gen_pop = hai_entries[pair]
+            groups = {band_at_risk["@Group"]: band_at_risk["@Advice"],
+                      band_gen_pop["@Group"]: band_gen_pop["@Advice"]}
+            advice.append(HealthAdvice(
+                        quality_band = band_at_risk["@AirQualityBand"],
+                        lower_index = band_at_risk["@LowerAirQualityIndex"],
+                        upper_index = band_at_risk["@UpperAirQualityIndex"],
+                        advice_gen_pop = groups['General population'],
+                        advice_at_risk = groups['At-risk individuals']))
+        return advice
+
+    def upsert(self, model, objs, unique_field):
+        """
+        Insert objs into model's table in a single bulk query, updating the existing row 
+        wherever one with the same unique_field already exists.
+        """
+        update_fields = [field.name for field in model._meta.concrete_fields 
+                         if not field.primary_key and field.name != unique_field]
+        model.objects.bulk_create(objs, batch_size=500, update_conflicts=True,
+                                  unique_fields=[unique_field], update_fields=update_fields)
+        # bulk queries don't send the signals that mark the table as changed
+        transaction.on_commit(lambda: cache.bump_data_version(model.__name__))
+        return len(objs)
+
+    def populate(self):
+        """
+        Fetch the data for every table from the LondonAir API, and upsert it all inside
+        a single transaction. Tables whose API endpoint returned an error are skipped,
+        with a message printed to the console.
+        """
+        data = self.fetch_all()
+        with transaction.atomic():
+            if data["groups"] is not None and data["local_authorities"] is not None:
+                self.upsert(LocalAuthority, 
+                            self.build_local_authorities(data["groups"], data["local_authorities"]), 
+                            "name")
+            else:
+                print("LondonAir API returned an error for Local Authorities/ Groups")
+
+            if data["species"] is not None:
+                self.upsert(Species, self.build_species(data["species"]), "code")
+            else:
+                print("LondonAir API returned an error for Species")
+
+            if data["sites"] is not None:
+                # resolve foreign keys from one query, rather than one per site
+                la_ids = dict(LocalAuthority.objects.values_list("name", "id"))
+                self.upsert(Site, self.build_sites(data["sites"], la_ids), "code")
+            else:
+                print("LondonAir API returned an error for Sites")
+
+            if data["health_advice"] is not None:
+                self.upsert(HealthAdvice, self.build_health_advice(data["health_advice"]), "quality_band")
+            else:
+                print("LondonAir API returned an error for Health Advice")
       
+    def refresh_table(self, model, objs, unique_field):
+        """
+        Bring model's table into line with objs, writing only the rows that have changed: 
+        objs with a new unique_field value are inserted, and existing rows are updated 
+        (only in the fields that differ) if their content has changed.
+
+        Parameters:
+        - model (django model class), e.g. Site
+        - objs (list), unsaved model objects built from the API data
+        - unique_field (str), the name of the field that identifies a row, e.g. "code"
+
+        Returns:
+        - a dict with the number of rows 'inserted' and 'updated'
+        """
+        fields = [field for field in model._meta.concrete_fields 
+                  if not field.primary_key and field.name != unique_field]
+        existing = {getattr(obj, unique_field): obj for obj in model.objects.all()}
+        inserted, updated, changed_fields = [], [], set()
+        for obj in objs:
+            current = existing.get(getattr(obj, unique_field))
+            if current is None:
+                inserted.append(obj)
+                continue
+            # compare the normalised values, since the API gives numbers as strings
+            changed = False
+            for field in fields:
+                value = field.to_python(getattr(obj, field.attname))
+                if field.to_python(getattr(current, field.attname)) != value:
+                    setattr(current, field.attname, value)
+                    changed_fields.add(field.name)
+                    changed = True
+            if changed:
+                updated.append(current)
+        if inserted:
+            model.objects.bulk_create(inserted, batch_size=500)
+        if updated:
+            model.objects.bulk_update(updated, sorted(changed_fields), batch_size=500)
+        return {"inserted": len(inserted), "updated": len(updated)}
+
+    def close_missing_sites(self, data):
+        """
+        Mark any active Site that is no longer in the API's MonitoringSiteSpecies data as 
+        closed (i.e. no longer active, and not measuring any species).
+
+        Returns:
+        - int, the number of sites closed
+        """
+        codes = {item["@SiteCode"] for item in as_list(data['Sites']['Site'])}
+        missing = Site.objects.filter(site_still_active=True).exclude(code__in=codes)
+        return missing.update(**{field: False for field in SITE_ACTIVE_FIELDS})
+
+    def refresh(self, force=False):
+        """
+        Incrementally refresh the tables from the LondonAir API, inside a single 
+        transaction. Each table is skipped if the hash of its API payload is the same as 
+        at the last refresh (unless force is True); otherwise only the inserted, updated 
+        or closed rows are written. Tables whose API endpoint returned an error are 
+        skipped, with a message printed to the console.
+
+        Returns:
+        - a dict of the changes made to each table that was refreshed, keyed on the 
+        model name, e.g. {'Site': {'inserted': 0, 'updated': 2, 'closed': 1}}
+        """
+        data = self.fetch_all()
+        payloads = {LocalAuthority: [data["groups"], data["local_authorities"]],
+                    Species: [data["species"]],
+                    Site: [data["sites"]],
+                    HealthAdvice: [data["health_advice"]]}
+        stored_hashes = dict(ReferencePayload.objects.values_list("table", "payload_hash"))
+        changes = {}
+        with transaction.atomic():
+            for model, payload in payloads.items():
+                table = model.__name__
+                if any(item is None for item in payload):
+                    print(f"LondonAir API returned an error for {table}; not refreshed")
+                    continue
+                new_hash = payload_hash(payload)
+                if not force and stored_hashes.get(table) == new_hash:
+                    continue
+
+                if model is LocalAuthority:
+                    changes[table] = self.refresh_table(
+                        model, self.build_local_authorities(*payload), "name")
+                elif model is Species:
+                    changes[table] = self.refresh_table(model, self.build_species(*payload), "code")
+                elif model is Site:
+                    # resolve foreign keys from one query, after any new LAs are added
+                    la_ids = dict(LocalAuthority.objects.values_list("name", "id"))
+                    changes[table] = self.refresh_table(
+                        model, self.build_sites(*payload, la_ids), "code")
+                    changes[table]["closed"] = self.close_missing_sites(*payload)
+                else:
+                    changes[table] = self.refresh_table(
+                        model, self.build_health_advice(*payload), "quality_band")
+                ReferencePayload.objects.update_or_create(
+                    table=table, defaults={"payload_hash": new_hash})
+                # bulk queries don't send the signals that mark the table as changed
+                if any(changes[table].values()):
+                    transaction.on_commit(lambda table=table: cache.bump_data_version(table))
+        return changes
+
     def get_data_from_API(self, url):
         """
-        Get data from the LondonAir API. If a connection cannot be made, print 
-        a message to the console and exit.
+        Get data from the LondonAir API (as AirQualityApiData.fetch_from_API). If a 
+        connection cannot be made, log a warning and return None, so that the table is 
+        skipped (see populate and refresh).
         """
-        root = "https://api.erg.kcl.ac.uk/AirQuality"
+        client = get_client()
         try:
-            response = requests.get(root + url, proxies = self.proxy)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return None
-        except requests.exceptions.ConnectionError:
-            print("No response from LondonAir API server")
-            exit(1)       
+            return client.get_json(url, self.proxy)
+        except requests.exceptions.RequestException:
+            logger.warning("No response from %s; is the URL correct?", client.base_url + url)
+            return None
 
 def main(): 
     """
     Driver function
     """
-    pd = PopulateDb(use_proxy=False, group='London')
-    pd.populate_local_authorities()
-    pd.populate_species()
-    pd.populate_sites()
-    pd.populate_health_advice()
+    parser = argparse.ArgumentParser(description="Populate the database from the LondonAir API")
+    parser.add_argument("--refresh", action="store_true", 
+                        help="Only write the rows that have changed since the last refresh")
+    parser.add_argument("--force", action="store_true",
+                        help="With --refresh, compare every table even if its payload is unchanged")
+    args = parser.parse_args()
+
+    pd = PopulateDb(group='London')
+    if args.refresh:
+        changes = pd.refresh(force=args.force)
+        if not changes:
+            print("No changes to the reference data")
+        for table, counts in changes.items():
+            print(f"{table}: " + ", ".join(f"{count} {change}" for change, count in counts.items()))
+    else:
+        pd.populate()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -27,6 +27,10 @@ console.log(EMISSION_LEVELS);
 const EMISSION_INFO = JSON.parse(document.getElementById(CONFIG.CONSTANTS.JSON_SCRIPT.EMISSIONS_INFO_ID).textContent);
 const LOCAL_AUTHORITIES = JSON.parse(document.getElementById(CONFIG.CONSTANTS.JSON_SCRIPT.LOCAL_AUTHS_ID).textContent);
 const SITES = JSON.parse(document.getElementById(CONFIG.CONSTANTS.JSON_SCRIPT.SITES_ID).textContent);
+// URLs of the borough boundaries, simplified for each map zoom level: {"10": "/api/...", ...}
+const BOUNDARY_URLS = JSON.parse(document.getElementById(CONFIG.CONSTANTS.JSON_SCRIPT.BOUNDARIES_ID).textContent);
+// boundaries GeoJSON that has been loaded, by zoom level
+const BOUNDARIES = {};
 
 // default values for drop-down menus
 const DEFAULT_EMISSIONS = "Nitrogen Dioxide";
@@ -99,9 +103,6 @@ const EMISSION_LOOKUP = {"CO": {"name": "Carbon Monoxide",
                                 "chartObject": SO2_GRAPH}
                         };
 
-// Root of the LondonAir API
-const API_ROOT = "https://api.erg.kcl.ac.uk/AirQuality/";
-
 // ***************************************************************************************************
 // Helper functions 
 // ***************************************************************************************************
@@ -176,25 +177,6 @@ function addTableRow(tableId, position, info){
     });  
 }
 
-function parseResponse(jsonResponse){
-    let data = {"CO": [], "NO2": [], "O3": [], "PM10": [], "PM25": [], "SO2": []};
-    // get today's air quality data
-    jsonResponse["AirQualityData"]["Data"].forEach(function(d){
-        if(d["@SpeciesCode"] in data){
-            const value = d["@Value"] !== "" ? parseFloat(d["@Value"]) : 0;
-            data[d["@SpeciesCode"]].push(value);
-        }
-    });
-    // each array should have a value for the times 00:00 -> 23:00, so add trailing
-    // zeros for any timestamp where there isn't data yet.
-    const keys = Object.keys(data);
-    keys.forEach(function(d){
-        const numZeros = TIMES.length - data[d].length;
-        data[d].concat(Array(numZeros).fill(0));
-    })
-    return data;
-}
-
 function clearGraphs(){
     // clear all charts, i.e. DOM elements with class 'chart'
     const keys = Object.keys(EMISSION_LOOKUP);
@@ -252,6 +234,11 @@ function plotDaysEmissionsGraph(emissionCode, graphData){
     });
 }
 
+/**
+ * Get a site's hourly readings for a day from the server (which caches them, and pivots 
+ * them into an array of 24 hourly values per species), and plot them.
+ * @param {string} URL 
+ */
 function makeRequest(URL) {
     const httpRequest = new XMLHttpRequest();
 
@@ -263,17 +250,14 @@ function makeRequest(URL) {
     httpRequest.open('GET', URL, true);
     httpRequest.onreadystatechange = function() {
         if (this.readyState === XMLHttpRequest.DONE && this.status === 200) {
-            console.log("Success! JSON response:")
-            const response = JSON.parse(this.responseText);
-            const emissionsData = parseResponse(response);
-            console.log(emissionsData);
+            const emissionsData = JSON.parse(this.responseText)["species"];
             const keys = Object.keys(emissionsData);
             keys.forEach(function(d){
-                // if the graph data is all zeros, we don't want to plot it
+                // if the graph data is all zeros (or missing), we don't want to plot it
                 const allZero = emissionsData[d].every(function(e){ 
-                    return e === 0;
+                    return e === 0 || e === null;
                 });
-                if(emissionsData[d].length > 0 && !allZero){
+                if(d in EMISSION_LOOKUP && !allZero){
                     plotDaysEmissionsGraph(d, emissionsData[d]);
                 }
             });
@@ -282,21 +266,12 @@ function makeRequest(URL) {
     httpRequest.send();
 }
 
-function formatDate(date){
-    const dateArray = date.toDateString().split(" ");
-    return dateArray[2] + dateArray[1] + dateArray[3];
-}
-
 function showSiteEmissions(siteName){
     clearGraphs();
     const siteCode = SITES.find(function(d) { return d["name"] === siteName })["code"];
     document.getElementById(CONFIG.HTML.SITES.TITLE.ID).innerHTML = siteName;
-    const today = new Date();
-    const tomorrow = new Date(today.getFullYear(), today.getMonth(), today.getDate() + 1);
-    const startDate = formatDate(today);
-    const endDate = formatDate(tomorrow);
-    const url = API_ROOT.concat("Data/Site/SiteCode=", siteCode, "/StartDate=", startDate, "/EndDate=", endDate, "/Json");
-    makeRequest(url);
+    // the server defaults to today's readings
+    makeRequest("/api/sites/" + encodeURIComponent(siteCode) + "/readings");
 }
 
 function shortSiteName(fullSiteName){
@@ -385,8 +360,64 @@ function getSitesInLocalAuthority(la_name){
     return SITES.filter(function(d) { return d["local_auth_id"] === la["code"]; });
 }
 
-function getGeojsonForLocalAuthority(la_name){
-    return GEOJSON['features'].find(function(d){
+/**
+ * Get the zoom level of the boundaries to use at a map zoom level; i.e. the most detailed
+ * boundaries that are no more detailed than the map can show (or the least detailed, if 
+ * the map is zoomed out beyond all of them).
+ * @param {number} mapZoom 
+ */
+function getBoundaryZoom(mapZoom){
+    const zooms = Object.keys(BOUNDARY_URLS).map(Number).sort(function(a, b) { return a - b; });
+    let boundaryZoom = zooms[0];
+    zooms.forEach(function(zoom){
+        if(zoom <= mapZoom) { boundaryZoom = zoom; }
+    });
+    return boundaryZoom;
+}
+
+/**
+ * Load the borough boundaries for a map zoom level (if they haven't been already), then 
+ * call callback with the GeoJSON.
+ * @param {number} mapZoom 
+ * @param {function} callback 
+ */
+function loadBoundaries(mapZoom, callback){
+    const zoom = getBoundaryZoom(mapZoom);
+    if(BOUNDARIES[zoom] !== undefined){
+        callback(BOUNDARIES[zoom]);
+        return;
+    }
+    const httpRequest = new XMLHttpRequest();
+    httpRequest.open('GET', BOUNDARY_URLS[zoom], true);
+    httpRequest.onreadystatechange = function() {
+        if (this.readyState === XMLHttpRequest.DONE && this.status === 200) {
+            BOUNDARIES[zoom] = JSON.parse(this.responseText);
+            callback(BOUNDARIES[zoom]);
+        }
+    };
+    httpRequest.send();
+}
+
+/**
+ * Find the London borough (and local authority) that a point is in, from the server's
+ * point-in-borough lookup; the callback gets the JSON response, with a null borough if the
+ * point isn't in London.
+ * @param {L.LatLng} latlng 
+ * @param {function} callback 
+ */
+function lookupBorough(latlng, callback){
+    const httpRequest = new XMLHttpRequest();
+    httpRequest.open('GET', '/api/borough?lat=' + latlng.lat + '&lon=' + latlng.lng, true);
+    httpRequest.onreadystatechange = function() {
+        if (this.readyState === XMLHttpRequest.DONE && this.status === 200) {
+            callback(JSON.parse(this.responseText));
+        }
+    };
+    httpRequest.send();
+}
+
+function getGeojsonForLocalAuthority(geojson, la_name){
+    return geojson['features'].find(function(d){
         return d['properties']['name'] === la_name;
     });
 }
@@ -435,6 +466,13 @@ function main(){
 
         L.circle(pos.latlng, radius).addTo(map);
         userLoc = {"latlng": pos.latlng, "bounds": pos.bounds};
+        // if the user is in a London borough, centre the view on them
+        lookupBorough(pos.latlng, function(result){
+            if(result["borough"] !== null){
+                userLoc["borough"] = result["borough"];
+                map.fitBounds(userLoc["bounds"], maxZoom = 4);
+            }
+        });
     }
 
     function onLocationError(e) {
@@ -442,19 +480,6 @@ function main(){
         return e.message;
     }
 
-    function isPointInLondon(latlng) {        
-        if(latlng !== null) {
-            if(MIN_LAT <= latlng[0]  && latlng[0] <= MAX_LAT) {
-                if(MIN_LNG <= latlng[1]  && latlng[1] <= MAX_LNG) {
-                    // the user's latlng is within greater London
-                    return true;
-                }
-            }
-        } else {
-            return false; 
-        }
-    }   
-
 	// get tiles from openstreetmap.org, add attribution etc. Add tiles to map.
 	let baseLayer = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
 			attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a>',
@@ -480,6 +505,23 @@ function main(){
 
     // create the goejson polygon
     let geoJsonLayer = L.geoJSON();
+    let selectedLocalAuth = null;
+
+    /**
+     * Draw the boundary of the selected local authority (if any), loading the boundaries
+     * for the map's current zoom level if necessary.
+     */
+    function drawLocalAuthBoundary(){
+        if(selectedLocalAuth === null) { return; }
+        const localAuth = selectedLocalAuth;
+        loadBoundaries(map.getZoom(), function(geojson){
+            // the selection may have changed while the boundaries were loading
+            if(localAuth !== selectedLocalAuth) { return; }
+            // get rid of the existing local authority polygon layer, and draw a new LA polygon
+            map.removeLayer(geoJsonLayer);
+            geoJsonLayer = L.geoJSON(getGeojsonForLocalAuthority(geojson, localAuth)).addTo(map);
+        });
+    }
 
     // create a circle for each marker
     // BETTER WAY: 
@@ -572,16 +614,12 @@ function main(){
     // set up callbacks based on whether user's location was correctly found
     map.on('locationfound', onLocationFound);
     map.on('locationerror', onLocationError);
-    // if the user's location is available, get both the (lat, lng) coords and a bounding box.
-    if(isPointInLondon(userLoc["latlng"])){
-        map.fitBounds(userLoc["bounds"], maxZoom = 4);
-    } else {
-        // otherwise, set the box on central London
-        map.fitBounds([
-            [MIN_LAT, MIN_LNG],
-            [MAX_LAT, MAX_LNG]
-        ]);
-    } 
+    // set the box on central London, until the user's location is found (if it's in London, 
+    // onLocationFound moves the view to it)
+    map.fitBounds([
+        [MIN_LAT, MIN_LNG],
+        [MAX_LAT, MAX_LNG]
+    ]);
     // initialise the heatmap with data from API
     document.getElementById(CONFIG.HTML.LISTS.EMISSION_LIST_ID).value = DEFAULT_CODE;    
     heatmapLayer.setData(getEmissionsValues(DEFAULT_EMISSIONS));
@@ -615,13 +653,14 @@ function main(){
         // get the newly-selected element
         const newLocalAuth = localAuthsList.selectedOptions[0].text;
         if(newLocalAuth !== "All Local Authorities") {
-            // get the boundary coords of the local authority and move the map to centre on it
-            const newGeoJson = getGeojsonForLocalAuthority(newLocalAuth);
-            map.fitBounds(getMapLocalAuthBounds(newGeoJson["geometry"]["coordinates"][0][0]));
-            
-            // get rid of the existing local authority polygon layer, and draw a new LA polygon
-            map.removeLayer(geoJsonLayer);
-            geoJsonLayer = L.geoJSON(newGeoJson).addTo(map);
+            selectedLocalAuth = newLocalAuth;
+            loadBoundaries(map.getZoom(), function(geojson){
+                // get the boundary coords of the local authority and move the map to centre on it
+                const newGeoJson = getGeojsonForLocalAuthority(geojson, newLocalAuth);
+                map.fitBounds(getMapLocalAuthBounds(newGeoJson["geometry"]["coordinates"][0][0]));
+                // (the polygon is drawn once the map has zoomed; see 'zoomend')
+                drawLocalAuthBoundary();
+            });
 
             console.log("Sites:");
             console.log(getSitesInLocalAuthority(newLocalAuth));
@@ -639,6 +678,8 @@ function main(){
 
             changeLocalAuthorityInfoElements(newLocalAuth, sites);
         } else {
+            selectedLocalAuth = null;
+            map.removeLayer(geoJsonLayer);
             // TODO: reset the map view, either to the user location or to the London map
             const element = document.getElementById(CONFIG.HTML.LOCAL_AUTHS.CONTAINER_ID);
             if(!element.classList.contains("row-hidden")) {
@@ -647,6 +688,11 @@ function main(){
         }
     });
 
+    // ----------------------------------------------------------------------------------------------
+    // Redraw the selected local authority's boundary, with the detail to suit the new zoom
+    // ----------------------------------------------------------------------------------------------
+    map.on('zoomend', drawLocalAuthBoundary);
+
     // map.on('zoomend', function() {
     //     var currentZoom = map.getZoom();
     //     var myRadius = currentZoom*(1/2); //or whatever ratio you prefer